@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*
+import math
+import time
+import queue
+import pickle
+import logging
+import threading
+import multiprocessing
+from operator import itemgetter
+
+# Seconds between two adjustments of the number of workers
+AUTOSCALE_INTERVAL = 5
+
+# Extra workers over the ones Little's law asks for, to absorb the
+# variations of the latency
+AUTOSCALE_HEADROOM = 1.25
+
+# Latency (seconds) we assume until the first call of the throttled function
+# ends
+AUTOSCALE_INITIAL_LATENCY = 5
+
+# Seconds the pool waits for a result before looking at its workers
+AUTOSCALE_POLL_INTERVAL = 0.5
+
+# Asks a worker to exit, or to release what it keeps between tasks (ex: its
+# browsers) because it will not get tasks for a while
+_RETIRE = None
+_RELEASE = "release"
+
+_logger = logging.getLogger("bovespa")
+
+
+def _worker(tasks, results, initializer, initargs, releaser):
+    if initializer is not None:
+        initializer(*initargs)
+
+    while True:
+        task = tasks.get()
+        if task is _RETIRE or task == _RELEASE:
+            if releaser is not None:
+                releaser()
+            if task is _RETIRE:
+                return
+            continue
+
+        task_id, func, args, star = task
+        try:
+            result = (task_id, True, func(*args) if star else func(args))
+        except Exception as ex:
+            try:
+                pickle.dumps(ex)
+            except Exception:
+                ex = Exception(repr(ex))
+            result = (task_id, False, ex)
+        results.put(result)
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class _Slot(object):
+    """
+    A worker of the pool with its own queue of tasks, so only the workers we
+    choose get tasks
+    """
+
+    def __init__(self, worker, tasks):
+        self.worker = worker
+        self.tasks = tasks
+        self.busy = False
+        self.released = True
+
+
+class AutoscalingPool(object):
+    """
+    A pool of workers (processes or threads) whose size follows the calls
+    the throttle of the tasks allows. By Little's law, the number of calls
+    in progress is the rate of the calls times the time each call takes, so
+    every interval the pool keeps
+
+        workers = rate (calls/sec) * average latency (sec) * headroom
+
+    between min_workers and max_workers busy. The rate and the latency are
+    the ones of the throttle (see Throttle.average_latency), so the workers
+    do not wait for tokens they will not get.
+
+    Every worker has its own queue of tasks, and the tasks are only sent to
+    the first workers (the active ones), so no more workers than the target
+    run tasks. With threads, the pool starts new workers or asks the ones
+    over the target to exit. With processes, all the max_workers processes
+    are forked when the pool is created, so like the rest of the pools it
+    must be created before any thread is started (a process forked while
+    other threads hold locks can deadlock); the processes over the target
+    stay idle. In both cases the workers that stop getting tasks call the
+    releaser (ex: release_browser_pool, to quit their browsers).
+
+    It has the interface of the multiprocessing pools we use, and several
+    runs (ex: the stages of a pipeline) can share it:
+
+        pool = AutoscalingPool(download_file.throttle, max_workers=20)
+        for result in pool.imap_unordered(download_file_task, params):
+            ...
+        pool.close()
+        pool.join()
+    """
+
+    def __init__(self, throttle, max_workers, min_workers=1, threads=False,
+                 initializer=None, initargs=(), releaser=None, name="pool",
+                 interval=AUTOSCALE_INTERVAL, headroom=AUTOSCALE_HEADROOM):
+        self.throttle = throttle
+        self.max_workers = max(max_workers or 1, 1)
+        self.min_workers = min(max(min_workers, 1), self.max_workers)
+        self.threads = threads
+        self.initializer = initializer
+        self.initargs = initargs
+        self.releaser = releaser
+        self.name = name
+        self.interval = interval
+        self.headroom = headroom
+
+        self._results = queue.Queue() if threads else \
+            multiprocessing.Queue()
+
+        # All the workers started, to wait for them, and the ones that can
+        # get tasks, the active ones first
+        self._workers = []
+        self._slots = []
+        self._active = 0
+        # The worker and the run of each task in progress
+        self._task_slots = {}
+        self._task_runs = {}
+        self._next_task_id = 0
+        self._scaled_at = 0
+        self._condition = threading.Condition()
+        self._collector = None
+        self._closed = False
+        self._joined = False
+
+        if not threads:
+            for _ in range(self.max_workers):
+                self._start_worker()
+        self._scale(self.target_workers())
+
+    def target_workers(self):
+        """
+        The workers we need for the current rate and latency of the throttle
+        """
+        latency = self.throttle.average_latency() or \
+            AUTOSCALE_INITIAL_LATENCY
+        workers = math.ceil(
+            self.throttle.tokens_per_second() * latency * self.headroom)
+        return min(max(workers, self.min_workers), self.max_workers)
+
+    def _start_worker(self):
+        if self.threads:
+            tasks = queue.Queue()
+        else:
+            tasks = multiprocessing.Queue()
+        args = (tasks, self._results, self.initializer, self.initargs,
+                self.releaser)
+        if self.threads:
+            worker = threading.Thread(target=_worker, args=args, daemon=True)
+        else:
+            worker = multiprocessing.Process(
+                target=_worker, args=args, daemon=True)
+        worker.start()
+        self._workers.append(worker)
+        self._slots.append(_Slot(worker, tasks))
+
+    def _scale(self, workers):
+        with self._condition:
+            if self._closed or workers == self._active:
+                return
+
+            _logger.info("Autoscaling {0} from {1} to {2} workers (rate "
+                         "{3:.2f} calls/s, latency {4:.2f}s)".format(
+                             self.name, self._active, workers,
+                             self.throttle.tokens_per_second(),
+                             self.throttle.average_latency()))
+
+            if self.threads:
+                for _ in range(workers - len(self._slots)):
+                    self._start_worker()
+                # They end the task they have first
+                for slot in self._slots[workers:]:
+                    slot.tasks.put(_RETIRE)
+                del self._slots[workers:]
+            else:
+                for slot in self._slots[workers:]:
+                    if not slot.released:
+                        slot.tasks.put(_RELEASE)
+                        slot.released = True
+            self._active = workers
+            self._scaled_at = time.monotonic()
+            self._condition.notify_all()
+
+    def _check_workers(self):
+        with self._condition:
+            alive = []
+            for worker in self._workers:
+                if worker.is_alive():
+                    alive.append(worker)
+                elif getattr(worker, "exitcode", 0):
+                    raise WorkerDied("A worker of the {0} pool died with "
+                                     "exit code {1}".format(
+                                         self.name, worker.exitcode))
+            self._workers = alive
+
+            if time.monotonic() - self._scaled_at < self.interval:
+                return
+            self._scaled_at = time.monotonic()
+        self._scale(self.target_workers())
+
+    def _idle_slot(self):
+        """
+        :return: an active worker without a task, or None. Must be called
+                 holding the condition
+        """
+        for slot in self._slots[:self._active]:
+            if not slot.busy:
+                return slot
+        return None
+
+    def _feed(self, func, iterable, star, run):
+        # A task is only sent to an active worker without a task, so the
+        # workers over the target never get one
+        try:
+            for args in iterable:
+                with self._condition:
+                    slot = self._idle_slot()
+                    while slot is None and not run["stopped"]:
+                        self._condition.wait(AUTOSCALE_POLL_INTERVAL)
+                        slot = self._idle_slot()
+                    if run["stopped"]:
+                        return
+                    task_id = self._next_task_id
+                    self._next_task_id += 1
+                    slot.busy = True
+                    slot.released = False
+                    self._task_slots[task_id] = slot
+                    self._task_runs[task_id] = run
+                    run["pending"].add(task_id)
+                    slot.tasks.put((task_id, func, args, star))
+        except Exception as ex:
+            run["error"] = ex
+        finally:
+            run["exhausted"] = True
+
+    def _collect(self):
+        """
+        Free the worker of every result and give the result to its run. The
+        results of the runs that raised are dropped
+        """
+        while not self._joined:
+            try:
+                task_id, success, result = self._results.get(
+                    timeout=AUTOSCALE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            with self._condition:
+                slot = self._task_slots.pop(task_id, None)
+                if slot is not None:
+                    slot.busy = False
+                run = self._task_runs.pop(task_id, None)
+                self._condition.notify_all()
+            if run is not None:
+                run["results"].put((task_id, success, result))
+
+    def _imap(self, func, iterable, star=False):
+        """
+        :return: an iterator over the task ids and results, as they end
+        """
+        run = {"results": queue.Queue(), "pending": set(),
+               "exhausted": False, "stopped": False, "error": None}
+        with self._condition:
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect,
+                    name="{}-collector".format(self.name), daemon=True)
+                self._collector.start()
+        feeder = threading.Thread(
+            target=self._feed, args=(func, iterable, star, run),
+            name="{}-feeder".format(self.name), daemon=True)
+        feeder.start()
+
+        try:
+            while not (run["exhausted"] and not run["pending"]):
+                try:
+                    task_id, success, result = run["results"].get(
+                        timeout=AUTOSCALE_POLL_INTERVAL)
+                except queue.Empty:
+                    self._check_workers()
+                    continue
+
+                with self._condition:
+                    run["pending"].discard(task_id)
+                if not success:
+                    raise result
+                yield task_id, result
+
+                if time.monotonic() - self._scaled_at >= self.interval:
+                    self._check_workers()
+
+            if run["error"] is not None:
+                raise run["error"]
+        finally:
+            # The feeder ends when it takes the next item, and the results
+            # still running are not ours anymore
+            with self._condition:
+                run["stopped"] = True
+                for task_id in run["pending"]:
+                    self._task_runs.pop(task_id, None)
+                self._condition.notify_all()
+
+    def imap_unordered(self, func, iterable):
+        for task_id, result in self._imap(func, iterable):
+            yield result
+
+    def starmap(self, func, iterable):
+        return [result for task_id, result in
+                sorted(self._imap(func, iterable, star=True),
+                       key=itemgetter(0))]
+
+    def close(self):
+        with self._condition:
+            for slot in self._slots:
+                slot.tasks.put(_RETIRE)
+            self._slots = []
+            self._active = 0
+            self._closed = True
+            self._condition.notify_all()
+
+    def join(self):
+        for worker in self._workers:
+            while worker.is_alive():
+                worker.join(AUTOSCALE_POLL_INTERVAL)
+                # The results nobody reads would keep the processes alive
+                if self._collector is None:
+                    self._drain_results()
+        self._workers = []
+        self._joined = True
+        if self._collector is not None:
+            self._collector.join()
+
+    def _drain_results(self):
+        try:
+            while True:
+                self._results.get_nowait()
+        except queue.Empty:
+            pass
+
+    def terminate(self):
+        self._closed = True
+        self._joined = True
+        for worker in self._workers:
+            if not self.threads and worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*
+"""
+Benchmark of the extraction of the accounts of the InfoFinaDFin.xml files
+(download_file.py)
+
+It compares the streaming extractor (iterparse) with the previous
+implementation, that converted the whole file into json with badgerfish,
+checking that both return the same accounts. Each extractor runs in its own
+process to measure its peak RSS.
+
+The packages are downloaded ENET files (crawler_cache/<ccvm>/*.ITR or
+*.DFP). Without packages, a synthetic one is generated.
+
+Usage:
+    python benchmarks/account_extractor_benchmark.py \
+        crawler_cache/9512/CCVM_9512_20180331_10.ITR
+"""
+import io
+import os
+import sys
+import time
+import random
+import zipfile
+import argparse
+import resource
+from datetime import datetime
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from crawling_parts.download_file import (  # noqa: E402
+    get_financial_info_accounts, read_file_content, FilingContext,
+    SHARES_NUMBER_ACCOUNTS)
+
+BALANCE_TYPE_CODES = [2, 3, 4, 5, 6, 7, 8, 9]
+
+DOCUMENT_XML = \
+    '<?xml version="1.0" encoding="utf-8"?>\n<Documento>\n' \
+    '  <CodigoEscalaMoeda>2</CodigoEscalaMoeda>\n' \
+    '  <CodigoEscalaQuantidade>1</CodigoEscalaQuantidade>\n</Documento>\n'
+
+
+def synthetic_package(doc_type, num_of_accounts):
+    """
+    An ENET package with an ITR/DFP zip inside with the files we parse
+    """
+    rnd = random.Random(num_of_accounts)
+
+    accounts = []
+    for number in range(num_of_accounts):
+        values = "".join(
+            "<ValorConta{0}>{1}</ValorConta{0}>".format(
+                index, rnd.randint(-10 ** 9, 10 ** 9))
+            for index in range(1, 7))
+        accounts.append(
+            "<InfoFinaDFin>\n  <PlanoConta>\n    <VersaoPlanoConta>\n"
+            "      <CodigoTipoDemonstracaoFinanceira>{0}"
+            "</CodigoTipoDemonstracaoFinanceira>\n"
+            "      <CodigoTipoInformacaoFinanceira>{1}"
+            "</CodigoTipoInformacaoFinanceira>\n    </VersaoPlanoConta>\n"
+            "    <NumeroConta>{2}.{3:02d}</NumeroConta>\n  </PlanoConta>\n"
+            "  <DescricaoConta1>Conta {3}</DescricaoConta1>\n"
+            "  <PeriodoDemonstracaoFinanceira>\n"
+            "    <NumeroIdentificacaoPeriodo>{4}"
+            "</NumeroIdentificacaoPeriodo>\n"
+            "  </PeriodoDemonstracaoFinanceira>\n  {5}\n"
+            "</InfoFinaDFin>".format(
+                rnd.choice(BALANCE_TYPE_CODES), rnd.choice([1, 2]),
+                rnd.randint(1, 9), number, rnd.choice([1, 4]), values))
+    financial_info = '<?xml version="1.0" encoding="utf-8"?>\n' \
+                     '<ArrayOfInfoFinaDFin>\n{}\n' \
+                     '</ArrayOfInfoFinaDFin>\n'.format("\n".join(accounts))
+
+    capital_composition = \
+        '<?xml version="1.0" encoding="utf-8"?>\n' \
+        '<ArrayOfComposicaoCapitalSocialDemonstracaoFinanceira>\n' \
+        '<ComposicaoCapitalSocialDemonstracaoFinanceira>\n{}\n' \
+        '</ComposicaoCapitalSocialDemonstracaoFinanceira>\n' \
+        '</ArrayOfComposicaoCapitalSocialDemonstracaoFinanceira>\n'.format(
+            "\n".join("<{0}>{1}</{0}>".format(name, 1000)
+                      for number, name in SHARES_NUMBER_ACCOUNTS))
+
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("Documento.xml", DOCUMENT_XML)
+        zip_ref.writestr(
+            "ComposicaoCapitalSocialDemonstracaoFinanceiraNegocios.xml",
+            capital_composition)
+        zip_ref.writestr("InfoFinaDFin.xml", financial_info)
+
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("00001.{}".format(doc_type), inner.getvalue())
+
+    return package.getvalue()
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def extract(queue, available_files, doc_type, filings, stream):
+    rss_before = max_rss_kb()
+    started_at = time.monotonic()
+    for _ in range(filings):
+        accounts = get_financial_info_accounts(
+            FilingContext(available_files), "0", datetime(2018, 3, 31),
+            "1.0", doc_type, stream=stream)
+    elapsed = time.monotonic() - started_at
+    queue.put((accounts, elapsed, max_rss_kb(), max_rss_kb() - rss_before))
+
+
+def run(available_files, doc_type, filings, stream):
+    queue = Queue()
+    process = Process(target=extract,
+                      args=(queue, available_files, doc_type, filings, stream))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("packages", nargs="*", help="Downloaded ENET files")
+    parser.add_argument("--doc-type", default="ITR")
+    parser.add_argument("--synthetic-accounts", type=int, default=5000,
+                        help="Accounts of the synthetic package")
+    parser.add_argument("--filings", type=int, default=20,
+                        help="Times each package is extracted")
+    args = parser.parse_args()
+
+    packages = []
+    for filename in args.packages:
+        with open(filename, "rb") as f:
+            packages.append((filename, f.read()))
+    if not packages:
+        packages.append((
+            "synthetic ({} accounts)".format(args.synthetic_accounts),
+            synthetic_package(args.doc_type, args.synthetic_accounts)))
+
+    for name, package in packages:
+        available_files = read_file_content(
+            args.doc_type, io.BytesIO(package))
+
+        print(name)
+        results = []
+        for label, stream in [("badgerfish", False), ("iterparse", True)]:
+            accounts, elapsed, max_rss, rss_increase = run(
+                available_files, args.doc_type, args.filings, stream)
+            results.append(accounts)
+            print("  {0:>10}: {1:8.1f} filings/sec, peak RSS {2:8,} KB "
+                  "(+{3:,} KB)".format(label, args.filings / elapsed,
+                                       max_rss, rss_increase))
+        print("  {0} accounts -> {1}".format(
+            len(results[-1]),
+            "identical" if results[0] == results[1] else "DIFFERENT"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*
+"""
+Benchmark of the checkpoint backends (checkpoint.py)
+
+For each backend it measures the time to checkpoint N company keys one by one
+(like the workers of the company files stage do) and the time to look up
+every key afterwards.
+
+Usage:
+    python benchmarks/checkpoint_benchmark.py --keys 10000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from checkpoint import (  # noqa: E402
+    Checkpoint, set_checkpoint_backend, CHECKPOINT_BACKENDS)
+
+# A company with 40 files like the ones of the company files stage
+COMPANY_FILES = [(datetime(2018, 3, 31), "{:06d}".format(protocol), "1.0",
+                  "ITR", "Apresentacao", datetime(2018, 5, 10))
+                 for protocol in range(40)]
+
+
+def run(backend, keys_num, folder):
+    set_checkpoint_backend(backend)
+    checkpoint = Checkpoint(os.path.join(folder, "{}.ctl".format(backend)))
+    keys = ["{}_ITR".format(ccvm) for ccvm in range(keys_num)]
+
+    started_at = time.monotonic()
+    for key in keys:
+        checkpoint.put(key, COMPANY_FILES)
+    put_time = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    found = sum(1 for key in keys if key in checkpoint)
+    lookup_time = time.monotonic() - started_at
+    assert found == keys_num
+
+    return put_time, lookup_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--backends", nargs="*", default=CHECKPOINT_BACKENDS)
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>12} {:>14}".format(
+        "backend", "puts (s)", "lookups (s)", "puts/sec"))
+    with tempfile.TemporaryDirectory() as folder:
+        for backend in args.backends:
+            put_time, lookup_time = run(backend, args.keys, folder)
+            print("{:>8} {:12.2f} {:12.2f} {:14,.0f}".format(
+                backend, put_time, lookup_time, args.keys / put_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*
+"""
+Benchmark of the parser of the company documents page (company_files.py)
+
+It compares the single pass lxml parser with the previous implementation,
+that serialized the BeautifulSoup document for every regular expression,
+checking that both return the same files.
+
+The pages are the saved HTML of the documents listing of a company (the
+page shown after clicking the ITR or DFP link), with all the documents in
+one page (QtLinks=1000). Without pages, a synthetic page is generated.
+
+Usage:
+    python benchmarks/company_files_parser_benchmark.py \
+        --doc-type ITR saved_pages/9512_ITR.html saved_pages/86_ITR.html
+"""
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+
+import lxml.html
+from bs4 import BeautifulSoup
+from dateutil.parser import parse as date_parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from crawling_parts.company_files import (  # noqa: E402
+    extract_company_files_from_page,
+    RE_DOWNLOAD_FILE, RE_TOTAL_FILES, RE_LAST_FILE_IN_PAGE)
+
+# The expressions the previous implementation used over the serialized
+# BeautifulSoup document
+RE_FISCAL_DATE = r'Data Encerramento.*[\s].*(\d{2}/\d{2}/\d{4})'
+RE_DELIVERY_DATE = r'Data Entrega.*[\s].*(\d{2}/\d{2}/\d{4}) \d{2}:\d{2}'
+RE_VERSION = r'Versão.*[\s].*(\d+.\d+)'
+RE_DELIVERY_TYPE = r'Tipo Apresentação.*[\s].*<td.*>([\w\s]*)</td>'
+RE_COMPANY_NAME = r'Razão Social.*:(.*)<br/>'
+RE_CNPJ = r'CNPJ.*:(.*)\s'
+
+_logger = logging.getLogger("bovespa")
+
+
+def legacy_extract_company_files_from_page(
+        ccvm, next_page, bs, doc_type="ITR", from_date=None):
+    """
+    Extract all the files to download from the listing HTML page
+
+    :param next_page: a function that navigates to the next page of the
+                    listing and returns its BeautifulSoup object. We use it
+                    to navigate through the listing if needed
+    :param bs: a BeautifulSoup object with the content of the listing page
+    :param doc_type: the type of the files we are downloading
+    :param from_date: if we are interested only in files presented after a
+                    given date (newer files only)
+    :return: a list of tuples with two components: the fiscal_period (date)
+                and the protocol code for each file in the list
+    """
+    files = []
+
+    # Extract the company name from the content
+    company_name = re.search(RE_COMPANY_NAME, str(bs))[1].strip()
+
+    # Extract the CNPJ from the content
+    company_cnpj = re.search(RE_CNPJ, str(bs))[1].strip().lower()
+
+    # Get the number of files we should expect to find for the company
+    try:
+        num_of_docs = int(re.search(RE_TOTAL_FILES, str(bs))[1])
+    except:
+        _logger.warning("There is no files information in the companies "
+                        "files page for [{ccvm} - {doc_type}] ".
+                        format(ccvm=ccvm, doc_type=doc_type))
+        return files
+
+    while True:
+
+        # Get the number of files we can really get from the current page
+        last_file_in_page = int(
+            re.search(RE_LAST_FILE_IN_PAGE, str(bs))[2])
+
+        # Obtain the table elements that contains information about files with
+        # financial statements of the company
+        all_tables = [tag.findParent("table") for tag in
+                      bs.find_all(
+                          text=re.compile("{} - ENET".format(doc_type)))
+                      if tag.findParent("table")]
+
+        # For each table we extract the files information of all the files
+        # that belongs to a fiscal period after the from_date argument.
+        for table in all_tables:
+            link_tag = table.find('a', href=re.compile(RE_DOWNLOAD_FILE))
+            if link_tag:
+                fiscal_date = re.search(RE_FISCAL_DATE,str(table))[1]
+                fiscal_date = date_parse(fiscal_date)
+
+                delivery_date = re.search(RE_DELIVERY_DATE, str(table))[1]
+                delivery_date = date_parse(delivery_date)
+
+                # We only continue processing files from the HTML page
+                # if are newer (deliver after) than the from_date argument.
+                # We look for newer delivery files
+                if from_date is not None and delivery_date <= from_date:
+                    break
+
+                version = re.search(RE_VERSION, str(table))[1]
+
+                delivery_type = re.search(RE_DELIVERY_TYPE, str(table))[1]
+
+                protocol = re.match(
+                    RE_DOWNLOAD_FILE, link_tag.attrs['href'])[1]
+
+                if not from_date or fiscal_date >= from_date:
+                    files.append((fiscal_date, protocol, version,
+                                  doc_type, delivery_type, delivery_date))
+            else:
+                _logger.debug("The file is not available in ITR format")
+
+        if last_file_in_page == num_of_docs:
+            break
+        else:
+            # Navigate to the next page
+            bs = next_page()
+
+    return files
+
+
+def synthetic_page(doc_type, num_of_docs):
+    tables = []
+    for i in range(num_of_docs):
+        year = 2018 - i // 4
+        fiscal_date = "{:02d}/{:02d}/{}".format(
+            [31, 30, 30, 31][i % 4], [3, 6, 9, 12][i % 4], year)
+        tables.append(
+            "<table width=\"100%\">\n"
+            "<tr><td class=\"tit\">{doc_type} - ENET</td>\n"
+            "<td><a href=\"javascript:fVisualizaArquivo_ENET('{protocol}',"
+            "'DOWNLOAD')\">Download</a></td></tr>\n"
+            "<tr><td>Data Encerramento:</td>\n<td>{fiscal_date}</td></tr>\n"
+            "<tr><td>Data Entrega:</td>\n"
+            "<td>10/05/{year} 18:35</td></tr>\n"
+            "<tr><td>Versão:</td>\n<td>{version}</td></tr>\n"
+            "<tr><td>Tipo Apresentação:</td>\n"
+            "<td class=\"val\">Apresentação</td></tr>\n"
+            "</table>".format(doc_type=doc_type, protocol=60000 + i,
+                              fiscal_date=fiscal_date, year=year,
+                              version="{}.0".format(1 + i % 2)))
+
+    return (
+        "<html><head><title>Documentos</title></head><body>\n"
+        "<b>Razão Social:</b> EMPRESA TESTE SA<br/>\n"
+        "<b>CNPJ:</b> 00.000.000/0001-00\n"
+        "<form name=\"AIR\"><table><tr>"
+        "<td>{total}&nbsp;documento(s) encontrado(s)</td></tr>\n"
+        "<tr><td>Exibindo&nbsp;1&nbsp;a&nbsp;{total}</td></tr></table>\n"
+        "{tables}\n</form></body></html>".format(
+            total=num_of_docs, tables="\n".join(tables)))
+
+
+def no_next_page():
+    raise AssertionError("The benchmark pages must have all the documents")
+
+
+def run(fn, repetitions):
+    started_at = time.monotonic()
+    for _ in range(repetitions):
+        result = fn()
+    return result, (time.monotonic() - started_at) / repetitions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pages", nargs="*", help="Saved HTML pages")
+    parser.add_argument("--doc-type", default="ITR")
+    parser.add_argument("--synthetic-docs", type=int, default=300,
+                        help="Documents of the synthetic page")
+    parser.add_argument("--repetitions", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = []
+    for filename in args.pages:
+        with open(filename, encoding="utf-8", errors="replace") as f:
+            pages.append((filename, f.read()))
+    if not pages:
+        pages.append(("synthetic ({} docs)".format(args.synthetic_docs),
+                      synthetic_page(args.doc_type, args.synthetic_docs)))
+
+    for name, html in pages:
+        legacy, legacy_time = run(
+            lambda: legacy_extract_company_files_from_page(
+                "0", no_next_page, BeautifulSoup(html, "html.parser"),
+                doc_type=args.doc_type), args.repetitions)
+        current, current_time = run(
+            lambda: extract_company_files_from_page(
+                "0", no_next_page, lxml.html.fromstring(html),
+                doc_type=args.doc_type), args.repetitions)
+
+        print("{0}: {1} files. previous {2:.3f}s, lxml {3:.3f}s ({4:.1f}x)"
+              " -> {5}".format(name, len(current), legacy_time, current_time,
+                               legacy_time / current_time,
+                               "identical" if legacy == current
+                               else "DIFFERENT"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*
+"""
+Microbenchmark of the shared-memory token bucket of throttle.Throttle
+
+It measures:
+    - the overhead of a throttled call (calls/sec) when the bucket never
+      runs out of tokens
+    - how close the achieved rate is to the configured one when 10 to 50
+      workers compete for the same bucket
+
+Usage:
+    python benchmarks/throttle_benchmark.py --rate 600 --duration 10
+"""
+import os
+import sys
+import time
+import argparse
+from multiprocessing import Process, Value
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from throttle import Throttle  # noqa: E402
+
+
+def run_calls(throttled_fn, deadline, counter):
+    calls = 0
+    while True:
+        throttled_fn()
+        # Calls granted after the deadline are not part of the measure
+        if time.monotonic() >= deadline:
+            break
+        calls += 1
+    with counter.get_lock():
+        counter.value += calls
+
+
+def measure(throttle, workers_num, duration):
+    @throttle
+    def noop():
+        pass
+
+    counter = Value("l", 0)
+    deadline = time.monotonic() + duration
+    workers = [Process(target=run_calls, args=(noop, deadline, counter))
+               for _ in range(workers_num)]
+    started_at = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return counter.value, min(time.monotonic(), deadline) - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=int, default=600,
+                        help="Calls per minute for the accuracy test")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds each scenario runs")
+    parser.add_argument("--workers", type=int, nargs="*",
+                        default=[10, 25, 50])
+    args = parser.parse_args()
+
+    print("Overhead (unbounded bucket)")
+    for workers_num in [1] + args.workers:
+        throttle = Throttle(seconds=1, rate=10 ** 9, max_tokens=10 ** 9)
+        calls, elapsed = measure(throttle, workers_num, 2)
+        print("  workers={0:3d}  {1:12,.0f} calls/sec".format(
+            workers_num, calls / elapsed))
+
+    print("Accuracy (configured {} calls/min)".format(args.rate))
+    for workers_num in args.workers:
+        # One token of burst, so the result shows the sustained rate
+        throttle = Throttle(minutes=1, rate=args.rate, max_tokens=1)
+        calls, elapsed = measure(throttle, workers_num, args.duration)
+        achieved = (calls - 1) / args.duration * 60
+        print("  workers={0:3d}  {1:8.1f} calls/min  ({2:.1%} of "
+              "configured)".format(workers_num, achieved,
+                                   achieved / args.rate))
+
+
+if __name__ == "__main__":
+    main()
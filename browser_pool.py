@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*
+import logging
+import threading
+from contextlib import contextmanager
+from multiprocessing import Value
+from multiprocessing.util import Finalize
+
+from selenium import webdriver
+
+# Number of tasks served by a browser before being recycled
+MAX_BROWSER_USES = 50
+
+# Counters shared by all the workers to report the launches we saved
+_launches = Value("i", 0)
+_tasks = Value("i", 0)
+
+# The browser pool of the current worker process
+_browser_pool = None
+
+_logger = logging.getLogger("bovespa")
+
+
+class BrowserPool(object):
+    """
+    Keeps the PhantomJS browsers of a worker process alive between tasks,
+    one per thread. The browsers are reset (cookies and current page) after
+    each task, and recycled after max_uses tasks or when they crash.
+    """
+
+    def __init__(self, phantomjs_path, max_uses=MAX_BROWSER_USES):
+        self.phantomjs_path = phantomjs_path
+        self.max_uses = max_uses
+        self._local = threading.local()
+        self._drivers = []
+        self._lock = threading.Lock()
+
+    def _launch(self):
+        _logger.debug("Launching phantomjs browser")
+        driver = webdriver.PhantomJS(executable_path=self.phantomjs_path)
+        with _launches.get_lock():
+            _launches.value += 1
+        with self._lock:
+            self._drivers.append(driver)
+        self._local.driver = driver
+        self._local.uses = 0
+        return driver
+
+    def _discard(self):
+        driver = getattr(self._local, "driver", None)
+        self._local.driver = None
+        if driver is None:
+            return
+        with self._lock:
+            self._drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            _logger.exception("Unable to quit the phantomjs browser")
+
+    @staticmethod
+    def _reset(driver):
+        driver.delete_all_cookies()
+        driver.get("about:blank")
+
+    @contextmanager
+    def browser(self):
+        """
+        Lend the browser of the current thread for a task
+        """
+        driver = getattr(self._local, "driver", None) or self._launch()
+        self._local.uses += 1
+        with _tasks.get_lock():
+            _tasks.value += 1
+
+        try:
+            yield driver
+        finally:
+            try:
+                self._reset(driver)
+            except Exception:
+                _logger.warning("The phantomjs browser crashed. Recycling it")
+                self._discard()
+            else:
+                if self._local.uses >= self.max_uses:
+                    _logger.debug("Recycling the phantomjs browser after {} "
+                                  "uses".format(self._local.uses))
+                    self._discard()
+
+    def release(self):
+        """
+        Quit the browser of the current thread. A new one is launched on
+        demand
+        """
+        self._discard()
+
+    def quit(self):
+        with self._lock:
+            drivers, self._drivers = self._drivers, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                _logger.exception("Unable to quit the phantomjs browser")
+
+
+def init_browser_pool(phantomjs_path, max_uses=MAX_BROWSER_USES):
+    """
+    Initializer of the worker processes of a Pool. The browsers are launched
+    on demand and closed when the worker exits.
+    """
+    global _browser_pool
+    _browser_pool = BrowserPool(phantomjs_path, max_uses=max_uses)
+    Finalize(_browser_pool, _browser_pool.quit, exitpriority=10)
+
+
+def release_browser_pool():
+    """
+    Releaser of the workers of an AutoscalingPool: quit the browser of the
+    worker when it stops getting tasks
+    """
+    if _browser_pool is not None:
+        _browser_pool.release()
+
+
+@contextmanager
+def browser(phantomjs_path):
+    """
+    Obtain a browser for a task: the one of the worker pool if the process
+    was initialized with init_browser_pool, or a new one closed at the end
+    of the task
+    """
+    if _browser_pool is not None:
+        with _browser_pool.browser() as driver:
+            yield driver
+        return
+
+    pool = BrowserPool(phantomjs_path, max_uses=1)
+    try:
+        with pool.browser() as driver:
+            yield driver
+    finally:
+        pool.quit()
+
+
+def report_browser_launches():
+    _logger.info("{0} browser tasks served with {1} browser launches "
+                 "({2} launches saved)".format(
+                     _tasks.value, _launches.value,
+                     _tasks.value - _launches.value))
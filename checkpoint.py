@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*
+import os
+import pickle
+import shutil
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from multiprocessing import Lock
+
+from utils import get_control_file, put_control_file
+
+CHECKPOINT_BACKEND_SQLITE = "sqlite"
+CHECKPOINT_BACKEND_PICKLE = "pickle"
+CHECKPOINT_BACKENDS = [CHECKPOINT_BACKEND_SQLITE, CHECKPOINT_BACKEND_PICKLE]
+
+# Seconds a writer waits for the lock of the database
+SQLITE_TIMEOUT = 60
+
+_backend = CHECKPOINT_BACKEND_SQLITE
+
+# Cross-process lock for the pickle control files. It must be created before
+# the pools are started
+_pickle_lock = Lock()
+
+_logger = logging.getLogger("bovespa")
+
+
+def set_checkpoint_backend(backend):
+    """
+    Select the store of the checkpoint files. It must be called before
+    starting the pools.
+    """
+    global _backend
+    _backend = backend
+
+
+def _as_dict(content):
+    """
+    The old control files with a list of processed items are loaded as a
+    dict of processed items
+    """
+    if isinstance(content, (list, tuple)):
+        return {item: True for item in content}
+    return dict(content or {})
+
+
+class PickleCheckpoint(object):
+    """
+    The checkpoint is a dict pickled in the control file. Every change
+    rewrites the whole file, so it is only suitable for small checkpoints.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _load(self):
+        return _as_dict(get_control_file(self.filename, {}))
+
+    def get(self, key, default=None):
+        with _pickle_lock:
+            return self._load().get(key, default)
+
+    def put(self, key, value):
+        self.update(key, lambda _: value)
+
+    def update(self, key, fn, default=None):
+        with _pickle_lock:
+            content = self._load()
+            content[key] = fn(content.get(key, default))
+            put_control_file(self.filename, content)
+
+    def __contains__(self, key):
+        with _pickle_lock:
+            return key in self._load()
+
+    def items(self):
+        with _pickle_lock:
+            return list(self._load().items())
+
+    def reset(self):
+        with _pickle_lock:
+            if Path(self.filename).exists():
+                shutil.move(self.filename, "{}.bak".format(self.filename))
+
+
+class SqliteCheckpoint(object):
+    """
+    The checkpoint is a key/value table of a SQLite database in WAL mode, so
+    the changes are appended to the log and the lookups use the primary
+    key index. The processes (and threads) can read while another one is
+    writing. The old pickle control file is migrated to the database the
+    first time it is opened.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db_filename = "{}.sqlite".format(
+            os.path.splitext(filename)[0])
+        self._local = threading.local()
+
+    def _connection(self):
+        # The connections can not be shared between processes nor threads
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connection = self._connect()
+        return self._local.connection
+
+    def _connect(self):
+        Path(self.db_filename).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(
+            self.db_filename, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS checkpoint ("
+                           "key TEXT PRIMARY KEY, value BLOB)")
+        connection.execute("CREATE TABLE IF NOT EXISTS migration ("
+                           "filename TEXT PRIMARY KEY)")
+        self._migrate(connection)
+        return connection
+
+    def _migrate(self, connection):
+        if not Path(self.filename).exists():
+            return
+
+        with _Transaction(connection):
+            if connection.execute(
+                    "SELECT 1 FROM migration WHERE filename = ?",
+                    (self.filename,)).fetchone():
+                return
+
+            content = _as_dict(get_control_file(self.filename, {}))
+            _logger.info("Migrating {0} keys from {1} to {2}".format(
+                len(content), self.filename, self.db_filename))
+            connection.executemany(
+                "INSERT OR REPLACE INTO checkpoint (key, value) "
+                "VALUES (?, ?)",
+                [(str(key), _dumps(value)) for key, value in content.items()])
+            connection.execute(
+                "INSERT INTO migration (filename) VALUES (?)",
+                (self.filename,))
+
+    def get(self, key, default=None):
+        row = self._connection().execute(
+            "SELECT value FROM checkpoint WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def put(self, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO checkpoint (key, value) VALUES (?, ?)",
+            (key, _dumps(value)))
+
+    def update(self, key, fn, default=None):
+        connection = self._connection()
+        with _Transaction(connection):
+            row = connection.execute(
+                "SELECT value FROM checkpoint WHERE key = ?",
+                (key,)).fetchone()
+            value = fn(pickle.loads(row[0]) if row else default)
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoint (key, value) "
+                "VALUES (?, ?)", (key, _dumps(value)))
+
+    def __contains__(self, key):
+        return self._connection().execute(
+            "SELECT 1 FROM checkpoint WHERE key = ?",
+            (key,)).fetchone() is not None
+
+    def items(self):
+        return [(key, pickle.loads(value)) for key, value in
+                self._connection().execute(
+                    "SELECT key, value FROM checkpoint")]
+
+    def reset(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local = threading.local()
+
+        for filename in [self.filename, self.db_filename,
+                         "{}-wal".format(self.db_filename),
+                         "{}-shm".format(self.db_filename)]:
+            if Path(filename).exists():
+                shutil.move(filename, "{}.bak".format(filename))
+
+
+class _Transaction(object):
+    """
+    Write transaction that takes the lock of the database from the start
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class Checkpoint(object):
+    """
+    Checkpoint of the processed items of a stage, stored with the selected
+    backend (see set_checkpoint_backend)
+
+        files = Checkpoint("ctl/files_per_company.ctl")
+        files.put("9512_ITR", [...])
+        "9512_ITR" in files
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._stores = {}
+
+    def _store(self):
+        store = self._stores.get(_backend)
+        if store is None:
+            if _backend == CHECKPOINT_BACKEND_PICKLE:
+                store = PickleCheckpoint(self.filename)
+            else:
+                store = SqliteCheckpoint(self.filename)
+            self._stores[_backend] = store
+        return store
+
+    def get(self, key, default=None):
+        return self._store().get(key, default)
+
+    def put(self, key, value):
+        self._store().put(key, value)
+
+    def update(self, key, fn, default=None):
+        """
+        Atomically replace the value of the key with fn(current value)
+        """
+        self._store().update(key, fn, default)
+
+    def __contains__(self, key):
+        return key in self._store()
+
+    def items(self):
+        return self._store().items()
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def reset(self):
+        """
+        Move the checkpoint files away to start the stage from the beginning
+        """
+        self._store().reset()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*
+import time
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+from multiprocessing import Lock, RawArray
+
+import requests
+
+from throttle import is_server_failure
+
+# The states of a circuit
+CIRCUIT_CLOSED = 0  # The calls go on
+CIRCUIT_OPEN = 1  # The calls wait until the cooldown ends
+CIRCUIT_HALF_OPEN = 2  # A single call probes the endpoint
+
+# Positions of the circuit fields inside the shared array
+_STATE = 0
+_OPENED_AT = 1
+_COOLDOWN = 2
+_WINDOW_START = 3
+_CALLS = 4
+_FAILURES = 5
+_OUTAGE_START = 6
+_PROBE_AT = 7
+
+# Seconds a waiting call sleeps before looking at the circuit again
+CIRCUIT_POLL_INTERVAL = 1
+
+_logger = logging.getLogger("bovespa")
+
+
+class CircuitBreaker(object):
+    """
+    Decorator that pauses the calls to an endpoint while it is failing (ex:
+    a maintenance of the CVM or Bovespa sites), instead of letting every
+    worker wait out its timeouts:
+
+        - the circuit opens when, in a window of window seconds, at least
+          min_calls calls were made and failure_rate of them failed with a
+          timeout, a connection error, an HTTP 5xx or any of the failures
+          exceptions (see is_failure)
+        - while it is open the calls wait, and after cooldown seconds a
+          single call probes the endpoint (half open). The rest of the
+          calls keep waiting
+        - if the probe works the circuit closes and the calls go on, else
+          it opens again for twice the cooldown, up to max_cooldown
+
+    The beginning and the end of every outage are logged.
+
+    Like the Throttle, the circuit lives in shared memory created when the
+    function is decorated, so all the workers (processes or threads) of a
+    stage share it. It must wrap the throttle, so a waiting call does not
+    take a token:
+
+        @CircuitBreaker("download")
+        @AdaptiveThrottle(minutes=1, rate=20)
+        def download_file():
+            pass
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=60,
+                 cooldown=30, max_cooldown=300, failures=()):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = tuple(failures)
+
+        self._lock = Lock()
+        self._circuit = RawArray("d", [CIRCUIT_CLOSED, 0, cooldown,
+                                       time.monotonic(), 0, 0, 0, 0])
+
+    def is_failure(self, ex):
+        """
+        The calls that fail are the ones that raise any of the failures
+        exceptions, a timeout, an HTTP 5xx or an error of requests without
+        a response (ex: a connection or read timeout). An HTTP 4xx means the
+        endpoint answered
+        """
+        if isinstance(ex, self.failures) or is_server_failure(ex):
+            return True
+        return isinstance(ex, requests.RequestException) and \
+            getattr(ex, "response", None) is None
+
+    def state(self):
+        return int(self._circuit[_STATE])
+
+    def try_call(self):
+        """
+        Ask the circuit for a call. Only one call gets the probe of a half
+        open circuit; a probe that never reports (ex: its worker died) is
+        given to another call after the cooldown.
+
+        :return: the seconds to wait before asking again (0 if the call can
+                 go on), and if the call is the probe
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._circuit[_STATE]
+            if state == CIRCUIT_CLOSED:
+                return 0, False
+
+            if state == CIRCUIT_OPEN:
+                wait = self._circuit[_OPENED_AT] + \
+                    self._circuit[_COOLDOWN] - now
+            else:
+                wait = self._circuit[_PROBE_AT] + \
+                    self._circuit[_COOLDOWN] - now
+            if wait > 0:
+                return min(wait, CIRCUIT_POLL_INTERVAL), False
+
+            self._circuit[_STATE] = CIRCUIT_HALF_OPEN
+            self._circuit[_PROBE_AT] = now
+            return 0, True
+
+    def wait_for_call(self, fn_name):
+        """
+        :return: if the call is the probe of the circuit
+        """
+        while True:
+            wait, probe = self.try_call()
+            if not wait:
+                if probe:
+                    _logger.info("Circuit {0} half open: probing with "
+                                 "{1}".format(self.name, fn_name))
+                return probe
+            time.sleep(wait)
+
+    def on_success(self, probe):
+        with self._lock:
+            if probe:
+                outage_start = self._circuit[_OUTAGE_START]
+                self._circuit[_STATE] = CIRCUIT_CLOSED
+                self._circuit[_COOLDOWN] = self.cooldown
+                self._reset_window(time.monotonic())
+            else:
+                self._count(failed=False)
+                return
+
+        outage_end = time.time()
+        _logger.warning("Circuit {0} closed. Outage from {1} to {2} "
+                        "({3})".format(
+                            self.name,
+                            datetime.fromtimestamp(outage_start).isoformat(),
+                            datetime.fromtimestamp(outage_end).isoformat(),
+                            timedelta(seconds=round(
+                                outage_end - outage_start))))
+
+    def on_failure(self, probe, ex):
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                cooldown = min(self._circuit[_COOLDOWN] * 2,
+                               self.max_cooldown)
+                self._circuit[_STATE] = CIRCUIT_OPEN
+                self._circuit[_OPENED_AT] = now
+                self._circuit[_COOLDOWN] = cooldown
+                opened = False
+            else:
+                calls, failures = self._count(failed=True)
+                opened = self._circuit[_STATE] == CIRCUIT_CLOSED and \
+                    calls >= self.min_calls and \
+                    failures >= calls * self.failure_rate
+                if opened:
+                    self._circuit[_STATE] = CIRCUIT_OPEN
+                    self._circuit[_OPENED_AT] = now
+                    self._circuit[_COOLDOWN] = self.cooldown
+                    self._circuit[_OUTAGE_START] = time.time()
+
+        if opened:
+            _logger.warning("Circuit {0} opened at {1}: {2:.0f} of {3:.0f} "
+                            "calls failed, the last with {4}. Pausing the "
+                            "calls for {5}s".format(
+                                self.name, datetime.now().isoformat(),
+                                failures, calls, type(ex).__name__,
+                                self.cooldown))
+        elif probe:
+            _logger.warning("Circuit {0} probe failed with {1}. Pausing the "
+                            "calls for {2:.0f}s".format(
+                                self.name, type(ex).__name__, cooldown))
+
+    def _reset_window(self, now):
+        self._circuit[_WINDOW_START] = now
+        self._circuit[_CALLS] = 0
+        self._circuit[_FAILURES] = 0
+
+    def _count(self, failed):
+        """
+        Count a call in the current window. Must be called holding the lock.
+
+        :return: the calls and the failures of the window
+        """
+        now = time.monotonic()
+        if now - self._circuit[_WINDOW_START] > self.window:
+            self._reset_window(now)
+        self._circuit[_CALLS] += 1
+        if failed:
+            self._circuit[_FAILURES] += 1
+        return self._circuit[_CALLS], self._circuit[_FAILURES]
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            probe = self.wait_for_call(fn.__name__)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as ex:
+                if self.is_failure(ex):
+                    self.on_failure(probe, ex)
+                else:
+                    # The endpoint answered
+                    self.on_success(probe)
+                raise
+            self.on_success(probe)
+            return result
+
+        wrapper.circuit_breaker = self
+        return wrapper
@@ -3,35 +3,137 @@ import logging
 import logging.config
 import argparse
 from pathlib import Path
+from urllib.parse import urlparse
 
 from utils import mk_datetime
+from http_session import (
+    FETCH_MODES, FETCH_MODE_HTTP, FETCH_MODE_PHANTOMJS, allow_insecure_host)
+from browser_pool import MAX_BROWSER_USES
+from parse_cache import PARSE_CACHE_SIZE
+from checkpoint import (
+    set_checkpoint_backend, CHECKPOINT_BACKENDS, CHECKPOINT_BACKEND_SQLITE)
+from throttle import (
+    set_adaptive_mode, configure_adaptive_throttle, log_adaptive_rates,
+    adaptive_throttle_names)
+from task_runner import (
+    configure_task_runner, TASK_MAX_ATTEMPTS, DEAD_LETTER_FILE)
 
 from crawling_parts.listed_companies import crawl_listed_companies
 from crawling_parts.company_files import crawl_company_files
-from crawling_parts.download_file import download_files
+from crawling_parts.download_file import (
+    download_files, DOWNLOAD_WORKERS, DOWNLOAD_URL)
+from crawling_parts.pipeline import crawl_pipelined, PIPELINE_QUEUE_SIZE
 
 logging.config.fileConfig("log_config.conf")
 _logger = logging.getLogger("bovespa")
 
 
+def mk_throttle_limits(limits_str):
+    """
+    Process the rate limits of an adaptive throttled function with the format
+    function_name=min_rate:max_rate (ex: download_file=5:60)
+    """
+    try:
+        fn_name, rates = limits_str.split("=")
+        min_rate, max_rate = rates.split(":")
+        min_rate, max_rate = float(min_rate), float(max_rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid throttle limits {}. Expected the format "
+            "function_name=min_rate:max_rate".format(limits_str))
+    if fn_name not in adaptive_throttle_names():
+        raise argparse.ArgumentTypeError(
+            "Unknown adaptive throttled function {0}. Valid functions: "
+            "{1}".format(fn_name, ", ".join(adaptive_throttle_names())))
+    return fn_name, min_rate, max_rate
+
+
 def crawl(cache_folder=None,
           from_date=None,
           workers_num=10,
+          download_workers=DOWNLOAD_WORKERS,
+          parse_workers=None,
           phantomjs_path=None,
           force_crawl_listed_companies=False,
           force_crawl_company_files=False,
-          include_companies=None):
+          include_companies=None,
+          adaptive_throttle=False,
+          throttle_limits=None,
+          fetch_mode=FETCH_MODE_HTTP,
+          max_browser_uses=MAX_BROWSER_USES,
+          checkpoint_backend=CHECKPOINT_BACKEND_SQLITE,
+          incremental=False,
+          keep_all_versions=False,
+          extract_to_disk=False,
+          parse_cache_size=PARSE_CACHE_SIZE,
+          columnar_dataset=False,
+          long_dataset=False,
+          derived_dataset=False,
+          pipeline=False,
+          pipeline_queue_size=PIPELINE_QUEUE_SIZE,
+          autoscale=False,
+          max_attempts=TASK_MAX_ATTEMPTS,
+          dead_letter_file=DEAD_LETTER_FILE,
+          insecure_download=False):
+
+    # The store of the checkpoint files
+    set_checkpoint_backend(checkpoint_backend)
+
+    # The retries of the tasks that fail
+    configure_task_runner(max_attempts=max_attempts,
+                          dead_letter_file=dead_letter_file)
+
+    # The certificate of the download host is only skipped on demand
+    if insecure_download:
+        allow_insecure_host(urlparse(DOWNLOAD_URL).hostname)
+
+    # Adaptive rate control of the throttled functions
+    set_adaptive_mode(adaptive_throttle)
+    for fn_name, min_rate, max_rate in throttle_limits or []:
+        configure_adaptive_throttle(fn_name, min_rate, max_rate)
 
     # Force the creation of the cache folder if it does not exists
     cache_path = Path(cache_folder)
     if not cache_path.exists():
         cache_path.mkdir(parents=True, exist_ok=True)
 
+    if pipeline:
+        # All the stages at once, connected by bounded queues
+        crawl_pipelined(
+            phantomjs_path,
+            cache_folder,
+            ["ITR", "DFP"],
+            workers_num=workers_num,
+            download_workers=download_workers,
+            parse_workers=parse_workers,
+            from_date=from_date,
+            force_crawl_listed_companies=force_crawl_listed_companies,
+            force_crawl_company_files=force_crawl_company_files,
+            include_companies=include_companies,
+            fetch_mode=fetch_mode,
+            max_browser_uses=max_browser_uses,
+            incremental=incremental,
+            keep_all_versions=keep_all_versions,
+            extract_to_disk=extract_to_disk,
+            parse_cache_size=parse_cache_size,
+            columnar_dataset=columnar_dataset,
+            long_dataset=long_dataset,
+            derived_dataset=derived_dataset,
+            queue_size=pipeline_queue_size,
+            autoscale=autoscale)
+
+        if adaptive_throttle:
+            log_adaptive_rates()
+        return
+
     # Crawl the companies that are and have been registered into the
     # stock market in Brazil. These will be the companies we will crawl
     crawl_listed_companies(phantomjs_path,
                            workers_num=workers_num,
-                           force=force_crawl_listed_companies)
+                           force=force_crawl_listed_companies,
+                           fetch_mode=fetch_mode,
+                           max_browser_uses=max_browser_uses,
+                           autoscale=autoscale)
 
     # Let's crawl the files information available for each company
     # and for each period.
@@ -44,15 +146,30 @@ def crawl(cache_folder=None,
         workers_num=workers_num,
         from_date=from_date,
         force=force_crawl_company_files,
-        include_companies=include_companies)
+        include_companies=include_companies,
+        fetch_mode=fetch_mode,
+        max_browser_uses=max_browser_uses,
+        incremental=incremental,
+        autoscale=autoscale)
 
     # Let's download the files with the financial statements of the companies
     download_files(cache_folder,
                    companies_files,
                    ["ITR", "DFP"],
-                   workers_num=workers_num,
+                   download_workers=download_workers,
+                   parse_workers=parse_workers,
                    force_download=force_crawl_company_files,
-                   include_companies=include_companies)
+                   include_companies=include_companies,
+                   keep_all_versions=keep_all_versions,
+                   extract_to_disk=extract_to_disk,
+                   parse_cache_size=parse_cache_size,
+                   columnar_dataset=columnar_dataset,
+                   long_dataset=long_dataset,
+                   derived_dataset=derived_dataset,
+                   autoscale=autoscale)
+
+    if adaptive_throttle:
+        log_adaptive_rates()
 
 
 if __name__ == "__main__":
@@ -81,13 +198,81 @@ if __name__ == "__main__":
                         dest="workers_num",
                         help="The number of parallel threads crawling."
                              "(ex: 20")
+    parser.add_argument("--download-workers",
+                        action='store',
+                        default=DOWNLOAD_WORKERS,
+                        type=int,
+                        required=False,
+                        dest="download_workers",
+                        help="The number of threads downloading the files. "
+                             "They wait for the throttle and the network, so "
+                             "there can be many more than cores."
+                             "(ex: 40")
+    parser.add_argument("--parse-workers",
+                        action='store',
+                        default=None,
+                        type=int,
+                        required=False,
+                        dest="parse_workers",
+                        help="The number of processes parsing the downloaded "
+                             "files. By default the number of cores."
+                             "(ex: 8")
     parser.add_argument("--phantomjs-path",
                         action='store',
-                        required=True,
+                        required=False,
                         dest="phantomjs_path",
                         help="The path where we can found the PanthomJS "
-                             "librery installed."
+                             "librery installed. Required with the phantomjs "
+                             "fetch mode, and used as fallback in the http "
+                             "fetch mode."
                              "(ex: /phantomjs-2.1.1-macosx/bin/phantomjs)")
+    parser.add_argument("--fetch-mode",
+                        action='store',
+                        choices=FETCH_MODES,
+                        default=FETCH_MODE_HTTP,
+                        required=False,
+                        dest="fetch_mode",
+                        help="How we obtain the pages: plain HTTP requests "
+                             "or the PhantomJS browser."
+                             "(ex: --fetch-mode phantomjs")
+    parser.add_argument("--autoscale",
+                        action='store_true',
+                        required=False,
+                        dest="autoscale",
+                        help="If we want the number of workers of each stage "
+                             "to follow the rate of its throttle and the "
+                             "latency of the calls, with --workers-num and "
+                             "--download-workers as the maximum."
+                             "(ex: --autoscale")
+    parser.add_argument("--max-attempts",
+                        action='store',
+                        default=TASK_MAX_ATTEMPTS,
+                        type=int,
+                        required=False,
+                        dest="max_attempts",
+                        help="The times a task (a letter, a company or a "
+                             "file) is run before giving up on it. The tasks "
+                             "that fail are retried with an exponential "
+                             "backoff while the rest of the tasks go on."
+                             "(ex: 5")
+    parser.add_argument("--dead-letter-file",
+                        action='store',
+                        default=DEAD_LETTER_FILE,
+                        required=False,
+                        dest="dead_letter_file",
+                        help="The file where we write the tasks that failed "
+                             "all their attempts, with their traceback."
+                             "(ex: /var/log/bovespa/dead_letters.jsonl")
+    parser.add_argument("--insecure-download",
+                        action='store_true',
+                        required=False,
+                        dest="insecure_download",
+                        help="If we do not want to verify the TLS "
+                             "certificate of the host of the downloads "
+                             "(the sites of the CVM have served invalid "
+                             "certificate chains). The rest of the hosts are "
+                             "always verified."
+                             "(ex: --insecure-download")
     parser.add_argument("--force-crawl-listed-companies",
                         action='store_true',
                         required=False,
@@ -103,6 +288,84 @@ if __name__ == "__main__":
                         help="If we want to bypass the checkpoint control and "
                              "crawl the company files since the begining."
                              "(ex: --force-crawl-company-files")
+    parser.add_argument("--incremental",
+                        action='store_true',
+                        required=False,
+                        dest="incremental",
+                        help="If we want to look for the files delivered "
+                             "since the last crawl of each company and "
+                             "doc_type, instead of skipping the companies "
+                             "already crawled."
+                             "(ex: --incremental")
+    parser.add_argument("--keep-all-versions",
+                        action='store_true',
+                        required=False,
+                        dest="keep_all_versions",
+                        help="If we want to download all the versions "
+                             "delivered of each document, instead of only "
+                             "the latest one."
+                             "(ex: --keep-all-versions")
+    parser.add_argument("--extract-to-disk",
+                        action='store_true',
+                        required=False,
+                        dest="extract_to_disk",
+                        help="If we want to explode the downloaded files in "
+                             "the cache folder, instead of reading the files "
+                             "we need in memory."
+                             "(ex: --extract-to-disk")
+    parser.add_argument("--parse-cache-size",
+                        action='store',
+                        default=PARSE_CACHE_SIZE // (1024 * 1024),
+                        type=int,
+                        required=False,
+                        dest="parse_cache_size",
+                        help="The maximum size in MB of the cache of the "
+                             "parsed files. 0 to parse all the files again."
+                             "(ex: 1024")
+    parser.add_argument("--columnar-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="columnar_dataset",
+                        help="If we also want the dataset stored column-wise "
+                             "(a NumPy file per account) in "
+                             "data/dataset_columns."
+                             "(ex: --columnar-dataset")
+    parser.add_argument("--long-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="long_dataset",
+                        help="If we also want the dataset stored in long "
+                             "format (one row per value of an account) in "
+                             "data/dataset_long."
+                             "(ex: --long-dataset")
+    parser.add_argument("--derived-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="derived_dataset",
+                        help="If we also want the quarterly, trailing twelve "
+                             "months and year over year values of the "
+                             "accounts in data/dataset_quarterly, "
+                             "data/dataset_ttm and data/dataset_yoy. It "
+                             "implies --columnar-dataset."
+                             "(ex: --derived-dataset")
+    parser.add_argument("--pipeline",
+                        action='store_true',
+                        required=False,
+                        dest="pipeline",
+                        help="If we want to crawl the listed companies, the "
+                             "company files and download the files at the "
+                             "same time, instead of one stage after the "
+                             "other."
+                             "(ex: --pipeline")
+    parser.add_argument("--pipeline-queue-size",
+                        action='store',
+                        default=PIPELINE_QUEUE_SIZE,
+                        type=int,
+                        required=False,
+                        dest="pipeline_queue_size",
+                        help="The maximum number of companies or files "
+                             "waiting between two stages of the pipeline."
+                             "(ex: 200")
     parser.add_argument("--include-companies",
                         action='store',
                         nargs='*',
@@ -112,8 +375,52 @@ if __name__ == "__main__":
                              "companies."
                              "(ex: 35 94 1384")
 
+    parser.add_argument("--max-browser-uses",
+                        action='store',
+                        default=MAX_BROWSER_USES,
+                        type=int,
+                        required=False,
+                        dest="max_browser_uses",
+                        help="The number of tasks a PhantomJS browser serves "
+                             "before being recycled."
+                             "(ex: 100")
+    parser.add_argument("--checkpoint-backend",
+                        action='store',
+                        choices=CHECKPOINT_BACKENDS,
+                        default=CHECKPOINT_BACKEND_SQLITE,
+                        required=False,
+                        dest="checkpoint_backend",
+                        help="How we store the checkpoint files: a SQLite "
+                             "database or the pickle control files."
+                             "(ex: --checkpoint-backend pickle")
+    parser.add_argument("--adaptive-throttle",
+                        action='store_true',
+                        required=False,
+                        dest="adaptive_throttle",
+                        help="If we want to adapt the rate of calls to the "
+                             "sources to their latency and errors, instead "
+                             "of using fixed rates."
+                             "(ex: --adaptive-throttle")
+    parser.add_argument("--throttle-limits",
+                        action='store',
+                        nargs='*',
+                        type=mk_throttle_limits,
+                        required=False,
+                        dest="throttle_limits",
+                        help="The minimum and maximum rate (calls per "
+                             "minute) of the adaptive throttled functions."
+                             "(ex: download_file=5:60 "
+                             "obtain_company_files=10:120")
+
     args, unknown = parser.parse_known_args()
 
+    if args.fetch_mode == FETCH_MODE_PHANTOMJS and not args.phantomjs_path:
+        parser.error("--phantomjs-path is required with the phantomjs "
+                     "fetch mode")
+
+    # The size of the parse cache is given in MB
+    args.parse_cache_size *= 1024 * 1024
+
     try:
         crawl(**vars(args))
     except Exception as ex:
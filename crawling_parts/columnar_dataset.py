@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*
+import os
+import json
+import logging
+
+import numpy as np
+
+from utils import version_number, temporary_folder, replace_folder
+
+COLUMNAR_DATASET_FOLDER = "data/dataset_columns"
+
+SCHEMA_FILE = "schema.json"
+
+# The columns that identify the rows, sorted by all of them
+KEY_COLUMNS = [("ccvm", "int64"), ("period", "datetime64[D]"),
+               ("version", "U16")]
+
+_logger = logging.getLogger("bovespa")
+
+
+def write_columnar_dataset(folder, headers, rows):
+    """
+    Store the dataset column-wise in a folder: a .npy file per column, typed
+    (the keys as int64, datetime64 and unicode, and the accounts as float64
+    with NaN where the filing has no value), and a schema.json file with
+    the index of the file of each account and its description. The rows are
+    sorted by ccvm, period and version.
+
+    :param folder: the folder of the dataset. It is replaced at the end
+    :param headers: the description of the columns by name, like in the
+                    dictionary of the dataset
+    :param rows: a function that returns an iterator over the rows (dicts
+                 with the columns), called twice
+    """
+    key_names = [name for name, dtype in KEY_COLUMNS]
+    accounts = [name for name in headers if name not in key_names]
+    account_index = {name: index for index, name in enumerate(accounts)}
+
+    # The position of each row, sorted by the key columns
+    keys = [(int(row["ccvm"]), row["period"], str(row["version"]))
+            for row in rows()]
+    order = sorted(range(len(keys)), key=lambda row: (
+        keys[row][0], keys[row][1], version_number(keys[row][2])))
+    position = np.empty(len(keys), dtype="int64")
+    position[order] = np.arange(len(keys))
+
+    # Column-major, so each column is contiguous when we save it
+    values = np.full((len(keys), len(accounts)), np.nan,
+                     dtype="float64", order="F")
+    for row_num, row in enumerate(rows()):
+        row_values = values[position[row_num]]
+        for name, value in row.items():
+            index = account_index.get(name)
+            if index is not None and value is not None and value != "":
+                row_values[index] = value
+
+    key_columns = {
+        name: np.array([keys[row][key_num] for row in order], dtype=dtype)
+        for key_num, (name, dtype) in enumerate(KEY_COLUMNS)}
+
+    save_columnar_dataset(
+        folder, key_columns,
+        ((name, values[:, index]) for index, name in enumerate(accounts)),
+        headers)
+
+
+def save_columnar_dataset(folder, key_columns, columns, headers):
+    """
+    Store the columns of a dataset in the format of write_columnar_dataset
+
+    :param folder: the folder of the dataset. It is replaced at the end
+    :param key_columns: the arrays of the KEY_COLUMNS by name, sorted
+    :param columns: an iterable of the name and the array of each account,
+                    so the columns can be generated one by one
+    :param headers: the description of the columns by name
+    """
+    writer = ColumnarDatasetWriter(folder, key_columns, headers)
+    for name, column in columns:
+        writer.add(name, column)
+    writer.close()
+
+
+class ColumnarDatasetWriter(object):
+    """
+    Stores a dataset in the format of write_columnar_dataset adding its
+    columns one by one, so several datasets can be written at the same
+    time (ex: the derived measures, see derive_dataset). The folder is
+    replaced when the writer is closed.
+
+        writer = ColumnarDatasetWriter(folder, key_columns, headers)
+        writer.add("3.01", values)
+        writer.close()
+    """
+
+    def __init__(self, folder, key_columns, headers):
+        """
+        :param key_columns: the arrays of the KEY_COLUMNS by name, sorted
+        :param headers: the description of the columns by name
+        """
+        self.folder = folder
+        self.headers = headers
+        self.tmp_folder = temporary_folder(folder)
+
+        rows = len(key_columns[KEY_COLUMNS[0][0]])
+        self.schema = {"rows": rows, "keys": [], "columns": []}
+        for name, dtype in KEY_COLUMNS:
+            filename = "{}.npy".format(name)
+            np.save(str(self.tmp_folder / filename),
+                    np.asarray(key_columns[name], dtype=dtype))
+            self.schema["keys"].append(
+                {"name": name, "dtype": dtype, "file": filename,
+                 "description": headers.get(name, "")})
+
+    def add(self, name, column):
+        index = len(self.schema["columns"])
+        filename = "account_{:05d}.npy".format(index)
+        np.save(str(self.tmp_folder / filename),
+                np.asarray(column, dtype="float64"))
+        self.schema["columns"].append(
+            {"index": index, "name": name, "dtype": "float64",
+             "file": filename, "description": self.headers.get(name, "")})
+
+    def close(self):
+        with open(str(self.tmp_folder / SCHEMA_FILE), "w") as f:
+            json.dump(self.schema, f, indent=1, ensure_ascii=False)
+
+        # Replace the previous dataset
+        replace_folder(self.tmp_folder, self.folder)
+
+        _logger.info("Columnar dataset {0} generated with {1} rows and {2} "
+                     "accounts".format(self.folder, self.schema["rows"],
+                                       len(self.schema["columns"])))
+
+
+class ColumnarDataset(object):
+    """
+    Reads the dataset stored by write_columnar_dataset. Only the files of
+    the columns we read are loaded (memory mapped), so reading a few
+    accounts of a few companies never touches the rest of the dataset.
+
+        dataset = ColumnarDataset("data/dataset_columns")
+        data = dataset.read(["1.01", "3.11"], from_period="2018-01-01",
+                            to_period="2018-12-31")
+        data["ccvm"], data["period"], data["1.01"]
+    """
+
+    def __init__(self, folder=COLUMNAR_DATASET_FOLDER):
+        self.folder = folder
+        with open(os.path.join(folder, SCHEMA_FILE)) as f:
+            self.schema = json.load(f)
+
+        self.keys = [key["name"] for key in self.schema["keys"]]
+        self._files = {column["name"]: column["file"] for column in
+                       self.schema["keys"] + self.schema["columns"]}
+
+    @property
+    def accounts(self):
+        return [column["name"] for column in self.schema["columns"]]
+
+    def __len__(self):
+        return self.schema["rows"]
+
+    def column(self, name):
+        """
+        :return: the whole column, memory mapped
+        """
+        try:
+            filename = self._files[name]
+        except KeyError:
+            raise KeyError("There is no column {0} in the dataset {1}".
+                           format(name, self.folder))
+        return np.load(os.path.join(self.folder, filename), mmap_mode="r")
+
+    def rows(self, ccvms=None, from_period=None, to_period=None):
+        """
+        :return: the positions of the rows of the companies and periods
+        """
+        ccvm = self.column("ccvm")
+        if ccvms is not None:
+            # The rows are sorted by ccvm
+            ccvms = np.unique(np.asarray(ccvms, dtype="int64"))
+            selected = np.concatenate(
+                [np.arange(start, end) for start, end in
+                 zip(np.searchsorted(ccvm, ccvms, side="left"),
+                     np.searchsorted(ccvm, ccvms, side="right"))] or
+                [np.empty(0, dtype="int64")])
+        else:
+            selected = np.arange(len(ccvm))
+
+        if from_period is not None or to_period is not None:
+            period = self.column("period")[selected]
+            mask = np.ones(len(selected), dtype=bool)
+            if from_period is not None:
+                mask &= period >= np.datetime64(from_period, "D")
+            if to_period is not None:
+                mask &= period <= np.datetime64(to_period, "D")
+            selected = selected[mask]
+
+        return selected
+
+    def read(self, columns=None, ccvms=None, from_period=None,
+             to_period=None):
+        """
+        Read some columns of the rows of some companies and periods
+
+        :param columns: the accounts to read (ex: ["1.01", "3.11"]). All the
+                        accounts by default
+        :param ccvms: the companies to read. All by default
+        :param from_period: the first period to read (ex: "2018-01-01")
+        :param to_period: the last period to read (ex: "2018-12-31")
+        :return: a dict with the key columns and the accounts, by name
+        """
+        selected = self.rows(
+            ccvms=ccvms, from_period=from_period, to_period=to_period)
+
+        names = self.keys + [name for name in (columns or self.accounts)
+                             if name not in self.keys]
+        return {name: np.asarray(self.column(name)[selected])
+                for name in names}
@@ -2,44 +2,65 @@
 import csv
 import re
 import itertools
-import shutil
 import logging
-from pathlib import Path
-from multiprocessing.pool import Pool
-from multiprocessing import Manager
+from collections import namedtuple
+from multiprocessing.pool import Pool, ThreadPool
 
 from urllib.parse import urlencode
 from dateutil.parser import parse as date_parse
 
-from bs4 import BeautifulSoup
+import lxml.html
+import requests
 
-from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 
-from utils import get_control_file, put_control_file
-from throttle import Throttle
+from checkpoint import Checkpoint
+from throttle import AdaptiveThrottle
+from circuit_breaker import CircuitBreaker
+from autoscaling_pool import AutoscalingPool
+from task_runner import TaskRunner
+from browser_pool import (
+    browser, init_browser_pool, release_browser_pool, report_browser_launches,
+    MAX_BROWSER_USES)
+from http_session import (
+    HttpNavigator, NoSuchLinkError, UnexpectedPageError, FETCH_MODE_HTTP)
 
 RE_DOWNLOAD_FILE = r"javascript:fVisualizaArquivo_ENET\('([\d]+)','DOWNLOAD'\)"
 
-RE_FISCAL_DATE = r'Data Encerramento.*[\s].*(\d{2}/\d{2}/\d{4})'
-RE_DELIVERY_DATE = r'Data Entrega.*[\s].*(\d{2}/\d{2}/\d{4}) \d{2}:\d{2}'
-RE_VERSION = r'Versão.*[\s].*(\d+.\d+)'
-RE_DELIVERY_TYPE = r'Tipo Apresentação.*[\s].*<td.*>([\w\s]*)</td>'
-RE_COMPANY_NAME = r'Razão Social.*:(.*)<br/>'
-RE_CNPJ = r'CNPJ.*:(.*)\s'
 RE_TOTAL_FILES = r'(\d*) documento\(s\) encontrado\(s\)'
 RE_LAST_FILE_IN_PAGE = r'Exibindo (\d*) a (\d*)'
 
+# The texts of the listing page that identify the tables of the files
+XPATH_FILE_TYPE_TEXTS = "//text()[contains(., $file_type)]"
+
 COMPANY_DOCUMENTS_URL = "http://siteempresas.bovespa.com.br/consbov/" \
                         "ExibeTodosDocumentosCVM.asp?{}"
 
+NEXT_PAGE_LINK = "Próximos >>"
+
+# Elements that tell us the documents pages are loaded
+XPATH_DOCUMENTS_FORM = "//form[@name='AIR']"
+XPATH_DOCUMENTS_TABLE = "//form[@name='AIR']/table/*"
+ERROR_PAGE_TITLE = "CBLCNET -"
+
 FILES_BY_COMPANY_CTL = "ctl/files_per_company.ctl"
 
-manager = Manager()
-lock = manager.Lock()
+files_checkpoint = Checkpoint(FILES_BY_COMPANY_CTL)
+
+# Number of documents by listing page in the incremental mode, where we only
+# expect the few documents delivered since the last crawl
+INCREMENTAL_QT_LINKS = 20
+
+# Position of the delivery date in the tuples of the files
+DELIVERY_DATE_FIELD = 5
+
+CompanyFilesPage = namedtuple(
+    "CompanyFilesPage",
+    ["company_name", "cnpj", "num_of_docs", "last_file_in_page", "files",
+     "complete"])
 
 _logger = logging.getLogger("bovespa")
 
@@ -50,214 +71,564 @@ def update_companies_files_checkpoint(ccvm_code, doc_type, files=None):
                   format(ccvm=ccvm_code,
                          doc_type=doc_type,
                          files=files))
-    with lock:
-        if files is not None:
-            _logger.debug("Adding files from [{ccvm} - {doc_type}] to cache: "
-                          "{files}".
-                          format(ccvm=ccvm_code,
-                                 doc_type=doc_type,
-                                 files=files))
-            current_companies = get_control_file(FILES_BY_COMPANY_CTL, {})
-            key = "{0}_{1}".format(ccvm_code, doc_type)
-            current_companies[key] = files
-            put_control_file(FILES_BY_COMPANY_CTL, current_companies)
-        else:
-            _logger.debug("Files NOT ADDED from [{ccvm} - {doc_type}]"
-                          " to cache: {files}".
-                          format(ccvm=ccvm_code,
-                                 doc_type=doc_type,
-                                 files=files))
+    if files is not None:
+        _logger.debug("Adding files from [{ccvm} - {doc_type}] to cache: "
+                      "{files}".
+                      format(ccvm=ccvm_code,
+                             doc_type=doc_type,
+                             files=files))
+        key = "{0}_{1}".format(ccvm_code, doc_type)
+        files_checkpoint.put(key, files)
+    else:
+        _logger.debug("Files NOT ADDED from [{ccvm} - {doc_type}]"
+                      " to cache: {files}".
+                      format(ccvm=ccvm_code,
+                             doc_type=doc_type,
+                             files=files))
 
 
 def has_ccvm(ccvm_code, doc_type):
-    with lock:
-        current_companies = get_control_file(FILES_BY_COMPANY_CTL, {})
-        key = "{0}_{1}".format(ccvm_code, doc_type)
-        return key in current_companies.keys()
+    key = "{0}_{1}".format(ccvm_code, doc_type)
+    return key in files_checkpoint
 
 
-def extract_company_files_from_page(
-        ccvm, driver, bs, doc_type="ITR", from_date=None):
+def company_files_watermark(files):
+    """
+    The newest delivery date of the files we already have for a company and
+    doc_type. In the incremental mode we only look for the files delivered
+    since then.
+
+    :return: the delivery date, or None if there are no files
+    """
+    return max((file[DELIVERY_DATE_FIELD] for file in files or []),
+               default=None)
+
+
+def merge_company_files(new_files, files):
+    """
+    Add the files found in the incremental mode to the files of the
+    checkpoint. The new files come first, like in the listing pages, and
+    replace the ones with the same protocol.
+    """
+    protocols = {file[1] for file in new_files}
+    return list(new_files) + [file for file in files or []
+                              if file[1] not in protocols]
+
+
+# The values of the pages, read from their text nodes
+RE_DATE = r"(\d{2}/\d{2}/\d{4})"
+RE_VERSION_NUMBER = r"(\d+.\d+)"
+
+
+def _texts(element):
+    """
+    :return: the text nodes of the element with content, in document order
+    """
+    return [str(text) for text in element.xpath(".//text()")
+            if text.strip()]
+
+
+def _field(texts, label, pattern=None):
+    """
+    Find the value of a field of the page: the text after its label, in
+    the same text node or in the next ones (ex: the next cell)
+
+    :param texts: the text nodes (see _texts)
+    :param pattern: a regular expression the value must match. Its first
+                    group is the value
+    :return: the value, or None if the label or the value are not present
     """
-    Extract all the files to download from the listing HTML page
+    for index, text in enumerate(texts):
+        if label not in text:
+            continue
+
+        values = [text.split(label, 1)[1]] + texts[index + 1:]
+        for value in values:
+            value = value.lstrip(": ").strip()
+            if not value:
+                continue
+            if pattern is None:
+                return value
+            match = re.search(pattern, value)
+            if match:
+                return match[1]
+        return None
+
+    return None
+
+
+def _search(texts, pattern):
+    """
+    :return: the match of the first text node matching the pattern or None
+    """
+    for text in texts:
+        match = re.search(pattern, text)
+        if match:
+            return match
+    return None
+
+
+def parse_company_files_page(page, doc_type="ITR", from_date=None,
+                             watermark=None):
+    """
+    Extract the company information and the files of a listing page. The
+    values are read from the text nodes of the parsed page, without
+    serializing it, and the tables are found in one pass over the texts of
+    the page.
 
-    :param driver: the panthomjs driver with the current page loaded. We use
-                    the driver to navigate through the listing if needed
-    :param bs: a BeautifulSoup object with the content of the listing page
+    :param page: the lxml document of the listing page
     :param doc_type: the type of the files we are downloading
     :param from_date: if we are interested only in files presented after a
                     given date (newer files only)
+    :param watermark: the newest delivery date of the files we already have.
+                    The files delivered that same day are listed again
+                    because the dates of the listing have no seconds
+    :return: a CompanyFilesPage. The values not present in the page are None,
+             and complete is True when the listing reached the files older
+             than the from_date or the watermark
+    """
+    page_texts = _texts(page)
+
+    # Extract the company name and the CNPJ from the content
+    company_name = _field(page_texts, "Razão Social")
+    company_cnpj = _field(page_texts, "CNPJ")
+    if company_cnpj is not None:
+        company_cnpj = company_cnpj.lower()
+
+    # Get the number of files we should expect to find for the company
+    match = _search(page_texts, RE_TOTAL_FILES)
+    num_of_docs = int(match[1]) if match and match[1] else None
+
+    # Get the number of files we can really get from the current page
+    match = _search(page_texts, RE_LAST_FILE_IN_PAGE)
+    last_file_in_page = int(match[2]) if match else None
+
+    # Obtain the table elements that contains information about files with
+    # financial statements of the company
+    all_tables = []
+    for text in page.xpath(XPATH_FILE_TYPE_TEXTS,
+                           file_type="{} - ENET".format(doc_type)):
+        # The element that contains the text
+        element = text.getparent()
+        if text.is_tail:
+            element = element.getparent()
+
+        table = element if element.tag == "table" else \
+            next(element.iterancestors("table"), None)
+        if table is not None:
+            all_tables.append(table)
+
+    # For each table we extract the files information of all the files
+    # that belongs to a fiscal period after the from_date argument.
+    files = []
+    complete = False
+    for table in all_tables:
+        link_tag = next((tag for tag in table.iter("a")
+                         if re.search(RE_DOWNLOAD_FILE, tag.get("href", ""))),
+                        None)
+        if link_tag is None:
+            _logger.debug("The file is not available in ITR format")
+            continue
+
+        table_texts = _texts(table)
+
+        fiscal_date = _field(table_texts, "Data Encerramento", RE_DATE)
+        fiscal_date = date_parse(fiscal_date)
+
+        delivery_date = _field(table_texts, "Data Entrega", RE_DATE)
+        delivery_date = date_parse(delivery_date)
+
+        # We only continue processing files from the HTML page
+        # if are newer (deliver after) than the from_date argument.
+        # We look for newer delivery files
+        if from_date is not None and delivery_date <= from_date:
+            complete = True
+            break
+        if watermark is not None and delivery_date < watermark:
+            complete = True
+            break
+
+        version = _field(table_texts, "Versão", RE_VERSION_NUMBER)
+
+        delivery_type = _field(table_texts, "Tipo Apresentação")
+
+        protocol = re.match(RE_DOWNLOAD_FILE, link_tag.get("href"))[1]
+
+        if not from_date or fiscal_date >= from_date:
+            files.append((fiscal_date, protocol, version,
+                          doc_type, delivery_type, delivery_date))
+
+    return CompanyFilesPage(company_name, company_cnpj, num_of_docs,
+                            last_file_in_page, files, complete)
+
+
+def extract_company_files_from_page(
+        ccvm, next_page, page, doc_type="ITR", from_date=None,
+        watermark=None):
+    """
+    Extract all the files to download from the listing HTML page. The
+    listing is sorted by delivery date, so we stop navigating once we reach
+    the files older than the from_date or the watermark
+
+    :param next_page: a function that navigates to the next page of the
+                    listing and returns its lxml document. We use it
+                    to navigate through the listing if needed
+    :param page: the lxml document of the listing page
+    :param doc_type: the type of the files we are downloading
+    :param from_date: if we are interested only in files presented after a
+                    given date (newer files only)
+    :param watermark: the newest delivery date of the files we already have
     :return: a list of tuples with two components: the fiscal_period (date)
                 and the protocol code for each file in the list
     """
     files = []
 
-    # Extract the company name from the content
-    company_name = re.search(RE_COMPANY_NAME, str(bs))[1].strip()
-
-    # Extract the CNPJ from the content
-    company_cnpj = re.search(RE_CNPJ, str(bs))[1].strip().lower()
+    company_page = parse_company_files_page(
+        page, doc_type=doc_type, from_date=from_date, watermark=watermark)
+    if company_page.company_name is None or company_page.cnpj is None:
+        raise UnexpectedPageError(
+            "There is no company information in the companies files page "
+            "for [{ccvm} - {doc_type}]".format(ccvm=ccvm, doc_type=doc_type))
 
     # Get the number of files we should expect to find for the company
-    try:
-        num_of_docs = int(re.search(RE_TOTAL_FILES, str(bs))[1])
-    except:
+    num_of_docs = company_page.num_of_docs
+    if num_of_docs is None:
         _logger.warning("There is no files information in the companies "
                         "files page for [{ccvm} - {doc_type}] ".
                         format(ccvm=ccvm, doc_type=doc_type))
         return files
 
+    last_file_in_page = 0
     while True:
+        if company_page.last_file_in_page is None:
+            raise UnexpectedPageError(
+                "There is no pagination information in the companies files "
+                "page for [{ccvm} - {doc_type}]".format(
+                    ccvm=ccvm, doc_type=doc_type))
+
+        # A page that does not advance would be listed again forever
+        if company_page.last_file_in_page <= last_file_in_page:
+            raise UnexpectedPageError(
+                "The companies files listing for [{ccvm} - {doc_type}] did "
+                "not advance after the file {last}".format(
+                    ccvm=ccvm, doc_type=doc_type, last=last_file_in_page))
+        last_file_in_page = company_page.last_file_in_page
+
+        files.extend(company_page.files)
+
+        if company_page.complete or last_file_in_page >= num_of_docs:
+            break
+        else:
+            # Navigate to the next page
+            company_page = parse_company_files_page(
+                next_page(), doc_type=doc_type, from_date=from_date,
+                watermark=watermark)
 
-        # Get the number of files we can really get from the current page
-        last_file_in_page = int(
-            re.search(RE_LAST_FILE_IN_PAGE, str(bs))[2])
+    return files
 
-        # Obtain the table elements that contains information about files with
-        # financial statements of the company
-        all_tables = [tag.findParent("table") for tag in
-                      bs.find_all(
-                          text=re.compile("{} - ENET".format(doc_type)))
-                      if tag.findParent("table")]
 
-        # For each table we extract the files information of all the files
-        # that belongs to a fiscal period after the from_date argument.
-        for table in all_tables:
-            link_tag = table.find('a', href=re.compile(RE_DOWNLOAD_FILE))
-            if link_tag:
-                fiscal_date = re.search(RE_FISCAL_DATE,str(table))[1]
-                fiscal_date = date_parse(fiscal_date)
+def browser_next_page(driver):
+    def next_page():
+        element = driver.find_element_by_link_text(NEXT_PAGE_LINK)
+        element.click()
 
-                delivery_date = re.search(RE_DELIVERY_DATE, str(table))[1]
-                delivery_date = date_parse(delivery_date)
+        # Wait until the page is loaded
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located(
+                (By.XPATH, XPATH_DOCUMENTS_TABLE)))
 
-                # We only continue processing files from the HTML page
-                # if are newer (deliver after) than the from_date argument.
-                # We look for newer delivery files
-                if from_date is not None and delivery_date <= from_date:
-                    break
+        return lxml.html.fromstring(driver.page_source)
 
-                version = re.search(RE_VERSION, str(table))[1]
+    return next_page
 
-                delivery_type = re.search(RE_DELIVERY_TYPE, str(table))[1]
 
-                protocol = re.match(
-                    RE_DOWNLOAD_FILE, link_tag.attrs['href'])[1]
+def http_next_page(navigator):
+    def next_page():
+        navigator.click_link(NEXT_PAGE_LINK)
 
-                if not from_date or fiscal_date >= from_date:
-                    files.append((fiscal_date, protocol, version,
-                                  doc_type, delivery_type, delivery_date))
-            else:
-                _logger.debug("The file is not available in ITR format")
+        if navigator.find(XPATH_DOCUMENTS_TABLE) is None:
+            raise UnexpectedPageError(
+                "No documents in the next page {}".format(navigator.url))
 
-        if last_file_in_page == num_of_docs:
-            break
-        else:
-            # Navigate to the next page
-            element = driver.find_element_by_link_text("Próximos >>")
-            element.click()
+        return navigator.document
 
-            # Wait until the page is loaded
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located(
-                    (By.XPATH, "//form[@name='AIR']/table/*")))
+    return next_page
 
-            bs = BeautifulSoup(driver.page_source, "html.parser")
 
-    return files
+def company_documents_url(ccvm, qt_links=1000):
+    encoded_args = urlencode(
+        {'CCVM': ccvm, 'TipoDoc': 'C', 'QtLinks': str(qt_links)})
+    return COMPANY_DOCUMENTS_URL.format(encoded_args)
 
 
-@Throttle(minutes=1, rate=50, max_tokens=50)
-def obtain_company_files(
-        phantomjs_path, ccvm, doc_type, from_date=None):
+def fetch_company_files(ccvm, doc_types, from_date=None, watermarks=None):
     """
-    This function is responsible for get the relation of files to be
-    processed for the company and start its download
-
-    This function is being throttle allowing 20 downloads per minute
+    Obtain the files of the company using plain HTTP requests (no browser).
+    We reproduce the navigation of the browser: load the documents page of
+    the company once, and for each doc_type follow its link from that page
+    and follow the "Próximos >>" links while there are more pages.
+
+    :param watermarks: the newest delivery date of the files we already have
+                    by doc_type, to list only the new files (incremental mode)
+    :return: a dict with the list of files per doc_type. An empty list if
+             the company has no doc_type documents, or None if there is no
+             documents page for the doc_type
     """
-    files = []
-    driver = None
+    navigator = HttpNavigator()
 
-    _logger.debug("Starting to crawl company [{ccvm} - {doc_type}] ".
-                  format(ccvm=ccvm,
-                         doc_type=doc_type,
-                         num_files=len(files)))
+    navigator.get(company_documents_url(ccvm, _qt_links(watermarks)))
+    if navigator.find(XPATH_DOCUMENTS_FORM) is None:
+        if ERROR_PAGE_TITLE not in navigator.title():
+            raise UnexpectedPageError(
+                "Unexpected documents page for company {}".format(ccvm))
+        return {doc_type: None for doc_type in doc_types}
 
-    try:
-        driver = webdriver.PhantomJS(
-            executable_path=phantomjs_path)
-
-        encoded_args = urlencode(
-            {'CCVM': ccvm, 'TipoDoc': 'C', 'QtLinks': "1000"})
-        url = COMPANY_DOCUMENTS_URL.format(encoded_args)
+    company_page = navigator.state()
 
-        # Let's navigate to the url and wait until the reload is being done
-        # We control that the page is loaded looking for an element with
-        # id = "AIR" in the page
-        driver.get(url)
+    files_by_doc_type = {}
+    for doc_type in doc_types:
+        navigator.restore(company_page)
         try:
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.NAME, 'AIR')))
-        except TimeoutException:
-            WebDriverWait(driver, 10).until(
-                EC.title_contains("CBLCNET -"))
-            _logger.warning(
-                "There is no documents page for company {ccvm} "
-                "and {doc_type}. Showing 'Error de Aplicacao'".
-                    format(ccvm=ccvm, doc_type=doc_type))
-            return files
+            navigator.click_link(doc_type)
+        except NoSuchLinkError:
+            _logger.debug("The company {ccvm} do not have {doc_type} "
+                          "documents".format(ccvm=ccvm, doc_type=doc_type))
+            files_by_doc_type[doc_type] = []
+            continue
+
+        if navigator.find(XPATH_DOCUMENTS_TABLE) is None:
+            if ERROR_PAGE_TITLE not in navigator.title():
+                raise UnexpectedPageError(
+                    "Unexpected {0} documents page for company {1}".format(
+                        doc_type, ccvm))
+            files_by_doc_type[doc_type] = None
+            continue
+
+        files_by_doc_type[doc_type] = extract_company_files_from_page(
+            ccvm, http_next_page(navigator), navigator.document,
+            doc_type=doc_type, from_date=from_date,
+            watermark=(watermarks or {}).get(doc_type))
+
+    return files_by_doc_type
+
+
+@CircuitBreaker("company_files",
+                failures=[TimeoutException, UnexpectedPageError])
+@AdaptiveThrottle(minutes=1, rate=50, max_tokens=50,
+                  min_rate=10, max_rate=120,
+                  failures=[TimeoutException])
+def obtain_company_files(
+        phantomjs_path, ccvm, doc_types, from_date=None,
+        fetch_mode=FETCH_MODE_HTTP, watermarks=None):
+    """
+    This function is responsible for get the relation of files to be
+    processed for the company and start its download. The documents page of
+    the company is loaded once for all the doc_types.
 
-        # Once the page is ready, we can select the doc_type from the list
-        # of documentation available and navigate to the results page
-        # Select ITR files and Click
-        element = driver.find_element_by_link_text(doc_type)
-        element.click()
+    This function is being throttle allowing 50 calls per minute
 
-        # Wait until the page is loaded
+    :param watermarks: the newest delivery date of the files already in the
+                    checkpoint by doc_type (incremental mode). The new files
+                    of these doc_types are merged into the checkpoint
+    :return: a dict with the list of files per doc_type
+    """
+    watermarks = watermarks or {}
+    files_by_doc_type = None
+
+    if fetch_mode == FETCH_MODE_HTTP:
         try:
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located(
-                    (By.XPATH, "//form[@name='AIR']/table/*")))
-        except TimeoutException:
-            WebDriverWait(driver, 10).until(
-                EC.title_contains("CBLCNET -"))
+            files_by_doc_type = fetch_company_files(
+                ccvm, doc_types, from_date=from_date, watermarks=watermarks)
+        except (requests.RequestException, UnexpectedPageError):
+            # Without the browser fallback the error reaches the throttle
+            if not phantomjs_path:
+                raise
+            _logger.exception("Unable to fetch the documents for company "
+                              "{ccvm}. Using phantomjs".format(ccvm=ccvm))
+
+    if files_by_doc_type is None:
+        files_by_doc_type = browse_company_files(
+            phantomjs_path, ccvm, doc_types, from_date=from_date,
+            watermarks=watermarks)
+
+    for doc_type, files in files_by_doc_type.items():
+        if files is None:
             _logger.warning(
                 "There is no documents page for company {ccvm} "
                 "and {doc_type}. Showing 'Error de Aplicacao'".
-                    format(ccvm=ccvm, doc_type=doc_type))
-            return files
+                format(ccvm=ccvm, doc_type=doc_type))
+            files_by_doc_type[doc_type] = []
+        elif doc_type in watermarks:
+            _logger.debug("Found {num_files} new files for company "
+                          "[{ccvm} - {doc_type}]".format(
+                              num_files=len(files), ccvm=ccvm,
+                              doc_type=doc_type))
+            files_checkpoint.update(
+                "{0}_{1}".format(ccvm, doc_type),
+                lambda old_files: merge_company_files(files, old_files))
+        else:
+            # Set checkpoint to the current ccvm code and doc_type as a
+            # company already processed
+            update_companies_files_checkpoint(ccvm, doc_type, list(files))
 
-        bs = BeautifulSoup(driver.page_source, "html.parser")
-        files = extract_company_files_from_page(
-            ccvm, driver, bs, doc_type=doc_type, from_date=from_date)
+    return files_by_doc_type
 
-        # Set checkpoint to the current ccvm code as a
-        # company already processed
-        update_companies_files_checkpoint(ccvm, doc_type, list(files))
 
-        return files
-    except NoSuchElementException as ex:
-        _logger.debug("The company {ccvm} do not have {doc_type} documents".
-              format(ccvm=ccvm, doc_type=doc_type))
-        update_companies_files_checkpoint(ccvm, doc_type, [])
-        return []
+def _qt_links(watermarks):
+    # We only expect a few new files when all the doc_types have a watermark
+    if watermarks and all(watermarks.values()):
+        return INCREMENTAL_QT_LINKS
+    return 1000
+
+
+def browse_company_files(phantomjs_path, ccvm, doc_types, from_date=None,
+                         watermarks=None):
+    """
+    Obtain the files of the company navigating with the PhantomJS browser.
+    The documents page of the company is loaded once, and we navigate
+    directly to the doc_type links when they are not javascript calls.
+
+    :return: a dict with the list of files per doc_type. An empty list if
+             the company has no doc_type documents, or None if there is no
+             documents page for the doc_type
+    """
+    files_by_doc_type = {}
+
+    _logger.debug("Starting to crawl company [{ccvm} - {doc_types}] ".
+                  format(ccvm=ccvm, doc_types=doc_types))
+
+    try:
+        with browser(phantomjs_path) as driver:
+            url = company_documents_url(ccvm, _qt_links(watermarks))
+
+            # Let's navigate to the url and wait until the reload is being done
+            # We control that the page is loaded looking for an element with
+            # id = "AIR" in the page
+            driver.get(url)
+            try:
+                WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.NAME, 'AIR')))
+            except TimeoutException:
+                WebDriverWait(driver, 10).until(
+                    EC.title_contains(ERROR_PAGE_TITLE))
+                return {doc_type: None for doc_type in doc_types}
+
+            # The links to the documents of each doc_type
+            links = {}
+            for doc_type in doc_types:
+                try:
+                    links[doc_type] = driver.find_element_by_link_text(
+                        doc_type).get_attribute("href") or ""
+                except NoSuchElementException:
+                    _logger.debug("The company {ccvm} do not have {doc_type} "
+                                  "documents".format(ccvm=ccvm,
+                                                     doc_type=doc_type))
+                    files_by_doc_type[doc_type] = []
+
+            in_company_page = True
+            for doc_type, link in links.items():
+                # Once the page is ready, we can select the doc_type from the
+                # list of documentation available and navigate to the
+                # results page
+                if not link.lower().startswith("javascript:"):
+                    driver.get(link)
+                else:
+                    if not in_company_page:
+                        driver.get(url)
+                        WebDriverWait(driver, 10).until(
+                            EC.presence_of_element_located((By.NAME, 'AIR')))
+                    element = driver.find_element_by_link_text(doc_type)
+                    element.click()
+                in_company_page = False
+
+                # Wait until the page is loaded
+                try:
+                    WebDriverWait(driver, 10).until(
+                        EC.presence_of_element_located(
+                            (By.XPATH, XPATH_DOCUMENTS_TABLE)))
+                except TimeoutException:
+                    WebDriverWait(driver, 10).until(
+                        EC.title_contains(ERROR_PAGE_TITLE))
+                    files_by_doc_type[doc_type] = None
+                    continue
+
+                page = lxml.html.fromstring(driver.page_source)
+                files_by_doc_type[doc_type] = extract_company_files_from_page(
+                    ccvm, browser_next_page(driver), page,
+                    doc_type=doc_type, from_date=from_date,
+                    watermark=(watermarks or {}).get(doc_type))
+
+            return files_by_doc_type
     except Exception as ex:
         _logger.exception("Unable to cral the documents for company {ccvm} "
-                          "and {doc_type}".
-              format(ccvm=ccvm, doc_type=doc_type))
+                          "and {doc_types}".
+              format(ccvm=ccvm, doc_types=doc_types))
         raise ex
     finally:
-        _logger.debug("Finishing to crawl company [{ccvm} - {doc_type}] "
+        _logger.debug("Finishing to crawl company [{ccvm} - {doc_types}] "
                       "files: [{num_files}]".
                       format(ccvm=ccvm,
-                             doc_type=doc_type,
-                             num_files=len(files)))
-        if driver:
-            _logger.debug("Closing the phantomjs driver for company "
-                          "[{ccvm} - {doc_type}]".
-                          format(ccvm=ccvm, doc_type=doc_type))
-            driver.quit()
+                             doc_types=doc_types,
+                             num_files=sum(
+                                 len(files or []) for files in
+                                 files_by_doc_type.values())))
+
+
+def plan_company_files(ccvm, doc_types, incremental=False):
+    """
+    Find the doc_types of the company we have to crawl, using the checkpoint
+
+    :param incremental: if we want to look for the files delivered since the
+                    last crawl of the doc_types already in the checkpoint,
+                    instead of skipping them
+    :return: the doc_types to crawl, the watermarks of the doc_types already
+             crawled that we crawl again (incremental mode), and the files
+             of the doc_types we skip by doc_type
+    """
+    pending_doc_types = []
+    watermarks = {}
+    crawled_files = {}
+    for doc_type in doc_types:
+        key = "{0}_{1}".format(ccvm, doc_type)
+        # Use checkpoint to check if the company was already crawled
+        files = files_checkpoint.get(key)
+        if files is None:
+            pending_doc_types.append(doc_type)
+        elif incremental:
+            pending_doc_types.append(doc_type)
+            watermarks[doc_type] = company_files_watermark(files)
+        else:
+            _logger.debug("Getting the files from the cache")
+            crawled_files[doc_type] = files
+
+    return pending_doc_types, watermarks, crawled_files
+
+
+def company_files_pool(phantomjs_path, workers_num=10,
+                       fetch_mode=FETCH_MODE_HTTP,
+                       max_browser_uses=MAX_BROWSER_USES, autoscale=False):
+    """
+    The pool of the workers crawling the companies. With plain HTTP requests
+    the workers are threads of this process, sharing one connection pool.
+    Each worker reuses its browsers between companies (launched on demand)
+    """
+    threads = fetch_mode == FETCH_MODE_HTTP
+    if threads:
+        init_browser_pool(phantomjs_path, max_browser_uses)
+
+    if autoscale:
+        return AutoscalingPool(obtain_company_files.throttle,
+                               max_workers=workers_num, threads=threads,
+                               initializer=None if threads else
+                               init_browser_pool,
+                               initargs=(phantomjs_path, max_browser_uses),
+                               releaser=release_browser_pool,
+                               name="company_files")
+    if threads:
+        return ThreadPool(processes=workers_num)
+    return Pool(processes=workers_num,
+                initializer=init_browser_pool,
+                initargs=(phantomjs_path, max_browser_uses))
 
 
 def crawl_company_files(
@@ -266,17 +637,33 @@ def crawl_company_files(
         workers_num=10,
         from_date=None,
         force=False,
-        include_companies=None):
+        include_companies=None,
+        fetch_mode=FETCH_MODE_HTTP,
+        max_browser_uses=MAX_BROWSER_USES,
+        incremental=False,
+        autoscale=False):
+    """
+    Obtain the files of the companies for the doc_types
+
+    :param incremental: if we want to look for the files delivered since the
+                    last crawl of the companies already in the checkpoint,
+                    instead of skipping them
+    :param autoscale: if we want the number of workers to follow the rate
+                    and the latency of obtain_company_files, up to
+                    workers_num (see AutoscalingPool)
+    :return: a dict with the list of files per company and doc_type
+    """
 
     company_files_already_crawled = []
     companies_files = []
-    pool = Pool(processes=workers_num)
+
+    pool = company_files_pool(phantomjs_path, workers_num=workers_num,
+                              fetch_mode=fetch_mode,
+                              max_browser_uses=max_browser_uses,
+                              autoscale=autoscale)
     try:
         if force:
-            if Path(FILES_BY_COMPANY_CTL).exists():
-                shutil.move(
-                    FILES_BY_COMPANY_CTL, "{}.bak".
-                        format(FILES_BY_COMPANY_CTL))
+            files_checkpoint.reset()
 
         # Obtain the ccvm codes of all the listed companies
         ccvm_codes = []
@@ -291,36 +678,36 @@ def crawl_company_files(
         _logger.debug(
             "Processing the files of {} companies".format(len(ccvm_codes)))
 
-        current_companies = get_control_file(FILES_BY_COMPANY_CTL, {})
-
+        # One task per company with all the doc_types not already crawled
         func_params = []
         for ccvm in ccvm_codes:
-            for doc_type in doc_types:
-                # We process only the informed companies, if there is
-                #  any informed
-                if include_companies and ccvm not in include_companies:
-                    continue
+            # We process only the informed companies, if there is
+            #  any informed
+            if include_companies and ccvm not in include_companies:
+                continue
 
-                key = "{0}_{1}".format(ccvm, doc_type)
-                # Use checkpoint to check if the company was already crawled
-                if not key in current_companies.keys():
-                    func_params.append([
-                        phantomjs_path, ccvm, doc_type, from_date])
-                else:
-                    _logger.debug("Getting the files from the cache")
-                    if key in current_companies.keys():
-                        company_files_already_crawled += \
-                            current_companies[key]
+            pending_doc_types, watermarks, crawled_files = \
+                plan_company_files(ccvm, doc_types, incremental=incremental)
+            for files in crawled_files.values():
+                company_files_already_crawled += files
+
+            if pending_doc_types:
+                func_params.append([
+                    phantomjs_path, ccvm, pending_doc_types, from_date,
+                    fetch_mode, watermarks])
 
-        call_results = pool.starmap(obtain_company_files, func_params)
+        # The tasks that fail are retried and then skipped (see TaskRunner)
+        call_results = TaskRunner(pool, obtain_company_files).starmap(
+            func_params)
 
         # Merge all the responses into one only list
-        companies_files += list(
-            itertools.chain.from_iterable(call_results))
+        companies_files += list(itertools.chain.from_iterable(
+            files for files_by_doc_type in call_results
+            for files in files_by_doc_type.values()))
 
         companies_files += company_files_already_crawled
 
-        return get_control_file(FILES_BY_COMPANY_CTL, {})
+        return files_checkpoint.to_dict()
     except TimeoutError:
         _logger.exception("Timeout error")
         raise
@@ -328,3 +715,5 @@ def crawl_company_files(
         pool.close()
         pool.join()
         pool.terminate()
+        if phantomjs_path:
+            report_browser_launches()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*
+import os
+import csv
+import pickle
+import logging
+import tempfile
+from pathlib import Path
+
+from crawling_parts.columnar_dataset import write_columnar_dataset
+from crawling_parts.long_dataset import write_long_dataset
+
+DATASET_CSV = "data/dataset.csv"
+DICTIONARY_CSV = "data/dictionary.csv"
+
+# The columns of every row of the dataset
+DATASET_HEADERS = {"ccvm": "Company Bovespa Code",
+                   "period": "Date of the financial data",
+                   "version": "Delivered version"}
+
+_logger = logging.getLogger("bovespa")
+
+
+class DatasetWriter(object):
+    """
+    Writes the dataset and its dictionary while the files are parsed. The
+    columns of the dataset are the accounts found in all the files, so the
+    rows are spooled to a temporary file as they come and the csv files are
+    written when the writer is closed, with all the columns. Only the
+    columns are kept in memory.
+
+        with DatasetWriter() as writer:
+            for company_info, company_headers in results:
+                writer.write(company_info, company_headers)
+
+    If there is an error the previous dataset is kept. With a
+    columnar_folder the dataset is also stored column-wise in it (see
+    write_columnar_dataset), and with a long_folder in long format (see
+    write_long_dataset).
+    """
+
+    def __init__(self, dataset_filename=DATASET_CSV,
+                 dictionary_filename=DICTIONARY_CSV,
+                 columnar_folder=None,
+                 long_folder=None):
+        self.dataset_filename = dataset_filename
+        self.dictionary_filename = dictionary_filename
+        self.columnar_folder = columnar_folder
+        self.long_folder = long_folder
+        self.headers = dict(DATASET_HEADERS)
+        self.rows = 0
+
+        Path(dataset_filename).parent.mkdir(parents=True, exist_ok=True)
+        self._spool = tempfile.TemporaryFile(
+            dir=os.path.dirname(dataset_filename) or ".")
+
+    def write(self, company_info, company_headers, filing=None):
+        """
+        :param company_info: the row of the filing
+        :param company_headers: the description of the columns of the row
+        :param filing: the information of the filing that is not in the
+                       row (doc_type and delivery_date), if known
+        """
+        self.headers.update(company_headers)
+        pickle.dump((company_info, filing), self._spool,
+                    pickle.HIGHEST_PROTOCOL)
+        self.rows += 1
+
+    def _spooled_filings(self):
+        self._spool.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._spool)
+            except EOFError:
+                return
+
+    def _spooled_rows(self):
+        for company_info, filing in self._spooled_filings():
+            yield company_info
+
+    def close(self):
+        """
+        Write the csv files with the rows written so far
+        """
+        try:
+            _write_csv(self.dataset_filename, self.headers.keys(),
+                       self._spooled_rows())
+            _write_csv(self.dictionary_filename, ["Field", "Description"],
+                       ({"Field": field_name, "Description": field_desc}
+                        for field_name, field_desc in self.headers.items()))
+            if self.columnar_folder:
+                write_columnar_dataset(self.columnar_folder, self.headers,
+                                       self._spooled_rows)
+            if self.long_folder:
+                write_long_dataset(self.long_folder, self.headers,
+                                   self._spooled_filings)
+        finally:
+            self._spool.close()
+
+        _logger.info("Dataset {0} generated with {1} rows and {2} "
+                     "columns".format(self.dataset_filename, self.rows,
+                                      len(self.headers)))
+
+    def discard(self):
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _write_csv(filename, fieldnames, rows):
+    # Write a temporary file and replace the csv file with it, so the
+    # readers never see a half written file
+    tmp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_filename, filename)
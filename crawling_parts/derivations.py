@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*
+import logging
+
+import numpy as np
+
+from crawling_parts.columnar_dataset import (
+    ColumnarDataset, ColumnarDatasetWriter, COLUMNAR_DATASET_FOLDER)
+
+# The derived datasets, stored like the columnar dataset
+MEASURE_QUARTERLY = "quarterly"  # The value of each quarter alone
+MEASURE_TTM = "ttm"  # Trailing twelve months: the sum of the last 4 quarters
+MEASURE_YOY = "yoy"  # Year over year: the change since the same quarter
+MEASURES = [MEASURE_QUARTERLY, MEASURE_TTM, MEASURE_YOY]
+
+DERIVED_DATASET_FOLDER = "data/dataset_{measure}"
+
+# How the filings report the value of each account
+ACCOUNT_BALANCE = "balance"  # The value at the end of the period
+ACCOUNT_QUARTER = "quarter"  # ITR: the quarter alone. DFP: the whole year
+ACCOUNT_YEAR_TO_DATE = "year_to_date"  # ITR and DFP: since the year start
+
+# The kind of the accounts by the first number of the account, as in the
+# chart of accounts of the CVM: 1 ASSETS, 2 LIABILITIES, 3 DRE, 4 DRA,
+# 5 DMPL, 6 DFC_MD/DFC_MI and 7 DVA. The ITR values of the DRE and the DRA
+# are the ones of the quarter, and the ones of the DFC and the DVA since
+# the start of the year (see get_financial_info_accounts). The DMPL and
+# the shares (1.89.xx) are balances
+ACCOUNT_KINDS = {"3": ACCOUNT_QUARTER,
+                 "4": ACCOUNT_QUARTER,
+                 "6": ACCOUNT_YEAR_TO_DATE,
+                 "7": ACCOUNT_YEAR_TO_DATE}
+
+# Number of accounts derived at the same time, to bound the memory used by
+# the arrays of all the companies and quarters
+DERIVATION_BLOCK_SIZE = 64
+
+_logger = logging.getLogger("bovespa")
+
+
+def account_kind(account):
+    """
+    :return: how the filings report the value of the account (ex: 3.01)
+    """
+    return ACCOUNT_KINDS.get(account.split(".")[0], ACCOUNT_BALANCE)
+
+
+def derived_dataset_folder(measure):
+    return DERIVED_DATASET_FOLDER.format(measure=measure)
+
+
+def quarterly_values(reported, kinds):
+    """
+    Obtain the value of each quarter alone from the values reported by the
+    filings: the Q4 of the DRE and the DRA is the DFP minus the Q1, Q2 and
+    Q3, and the quarters of the DFC and the DVA are the difference with the
+    previous quarter of the year. The balances are kept as they are. A
+    quarter without all the filings it depends on is NaN.
+
+    :param reported: an array (companies, quarters, accounts) with the
+                     values of the latest filing of each quarter. The
+                     quarters start at the Q1 of a year, 4 per year
+    :param kinds: the kind of each account (see account_kind)
+    :return: an array with the same shape
+    """
+    companies, quarters, accounts = reported.shape
+    by_year = reported.reshape(companies, quarters // 4, 4, accounts)
+    values = by_year.copy()
+
+    quarter = kinds == ACCOUNT_QUARTER
+    if quarter.any():
+        year = by_year[..., quarter]
+        values[:, :, 3, quarter] = year[:, :, 3] - year[:, :, :3].sum(axis=2)
+
+    year_to_date = kinds == ACCOUNT_YEAR_TO_DATE
+    if year_to_date.any():
+        year = by_year[..., year_to_date]
+        values[:, :, 1:, year_to_date] = year[:, :, 1:] - year[:, :, :-1]
+
+    return values.reshape(companies, quarters, accounts)
+
+
+def trailing_twelve_months(quarterly, kinds):
+    """
+    :param quarterly: the values of each quarter alone (see
+                      quarterly_values)
+    :return: the sum of the last 4 quarters of each quarter, or the value
+             of the quarter for the balances
+    """
+    ttm = np.full(quarterly.shape, np.nan)
+    ttm[:, 3:] = quarterly[:, 3:] + quarterly[:, 2:-1] + \
+        quarterly[:, 1:-2] + quarterly[:, :-3]
+
+    balance = kinds == ACCOUNT_BALANCE
+    ttm[..., balance] = quarterly[..., balance]
+    return ttm
+
+
+def year_over_year(quarterly):
+    """
+    :param quarterly: the values of each quarter alone (see
+                      quarterly_values)
+    :return: the change of each quarter since the same quarter of the
+             previous year
+    """
+    yoy = np.full(quarterly.shape, np.nan)
+    yoy[:, 4:] = quarterly[:, 4:] - quarterly[:, :-4]
+    return yoy
+
+
+def check_measures(measures):
+    """
+    :raise ValueError: if any of the measures is not in MEASURES
+    """
+    unknown = [measure for measure in measures if measure not in MEASURES]
+    if unknown:
+        raise ValueError("Unknown measures {0}. Valid measures: {1}".format(
+            ", ".join(unknown), ", ".join(MEASURES)))
+
+
+def derive_measures(reported, kinds, measures=None):
+    """
+    Derive several measures of the same reported values. The values of each
+    quarter alone are computed once, and the rest of the measures are
+    derived from them.
+
+    :param measures: the measures (see MEASURES). All by default
+    :return: the arrays (companies, quarters, accounts) of the measures by
+             measure
+    """
+    measures = measures or MEASURES
+    check_measures(measures)
+
+    quarterly = quarterly_values(reported, kinds)
+    derived = {}
+    for measure in measures:
+        if measure == MEASURE_QUARTERLY:
+            derived[measure] = quarterly
+        elif measure == MEASURE_TTM:
+            derived[measure] = trailing_twelve_months(quarterly, kinds)
+        else:
+            derived[measure] = year_over_year(quarterly)
+    return derived
+
+
+def derive(reported, kinds, measure):
+    """
+    :return: the measure (see MEASURES) of the reported values, an array
+             (companies, quarters, accounts)
+    """
+    return derive_measures(reported, kinds, [measure])[measure]
+
+
+def _latest_quarters(dataset):
+    """
+    Find the rows of the latest version of each company and quarter, and
+    their position in the arrays (companies, quarters, accounts)
+
+    :return: the rows, the company and quarter of each row, and the number
+             of companies and quarters
+    """
+    ccvm = np.asarray(dataset.column("ccvm"))
+    period = np.asarray(dataset.column("period"))
+
+    # The rows are sorted by ccvm, period and version, so the latest
+    # version is the last row of each company and period
+    latest = np.ones(len(ccvm), dtype=bool)
+    latest[:-1] = (ccvm[1:] != ccvm[:-1]) | (period[1:] != period[:-1])
+
+    # ITR (Mar, Jun, Sep) and DFP (Dec) periods only
+    month = period.astype("datetime64[M]").astype("int64") % 12 + 1
+    rows = np.flatnonzero(latest & (month % 3 == 0))
+
+    year = period[rows].astype("datetime64[Y]").astype("int64")
+    first_year = year.min() if len(rows) else 0
+    quarter = (year - first_year) * 4 + month[rows] // 3 - 1
+    quarters = (year.max() - first_year + 1) * 4 if len(rows) else 4
+
+    ccvms, company = np.unique(ccvm[rows], return_inverse=True)
+
+    return rows, company, quarter, len(ccvms), quarters
+
+
+def derive_dataset(folder=COLUMNAR_DATASET_FOLDER, measures=None,
+                   block_size=DERIVATION_BLOCK_SIZE):
+    """
+    Derive the quarterly, trailing twelve months and year over year values
+    of all the companies from the columnar dataset (see
+    write_columnar_dataset), and store each measure as a columnar dataset
+    in its own folder (see derived_dataset_folder), with a row for the
+    latest version of each company and quarter. The accounts are derived
+    in blocks, for all the companies and quarters and all the measures at
+    once.
+
+    :param folder: the folder of the columnar dataset
+    :param measures: the measures to derive. All by default
+    :param block_size: the number of accounts derived at the same time
+    """
+    measures = measures or MEASURES
+    check_measures(measures)
+
+    dataset = ColumnarDataset(folder)
+    rows, company, quarter, companies, quarters = _latest_quarters(dataset)
+    key_columns = {name: np.asarray(dataset.column(name))[rows]
+                   for name in dataset.keys}
+    headers = {column["name"]: column["description"] for column in
+               dataset.schema["keys"] + dataset.schema["columns"]}
+    accounts = dataset.accounts
+
+    writers = {measure: ColumnarDatasetWriter(derived_dataset_folder(measure),
+                                              key_columns, headers)
+               for measure in measures}
+
+    # Every block of accounts is read and turned into quarterly values once
+    # for all the measures
+    for start in range(0, len(accounts), block_size):
+        names = accounts[start:start + block_size]
+        kinds = np.array([account_kind(name) for name in names])
+
+        reported = np.full((companies, quarters, len(names)), np.nan)
+        for index, name in enumerate(names):
+            reported[company, quarter, index] = dataset.column(name)[rows]
+
+        derived = derive_measures(reported, kinds, measures)
+        for measure, writer in writers.items():
+            values = derived[measure][company, quarter]
+            for index, name in enumerate(names):
+                writer.add(name, values[:, index])
+
+    for writer in writers.values():
+        writer.close()
@@ -1,23 +1,35 @@
 # -*- coding: utf-8 -*
+import io
 import logging
 import re
 import os
 import pathlib
 import shutil
 import ntpath
+import zlib
 import zipfile
-import ssl
-import csv
-from multiprocessing.pool import Pool
-from multiprocessing import Manager
+import queue
+import threading
+import traceback
+from collections import Counter, namedtuple
+from multiprocessing.pool import Pool, ThreadPool
 
 import xmljson
-from xml.etree.ElementTree import fromstring
-
-
-from urllib.request import urlretrieve
-from throttle import Throttle
-from utils import get_control_file, put_control_file
+from xml.etree.ElementTree import fromstring, iterparse
+
+
+from throttle import AdaptiveThrottle
+from circuit_breaker import CircuitBreaker
+from checkpoint import Checkpoint
+from utils import version_number
+from http_session import download
+from parse_cache import get_parse_cache, file_hash, PARSE_CACHE_SIZE
+from pipeline_stage import PipelineStage, run_stages, END
+from autoscaling_pool import AutoscalingPool
+from crawling_parts.dataset import DatasetWriter
+from crawling_parts.columnar_dataset import COLUMNAR_DATASET_FOLDER
+from crawling_parts.long_dataset import LONG_DATASET_FOLDER
+from crawling_parts.derivations import derive_dataset
 
 DOWNLOAD_URL = "http://www.rad.cvm.gov.br/enetconsulta/" \
                "frmDownloadDocumento.aspx?CodigoInstituicao=1&" \
@@ -25,11 +37,27 @@ DOWNLOAD_URL = "http://www.rad.cvm.gov.br/enetconsulta/" \
 
 DOWNLOADED_FILES_CTL = "ctl/downloads.ctl"
 
-manager = Manager()
-lock = manager.Lock()
+# Version of the extraction of the accounts. Change it when the extraction
+# changes to parse the files of the parse cache again
+PARSER_VERSION = 1
+
+# Threads downloading the files. They spend the time waiting for the
+# throttle and the network, so we can have many more than cores
+DOWNLOAD_WORKERS = 20
+
+# Maximum number of downloaded files waiting to be parsed
+PARSE_QUEUE_SIZE = 100
 
-# Avoid check certificates
-ssl._create_default_https_context = ssl._create_unverified_context
+# The errors of a file that is corrupted (ex: truncated), and not of the
+# parser. Only these files are downloaded again
+CORRUPTED_FILE_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError)
+
+# A downloaded file that could not be parsed because it is corrupted, with
+# the params of its download_file_task and the error
+CorruptedFile = namedtuple("CorruptedFile",
+                           ["file", "download_params", "error", "traceback"])
+
+downloads_checkpoint = Checkpoint(DOWNLOADED_FILES_CTL)
 
 DOC_TYPE_ITR = "ITR"
 DOC_TYPE_DFP = "DFP"
@@ -73,6 +101,9 @@ FILE_CAPITAL_COMPOSITION = \
     "docs/ComposicaoCapitalSocialDemonstracaoFinanceiraNegocios.xml"
 FILE_FINANCIAL_INFO = "docs/InfoFinaDFin.xml"
 
+# The files of the ITR/DFP packages we extract the accounts from
+PARSED_FILES = [FILE_DOCUMENT, FILE_CAPITAL_COMPOSITION, FILE_FINANCIAL_INFO]
+
 SHARES_NUMBER_ACCOUNTS = [
     ("1.89.01", "QuantidadeAcaoOrdinariaCapitalIntegralizado"),
     ("1.89.02", "QuantidadeAcaoPreferencialCapitalIntegralizado"),
@@ -89,13 +120,112 @@ def quarter(date):
     return (date.month - 1) // 3 + 1
 
 
+def open_xml(file, binary=False):
+    """
+    Open a file of the package: a path of the exploded package, or the
+    content read from the package in memory
+    """
+    if isinstance(file, bytes):
+        stream = io.BytesIO(file)
+        return stream if binary else io.TextIOWrapper(stream)
+    return open(file, "rb" if binary else "r")
+
+
 def convert_xml_into_json(file):
-    with open(file) as f:
+    with open_xml(file) as f:
         xml_content = f.read().replace("\n", "")
         return xmljson.badgerfish.data(fromstring(xml_content))
 
 
-def get_scales(available_files):
+def element_into_json(element):
+    """
+    Convert an element like convert_xml_into_json does with the whole file
+    (badgerfish convention, the new lines removed from the texts and the
+    values converted to numbers), without the root tag
+    """
+    value = {}
+    for attr, attr_value in element.attrib.items():
+        value["@{}".format(attr)] = xmljson.badgerfish._fromstring(
+            attr_value.replace("\n", ""))
+
+    text = element.text.replace("\n", "") if element.text else None
+    if text and text.strip():
+        value["$"] = xmljson.badgerfish._fromstring(text)
+
+    count = Counter(child.tag for child in element)
+    for child in element:
+        if count[child.tag] == 1:
+            value[child.tag] = element_into_json(child)
+        else:
+            value.setdefault(child.tag, []).append(element_into_json(child))
+
+    return value
+
+
+def iter_xml_elements(file, tag):
+    """
+    Parse the file incrementally, converting into json the children of the
+    root element with the tag (see element_into_json) as soon as they are
+    read. The elements are released once converted, so we never keep the
+    whole document in memory.
+    """
+    with open_xml(file, binary=True) as f:
+        root = None
+        depth = 0
+        for event, element in iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and element.tag == tag:
+                yield element_into_json(element)
+            if depth == 1:
+                root.remove(element)
+
+
+class FilingContext(object):
+    """
+    The files of a filing, shared by all the extractors of accounts. Each
+    file is converted into json only the first time an extractor needs it,
+    and the scales are obtained once.
+
+        filing = FilingContext(available_files)
+        money_scale, quant_scale = filing.scales()
+        data = filing.data(FILE_CAPITAL_COMPOSITION)
+    """
+
+    def __init__(self, available_files):
+        self.available_files = available_files
+        self._data = {}
+        self._scales = None
+
+    def file(self, name):
+        """
+        :return: the path or the content of the file, to parse it with
+                 another method (ex: iter_xml_elements)
+        """
+        return self.available_files[name]
+
+    def data(self, name):
+        """
+        :return: the content of the file converted into json
+        """
+        data = self._data.get(name)
+        if data is None:
+            data = convert_xml_into_json(self.available_files[name])
+            self._data[name] = data
+        return data
+
+    def scales(self):
+        if self._scales is None:
+            self._scales = get_scales(self)
+        return self._scales
+
+
+def get_scales(filing):
     """
     Obtain the Metric Scale and Quantity of Shares from the Document.xml file
 
@@ -103,10 +233,10 @@ def get_scales(available_files):
         xmldoc.child("Documento").child_value("CodigoEscalaMoeda")
         xmldoc.child("Documento").child_value("CodigoEscalaQuantidade")
 
-    :param available_files: list of available files per name
+    :param filing: the FilingContext of the filing
     :return: the money scale and quantity of shares
     """
-    data = convert_xml_into_json(available_files[FILE_DOCUMENT])
+    data = filing.data(FILE_DOCUMENT)
 
     money_scale = int(data["Documento"]["CodigoEscalaMoeda"]["$"])
     quant_scale = int(data["Documento"]["CodigoEscalaQuantidade"]["$"])
@@ -117,10 +247,10 @@ def get_scales(available_files):
 
 
 def get_cap_composition_accounts(
-        available_files, ccvm, fiscal_date, version):
-    money_scale, quant_scale = get_scales(available_files)
+        filing, ccvm, fiscal_date, version):
+    money_scale, quant_scale = filing.scales()
 
-    data = convert_xml_into_json(available_files[FILE_CAPITAL_COMPOSITION])
+    data = filing.data(FILE_CAPITAL_COMPOSITION)
 
     accounts = []
     for acc_number, acc_name in SHARES_NUMBER_ACCOUNTS:
@@ -150,14 +280,28 @@ def get_cap_composition_accounts(
 
 
 def get_financial_info_accounts(
-        available_files, ccvm, fiscal_date, version, doc_type):
+        filing, ccvm, fiscal_date, version, doc_type, stream=True):
+    """
+    Obtain the accounts of the financial statements from the InfoFinaDFin.xml
+    file
+
+    :param filing: the FilingContext of the filing
+    :param stream: if we want to extract the accounts while the file is
+                   parsed, instead of converting the whole file into json
+                   first
+    """
     accounts = []
 
-    money_scale, quant_scale = get_scales(available_files)
+    money_scale, quant_scale = filing.scales()
 
-    data = convert_xml_into_json(available_files[FILE_FINANCIAL_INFO])
+    if stream:
+        accounts_info = iter_xml_elements(
+            filing.file(FILE_FINANCIAL_INFO), "InfoFinaDFin")
+    else:
+        data = filing.data(FILE_FINANCIAL_INFO)
+        accounts_info = data["ArrayOfInfoFinaDFin"]["InfoFinaDFin"]
 
-    for account_info in data["ArrayOfInfoFinaDFin"]["InfoFinaDFin"]:
+    for account_info in accounts_info:
         acc_version = account_info["PlanoConta"]["VersaoPlanoConta"]
         account = {
             "ccvm": ccvm,
@@ -255,11 +399,14 @@ def load_account_details(available_files,
         ccvm=ccvm, fiscal_date=fiscal_date,
         version=version, doc_type=doc_type))
 
+    # The files of the filing are parsed once for all the extractors
+    filing = FilingContext(available_files)
+
     try:
         accounts = get_cap_composition_accounts(
-            available_files, ccvm, fiscal_date, version)
+            filing, ccvm, fiscal_date, version)
         accounts.extend(get_financial_info_accounts(
-            available_files, ccvm, fiscal_date, version, doc_type))
+            filing, ccvm, fiscal_date, version, doc_type))
 
         company_fin_info = {
             "ccvm": ccvm, "period": fiscal_date, "version": version}
@@ -284,20 +431,66 @@ def load_account_details(available_files,
         raise ex
 
 
+def version_key(version, delivery_date):
+    """
+    The order of the versions of a document: by version number (ex: 1.0 is
+    older than 2.0 and 10.0), and by delivery date for the same version
+    """
+    return version_number(version), delivery_date
+
+
+def latest_versions(files):
+    """
+    Keep only the latest version delivered of each document of a company
+    and doc_type. The companies deliver new versions of a document to fix
+    the previous ones, so the older versions are superseded.
+
+    :param files: the files of a company and doc_type, as tuples with the
+                  fiscal_date, protocol, version, doc_type, delivery_type
+                  and delivery_date
+    :return: the latest version of the files of each fiscal_date, in the
+             same order
+    """
+    latest = {}
+    for file in files:
+        (fiscal_date, protocol, version,
+         doc_type, delivery_type, delivery_date) = file
+        current = latest.get(fiscal_date)
+        if current is None or version_key(version, delivery_date) > \
+                version_key(current[2], current[5]):
+            latest[fiscal_date] = file
+
+    latest_files = set(latest.values())
+    return [file for file in files if file in latest_files]
+
+
 def update_download_files_checkpoint(ccvm_code, files=None):
-    with lock:
-        if files:
-            current_companies = get_control_file(DOWNLOADED_FILES_CTL, {})
-            company_files = current_companies.setdefault(ccvm_code, [])
-            if isinstance(files, (list, tuple)):
-                for file in files:
-                    if file not in company_files:
-                        company_files.extend(files)
-            else:
-                if files not in company_files:
-                    company_files.append(files)
-            current_companies[ccvm_code] = company_files
-            put_control_file(DOWNLOADED_FILES_CTL, current_companies)
+    if not files:
+        return
+
+    if not isinstance(files, (list, tuple)):
+        files = [files]
+
+    def add_files(company_files):
+        for file in files:
+            if file not in company_files:
+                company_files.append(file)
+        return company_files
+
+    downloads_checkpoint.update(ccvm_code, add_files, default=[])
+
+
+def discard_downloaded_file(ccvm_code, file):
+    """
+    Remove a downloaded file from the cache folder and from the checkpoint
+    (ex: a corrupted file), so it is downloaded again
+    """
+    if os.path.exists(file):
+        os.remove(file)
+    downloads_checkpoint.update(
+        ccvm_code, lambda company_files: [
+            company_file for company_file in company_files
+            if company_file != file], default=[])
 
 
 def delete_all(path):
@@ -379,30 +572,76 @@ def extract_file_content(cache_folder,
     return available_files
 
 
-def generate_dataset(results):
-    headers = {"ccvm": "Company Bovespa Code",
-               "period": "Date of the financial data",
-               "version": "Delivered version"}
-    docs = []
-    for company_info, company_headers, file in results:
-        headers.update(company_headers)
-        docs.append(company_info)
+def read_file_content(doc_type, file):
+    """Read the files we parse from the ITR/DFP zip inside of the ENET zip
+    file, in memory. Nothing is extracted to disk.
 
-    with open("data/dataset.csv", "w") as f:
-        writer = csv.DictWriter(f, fieldnames=headers.keys())
-        writer.writeheader()
-        writer.writerows(docs)
+    :return: the content of the files by name
+    """
+    available_files = {}
 
-    dictionary_headers = ["Field", "Description"]
-    with open("data/dictionary.csv", "w") as f:
-        writer = csv.DictWriter(f, fieldnames=dictionary_headers)
-        writer.writeheader()
-        for field_name, field_desc in headers.items():
-            writer.writerow({"Field": field_name,
-                             "Description": field_desc})
+    if doc_type not in ["ITR", "DFP"]:
+        return available_files
 
+    with zipfile.ZipFile(file, "r") as zip_ref:
+        for name in zip_ref.namelist():
+            if re.match(RE_FILE_BY_XML, name, re.IGNORECASE) or \
+                    not (re.match(RE_FILE_BY_ITR, name, re.IGNORECASE) or
+                         re.match(RE_FILE_BY_DFP, name, re.IGNORECASE)):
+                continue
+
+            # The inner zip is decompressed once into memory, so we can
+            # seek through it to read its members
+            content = io.BytesIO(zip_ref.read(name))
+            with zipfile.ZipFile(content, "r") as inner_zip_ref:
+                for inner_name in inner_zip_ref.namelist():
+                    filename = "docs/{}".format(ntpath.basename(inner_name))
+                    if filename in PARSED_FILES:
+                        available_files[filename] = \
+                            inner_zip_ref.read(inner_name)
+
+    return available_files
+
+
+def parse_file(cache_folder, ccvm, fiscal_date, version, doc_type, file,
+               force_extraction=False, extract_to_disk=False,
+               parse_cache_size=PARSE_CACHE_SIZE):
+    """
+    Extract the financial information of a downloaded file, or take it from
+    the parse cache of the cache folder if the file was already parsed with
+    the current PARSER_VERSION
+
+    :param parse_cache_size: the maximum size of the parse cache in bytes.
+                             0 to disable the cache
+    :return: the company info and the headers info
+    """
+    parse_cache = get_parse_cache(cache_folder, parse_cache_size)
+    if parse_cache is not None:
+        key = parse_cache.key(
+            file_hash(file), ccvm, "{:%Y%m%d}".format(fiscal_date), version,
+            doc_type, PARSER_VERSION)
+        result = parse_cache.get(key)
+        if result is not None:
+            return result
+
+    if extract_to_disk:
+        financial_files = extract_file_content(
+            cache_folder, ccvm, fiscal_date,
+            version, doc_type, file, force_extraction)
+    else:
+        financial_files = read_file_content(doc_type, file)
 
-@Throttle(minutes=1, rate=20, max_tokens=20)
+    result = load_account_details(
+        financial_files, ccvm, fiscal_date, version, doc_type)
+
+    if parse_cache is not None:
+        parse_cache.put(key, result)
+
+    return result
+
+
+@CircuitBreaker("download")
+@AdaptiveThrottle(minutes=1, rate=20, max_tokens=20, min_rate=5, max_rate=60)
 def download_file(
         cache_folder,
         ccvm, fiscal_date, version, doc_type, protocol,
@@ -411,7 +650,10 @@ def download_file(
     This function is responsible for download the financial statements of a
     public company based on a protocol code.
 
-    This function is being throttle allowing 20 downloads per minute
+    This function is being throttle allowing 20 downloads per minute. The
+    file is streamed into the cache folder using the keep-alive session of
+    the process, shared by the download threads. It is parsed apart (see
+    parse_file), in the processes of the parse pool
 
     :param ccvm: the unique code of the company in bovespa
     :param fiscal_period: the fiscal period of the financial statements
@@ -424,6 +666,7 @@ def download_file(
     :param cache_folder: the folder to place the company files (local cache)
     :param force_download: if we want to download the company file no matter
                             if it already exists in the cache
+    :return: the path of the file in the cache folder
     """
     filename = "CCVM_{0}_{1:%Y%m%d}_{2}.{3}".format(
         ccvm, fiscal_date, version.replace(".", ""), doc_type)
@@ -433,31 +676,208 @@ def download_file(
         file.parent.mkdir(parents=True, exist_ok=True)
 
     if force_download or not file.exists():
-        urlretrieve(DOWNLOAD_URL.format(protocol), filename=filename)
-        shutil.move(filename, file)
+        # A forced download never resumes a previous partial file
+        download(DOWNLOAD_URL.format(protocol), str(file),
+                 resume=not force_download)
 
     update_download_files_checkpoint(ccvm, str(file))
 
-    financial_files = extract_file_content(
-        cache_folder, ccvm, fiscal_date,
-        version, doc_type, file, force_download)
+    return str(file)
 
-    company_info, headers_info = load_account_details(
-        financial_files, ccvm, fiscal_date, version, doc_type)
 
-    return company_info, headers_info, file
+def download_file_task(params):
+    """
+    Download a file in a thread of the download pool
+
+    :return: the params of the parse_file_task of the file
+    """
+    download_params, delivery_date = params
+    cache_folder, ccvm, fiscal_date, version, doc_type, protocol, \
+        force_download, extract_to_disk, parse_cache_size = download_params
+
+    file = download_file(cache_folder, ccvm, fiscal_date, version, doc_type,
+                         protocol, force_download=force_download)
+
+    return (cache_folder, ccvm, fiscal_date, version, doc_type, protocol,
+            file, force_download, extract_to_disk, parse_cache_size,
+            delivery_date)
+
+
+def parse_file_task(params):
+    """
+    Parse a downloaded file in a process of the parse pool. A corrupted file
+    (see CORRUPTED_FILE_ERRORS) is discarded, and the params to download it
+    again are returned, so the download stage downloads it (see
+    download_stages). The rest of the errors are raised and the file is
+    kept
+
+    :return: the company info, the headers info and the information of the
+             filing, or a CorruptedFile
+    """
+    cache_folder, ccvm, fiscal_date, version, doc_type, protocol, file, \
+        force_download, extract_to_disk, parse_cache_size, delivery_date = \
+        params
+
+    try:
+        company_info, headers_info = parse_file(
+            cache_folder, ccvm, fiscal_date, version, doc_type, file,
+            force_extraction=force_download, extract_to_disk=extract_to_disk,
+            parse_cache_size=parse_cache_size)
+    except CORRUPTED_FILE_ERRORS as ex:
+        discard_downloaded_file(ccvm, file)
+        download_params = [cache_folder, ccvm, fiscal_date, version,
+                           doc_type, protocol, True, extract_to_disk,
+                           parse_cache_size]
+        return CorruptedFile(
+            file, (download_params, delivery_date),
+            "{0}: {1}".format(type(ex).__name__, ex), traceback.format_exc())
+
+    return company_info, headers_info, {
+        "doc_type": doc_type, "delivery_date": delivery_date}
+
+
+def download_files_pool(download_workers=DOWNLOAD_WORKERS, autoscale=False):
+    """
+    The pool of the threads downloading the files
+
+    :param autoscale: if we want the number of threads to follow the rate
+                      and the latency of download_file, up to
+                      download_workers (see AutoscalingPool)
+    """
+    if autoscale:
+        return AutoscalingPool(download_file.throttle,
+                               max_workers=download_workers, threads=True,
+                               name="download_files")
+    return ThreadPool(processes=download_workers)
+
+
+def download_stages(downloads, writer, download_pool, parse_pool, stop,
+                    download_workers=DOWNLOAD_WORKERS, parse_workers=None,
+                    queue_size=PARSE_QUEUE_SIZE):
+    """
+    The stages that download the files in the threads of the download pool
+    and parse them in the processes of the parse pool, connected by a
+    queue of at most queue_size files, so the downloads wait for the
+    throttle while all the cores parse.
+
+    The corrupted files (see parse_file_task) go through the pools once
+    more: they are downloaded again in the download pool and parsed again.
+    If they are still corrupted they are written to the dead letter file.
+
+    :param downloads: the queue with the params of the download_file_task
+                      of the files
+    :param writer: the DatasetWriter of the parsed files
+    :return: the list of stages to run (see run_stages)
+    """
+    parses = queue.Queue(maxsize=queue_size)
+    redownloads = queue.Queue(maxsize=queue_size)
+    reparses = queue.Queue(maxsize=queue_size)
+    parse_pending = (parse_workers or os.cpu_count()) * 2
+
+    def write_filing(result):
+        if isinstance(result, CorruptedFile):
+            _logger.warning("The file {0} is corrupted ({1}). Downloading "
+                            "it again".format(result.file, result.error))
+            return [result.download_params]
+        writer.write(*result)
+
+    def write_reparsed_filing(result):
+        if isinstance(result, CorruptedFile):
+            stages[-1].runner.dead_letter(result.download_params, 2,
+                                          result.error, result.traceback)
+            return
+        writer.write(*result)
+
+    stages = [PipelineStage("download_files", download_pool,
+                            download_file_task, downloads,
+                            lambda params: [params], outbox=parses,
+                            max_pending=download_workers, stop=stop),
+              PipelineStage("parse_files", parse_pool, parse_file_task,
+                            parses, write_filing, outbox=redownloads,
+                            max_pending=parse_pending, stop=stop),
+              PipelineStage("redownload_files", download_pool,
+                            download_file_task, redownloads,
+                            lambda params: [params], outbox=reparses,
+                            max_pending=download_workers, stop=stop),
+              PipelineStage("reparse_files", parse_pool, parse_file_task,
+                            reparses, write_reparsed_filing,
+                            max_pending=parse_pending, stop=stop)]
+    return stages
+
+
+def plan_file_downloads(cache_folder, ccvm, files, force_download=False,
+                        keep_all_versions=False, extract_to_disk=False,
+                        parse_cache_size=PARSE_CACHE_SIZE):
+    """
+    Prepare the download of the files of a company and doc_type, keeping
+    only the latest version of each fiscal_date unless keep_all_versions
+
+    :return: the params of the download_file_task of each file, and the
+             number of superseded versions skipped
+    """
+    superseded_files = 0
+    if not keep_all_versions:
+        all_files, files = len(files), latest_versions(files)
+        superseded_files = all_files - len(files)
+
+    func_params = []
+    for (fiscal_date, protocol, version,
+         doc_type, delivery_type, delivery_date) in files:
+
+        func_params.append(([
+            cache_folder, ccvm, fiscal_date, version,
+            doc_type, protocol, force_download, extract_to_disk,
+            parse_cache_size], delivery_date))
+
+    return func_params, superseded_files
 
 
 def download_files(cache_folder,
                    files_per_ccvm_and_doc_type,
                    doc_types,
-                   workers_num=10,
+                   download_workers=DOWNLOAD_WORKERS,
+                   parse_workers=None,
                    force_download=False,
-                   include_companies=None):
+                   include_companies=None,
+                   keep_all_versions=False,
+                   extract_to_disk=False,
+                   parse_cache_size=PARSE_CACHE_SIZE,
+                   columnar_dataset=False,
+                   long_dataset=False,
+                   derived_dataset=False,
+                   autoscale=False):
+    """
+    Download the files of the companies and generate the dataset. The rows
+    are written to the dataset as the files are downloaded and parsed, in
+    any order
+
+    :param download_workers: the number of threads downloading the files
+    :param parse_workers: the number of processes parsing the downloaded
+                    files. By default the number of cores
+    :param keep_all_versions: if we want to download all the versions
+                    delivered of each document, instead of only the latest
+    :param extract_to_disk: if we want to explode the downloaded files in
+                    the cache folder, instead of reading them in memory
+    :param parse_cache_size: the maximum size of the cache of the parsed
+                    files in bytes. 0 to parse all the files again
+    :param columnar_dataset: if we also want the dataset stored column-wise
+                    in data/dataset_columns
+    :param long_dataset: if we also want the dataset stored in long format
+                    in data/dataset_long
+    :param derived_dataset: if we also want the quarterly, trailing twelve
+                    months and year over year values (see derive_dataset).
+                    It implies the columnar dataset
+    :param autoscale: if we want the number of download threads to follow
+                    the rate and the latency of download_file
+    """
 
-    pool = Pool(processes=workers_num)
+    # The parse processes are forked before the download threads are started
+    parse_pool = Pool(processes=parse_workers)
+    download_pool = download_files_pool(download_workers, autoscale=autoscale)
+    stop = threading.Event()
     try:
         func_params = []
+        superseded_files = 0
         for key, files in files_per_ccvm_and_doc_type.items():
 
             ccvm, doc_type = key.split("_")
@@ -466,24 +886,41 @@ def download_files(cache_folder,
             if include_companies and ccvm not in include_companies:
                 continue
 
-            for (fiscal_date, protocol, version,
-                 doc_type, delivery_type, delivery_date) in files:
-
-                filename = "CCVM_{0}_{1:%Y%m%d}_{2}.{3}".format(
-                    ccvm, fiscal_date, version.replace(".",""), doc_type)
-
-                func_params.append([
-                    cache_folder, ccvm, fiscal_date, version,
-                    doc_type, protocol, force_download])
-
-            _logger.debug("Downloading {} files...".format(len(func_params)))
-            call_results = pool.starmap(download_file, func_params)
-
-            generate_dataset(call_results)
+            company_params, company_superseded_files = plan_file_downloads(
+                cache_folder, ccvm, files,
+                force_download=force_download,
+                keep_all_versions=keep_all_versions,
+                extract_to_disk=extract_to_disk,
+                parse_cache_size=parse_cache_size)
+            func_params.extend(company_params)
+            superseded_files += company_superseded_files
+
+        _logger.debug("Downloading {0} files ({1} superseded versions "
+                      "skipped)...".format(len(func_params),
+                                           superseded_files))
+
+        downloads = queue.Queue()
+        for params in func_params:
+            downloads.put(params)
+        downloads.put(END)
+
+        with DatasetWriter(columnar_folder=COLUMNAR_DATASET_FOLDER
+                           if columnar_dataset or derived_dataset else None,
+                           long_folder=LONG_DATASET_FOLDER
+                           if long_dataset else None) as writer:
+            run_stages(download_stages(
+                downloads, writer, download_pool, parse_pool, stop,
+                download_workers=download_workers,
+                parse_workers=parse_workers))
+
+        if derived_dataset:
+            derive_dataset(COLUMNAR_DATASET_FOLDER)
     except TimeoutError:
         _logger.exception("Timeout error")
         raise
     finally:
-        pool.close()
-        pool.join()
-        pool.terminate()
+        stop.set()
+        for pool in [download_pool, parse_pool]:
+            pool.close()
+            pool.join()
+            pool.terminate()
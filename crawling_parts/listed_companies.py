@@ -1,21 +1,26 @@
 # -*- coding: utf-8 -*
 import csv
 import itertools
-import shutil
 import logging
-from pathlib import Path
 from multiprocessing.pool import Pool
-from multiprocessing import Manager
 
-from bs4 import BeautifulSoup
+import lxml.html
+import requests
 
-from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 
-from utils import get_control_file, put_control_file
-from throttle import Throttle
+from checkpoint import Checkpoint
+from throttle import AdaptiveThrottle
+from circuit_breaker import CircuitBreaker
+from autoscaling_pool import AutoscalingPool
+from task_runner import TaskRunner
+from browser_pool import (
+    browser, init_browser_pool, release_browser_pool, report_browser_launches,
+    MAX_BROWSER_USES)
+from http_session import fetch_html, FETCH_MODE_HTTP
 
 ALPHABET_LIST = list(map(chr, range(65, 91)))
 NUMBERS_LIST = list(range(0, 10))
@@ -25,106 +30,184 @@ COMPANIES_LISTING_SEARCHER_LETTERS = ALPHABET_LIST + NUMBERS_LIST
 COMPANIES_LISTING_URL = "http://cvmweb.cvm.gov.br/SWB/Sistemas/SCW/CPublica/" \
                         "CiaAb/FormBuscaCiaAbOrdAlf.aspx?LetraInicial={}"
 
+NO_COMPANIES_MESSAGE = "Nenhuma companhia foi encontrada com o critério de" \
+                      " busca especificado."
+
 # The list of all the already processed letters (searching companies)
 COMPANY_LETTERS_CTL = "ctl/listed_companies_letters.ctl"
 
 # The list of all the already processed companies by letter
 COMPANIES_CTL = "ctl/listed_companies_companies.ctl"
 
-manager = Manager()
-lock = manager.Lock()
+letters_checkpoint = Checkpoint(COMPANY_LETTERS_CTL)
+companies_checkpoint = Checkpoint(COMPANIES_CTL)
 
 _logger = logging.getLogger("bovespa")
 
 
 def update_listed_companies_checkpoint(letter, companies=None):
-    with lock:
-        current_letters = get_control_file(COMPANY_LETTERS_CTL, [])
-        if letter not in set(current_letters):
-            current_letters.append(letter)
-            put_control_file(COMPANY_LETTERS_CTL, current_letters)
+    if companies:
+        companies_checkpoint.put(letter, companies)
 
-        if companies:
-            current_companies = get_control_file(COMPANIES_CTL, {})
-            current_companies[letter] = companies
-            put_control_file(COMPANIES_CTL, current_companies)
+    # The letter is marked as processed once its companies are saved
+    letters_checkpoint.put(letter, True)
 
 
 def has_letter(letter):
-    with lock:
-        current_letters = get_control_file(COMPANY_LETTERS_CTL, [])
-        return letter in current_letters
+    return letter in letters_checkpoint
 
 
-@Throttle(minutes=1, rate=50, max_tokens=50)
-def update_listed_companies(letter, phantomjs_path):
-    driver = None
-    try:
-        companies = []
-        driver = webdriver.PhantomJS(
-            executable_path=phantomjs_path)
+def parse_listed_companies(html):
+    """
+    Extract the companies from the listing page
 
-        url = COMPANIES_LISTING_URL.format(letter)
+    :param html: the content of the listing page
+    :return: the list of companies, an empty list if the page informs there
+             are no companies, or None if the page is not a listing page
+    """
+    document = lxml.html.fromstring(html)
 
-        # Let's navigate to the url and wait until the page is completely
-        # loaded. We control that the page is loaded looking for the
-        #  presence of the table with id = "dlCiasCdCVM"
-        driver.get(url)
+    companies_table = document.find(".//table[@id='dlCiasCdCVM']")
+    if companies_table is None:
+        message = document.find(".//*[@id='lblMsg']")
+        if message is not None and \
+                NO_COMPANIES_MESSAGE in message.text_content():
+            return []
+        return None
+
+    companies = []
+    companies_rows = list(companies_table.iter("tr"))
+
+    # The first row is the header
+    for row in companies_rows[1:]:
+        cells = list(row.iter("td"))
+        companies.append({
+            "cnpj": cells[0].find(".//a").text_content(),
+            "name": cells[1].find(".//a").text_content(),
+            "type": cells[2].find(".//a").text_content(),
+            "ccvm": cells[3].find(".//a").text_content(),
+            "situation": cells[4].find(".//a").text_content(),
+        })
+
+    return companies
+
+
+def fetch_listed_companies(letter):
+    """
+    Obtain the companies for a letter using a plain HTTP request (no browser)
+
+    :return: the list of companies or None if the page can not be processed
+    """
+    url = COMPANIES_LISTING_URL.format(letter)
+    return parse_listed_companies(fetch_html(url))
+
+
+@CircuitBreaker("listed_companies", failures=[TimeoutException])
+@AdaptiveThrottle(minutes=1, rate=50, max_tokens=50,
+                  min_rate=10, max_rate=120, failures=[TimeoutException])
+def update_listed_companies(letter, phantomjs_path,
+                            fetch_mode=FETCH_MODE_HTTP):
+    if fetch_mode == FETCH_MODE_HTTP:
         try:
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, 'dlCiasCdCVM')))
-        except:
-            WebDriverWait(driver, 10).until(
-                EC.text_to_be_present_in_element(
-                    (By.ID, 'lblMsg'),
-                    "Nenhuma companhia foi encontrada com o critério de"
-                    " busca especificado."))
-
-            update_listed_companies_checkpoint(letter)
+            companies = fetch_listed_companies(letter)
+        except requests.RequestException:
+            # Without the browser fallback the error reaches the throttle
+            if not phantomjs_path:
+                raise
+            _logger.exception("Unable to fetch the listed companies for "
+                              "letter {}".format(letter))
+            companies = None
+
+        if companies is not None:
+            update_listed_companies_checkpoint(letter, companies)
             return companies
 
-        bs = BeautifulSoup(driver.page_source, "html.parser")
+        if not phantomjs_path:
+            raise Exception("Unable to obtain the listed companies for "
+                            "letter {}".format(letter))
 
-        companies_table = bs.find("table", attrs={"id": "dlCiasCdCVM"})
-        companies_rows = companies_table.findChildren(["tr"])
+        _logger.warning("Using phantomjs to obtain the listed companies for "
+                        "letter {}".format(letter))
 
-        # The first row is the header
-        for row in companies_rows[1:]:
-            cells = row.findChildren('td')
-            companies.append({
-                "cnpj": cells[0].find("a").getText(),
-                "name": cells[1].find("a").getText(),
-                "type": cells[2].find("a").getText(),
-                "ccvm": cells[3].find("a").getText(),
-                "situation": cells[4].find("a").getText(),
+    return browse_listed_companies(letter, phantomjs_path)
 
-            })
 
-        update_listed_companies_checkpoint(letter, companies)
-        return companies
+def browse_listed_companies(letter, phantomjs_path):
+    try:
+        companies = []
+        with browser(phantomjs_path) as driver:
+            url = COMPANIES_LISTING_URL.format(letter)
+
+            # Let's navigate to the url and wait until the page is completely
+            # loaded. We control that the page is loaded looking for the
+            #  presence of the table with id = "dlCiasCdCVM"
+            driver.get(url)
+            try:
+                WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.ID, 'dlCiasCdCVM')))
+            except:
+                WebDriverWait(driver, 10).until(
+                    EC.text_to_be_present_in_element(
+                        (By.ID, 'lblMsg'), NO_COMPANIES_MESSAGE))
+
+                update_listed_companies_checkpoint(letter)
+                return companies
+
+            companies = parse_listed_companies(driver.page_source)
+
+            update_listed_companies_checkpoint(letter, companies)
+            return companies
     finally:
         _logger.debug("Finishing to crawl listed companies for letter {}".
               format(letter))
-        if driver:
-            _logger.debug("Closing the phantomjs driver for letter {}".
-                          format(letter))
-            driver.quit()
 
 
-def crawl_listed_companies(phantomjs_path, workers_num=10, force=False):
+def write_listed_companies(companies):
+    with open("data/companies.csv", "w") as f:
+        headers = ["ccvm", "name", "cnpj", "type", "situation"]
+        writer = csv.DictWriter(f, fieldnames=headers)
+        writer.writeheader()
+        writer.writerows(companies)
+
+
+def listed_companies_pool(phantomjs_path, workers_num=10,
+                          max_browser_uses=MAX_BROWSER_USES, autoscale=False):
+    """
+    The pool of the workers crawling the letters. Each worker reuses its
+    browsers between letters (launched on demand)
+
+    :param autoscale: if we want the number of workers to follow the rate
+                      and the latency of update_listed_companies, up to
+                      workers_num (see AutoscalingPool)
+    """
+    if autoscale:
+        return AutoscalingPool(update_listed_companies.throttle,
+                               max_workers=workers_num,
+                               initializer=init_browser_pool,
+                               initargs=(phantomjs_path, max_browser_uses),
+                               releaser=release_browser_pool,
+                               name="listed_companies")
+    return Pool(processes=workers_num,
+                initializer=init_browser_pool,
+                initargs=(phantomjs_path, max_browser_uses))
+
+
+def crawl_listed_companies(phantomjs_path, workers_num=10, force=False,
+                           fetch_mode=FETCH_MODE_HTTP,
+                           max_browser_uses=MAX_BROWSER_USES,
+                           autoscale=False):
 
     companies_already_crawled = []
     companies = []
-    pool = Pool(processes=workers_num)
+
+    pool = listed_companies_pool(phantomjs_path, workers_num=workers_num,
+                                 max_browser_uses=max_browser_uses,
+                                 autoscale=autoscale)
     try:
         if force:
             # We move the checkpoint files to start the crawling process
-            if Path(COMPANY_LETTERS_CTL).exists():
-                shutil.move(
-                    COMPANY_LETTERS_CTL, "{}.bak".format(COMPANY_LETTERS_CTL))
-            if Path(COMPANIES_CTL).exists():
-                shutil.move(
-                    COMPANIES_CTL, "{}.bak".format(COMPANIES_CTL))
+            letters_checkpoint.reset()
+            companies_checkpoint.reset()
 
         # We will launch a process per letter to crawl all the company data for
         # each letter
@@ -135,16 +218,17 @@ def crawl_listed_companies(phantomjs_path, workers_num=10, force=False):
             if not has_letter(letter):
                 # Preparing arguments for call the crawling function for the
                 # current letter
-                func_params.append([letter, phantomjs_path])
+                func_params.append([letter, phantomjs_path, fetch_mode])
             else:
                 # Loading the company data from the checkpoint
-                current_companies = get_control_file(COMPANIES_CTL, [])
-                if letter in current_companies.keys():
-                    companies_already_crawled += current_companies[letter]
+                companies_already_crawled += companies_checkpoint.get(
+                    letter, [])
 
         # Start the pool of processes to crawl the information about companies
-        # for each letter
-        call_results = pool.starmap(update_listed_companies, func_params)
+        # for each letter. The tasks that fail are retried and then skipped
+        # (see TaskRunner)
+        call_results = TaskRunner(pool, update_listed_companies).starmap(
+            func_params)
 
         # Merge all the responses into one only list
         companies += list(
@@ -153,11 +237,7 @@ def crawl_listed_companies(phantomjs_path, workers_num=10, force=False):
         # Add the companies already processed (checkpoint)
         companies += companies_already_crawled
 
-        with open("data/companies.csv", "w") as f:
-            headers = ["ccvm", "name", "cnpj", "type", "situation"]
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writeheader()
-            writer.writerows(companies)
+        write_listed_companies(companies)
     except TimeoutError:
         _logger.exception("Timeout error")
         raise
@@ -165,3 +245,5 @@ def crawl_listed_companies(phantomjs_path, workers_num=10, force=False):
         pool.close()
         pool.join()
         pool.terminate()
+        if phantomjs_path:
+            report_browser_launches()
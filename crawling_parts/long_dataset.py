@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*
+import os
+import json
+import logging
+from array import array
+
+import numpy as np
+
+from utils import version_number, temporary_folder, replace_folder
+
+LONG_DATASET_FOLDER = "data/dataset_long"
+
+SCHEMA_FILE = "schema.json"
+
+# The columns of the filings and their types
+FILING_COLUMNS = [("ccvm", "int32"), ("period", "datetime64[D]"),
+                  ("version", "U16"), ("doc_type", "U3"),
+                  ("delivery_date", "datetime64[D]")]
+
+# The columns of the values: the filing and the account they belong to
+VALUE_COLUMNS = [("filing_id", "int32"), ("account_id", "int32"),
+                 ("value", "float64")]
+
+_logger = logging.getLogger("bovespa")
+
+
+def write_long_dataset(folder, headers, rows):
+    """
+    Store the dataset in long format in a folder: one row per value of an
+    account of a filing (filing_id, account_id, value), so the accounts
+    without value in a filing take no space. The filings are stored in
+    their own table (ccvm, period, version, doc_type and delivery_date),
+    where the filing_id is the position of the filing sorted by ccvm,
+    period and version, and the accounts in the schema.json, where the
+    account_id is the position of the account. Every column is a .npy file.
+
+    :param folder: the folder of the dataset. It is replaced at the end
+    :param headers: the description of the columns by name, like in the
+                    dictionary of the dataset
+    :param rows: a function that returns an iterator over the rows and the
+                 information of their filings, called twice
+    """
+    key_names = [name for name, dtype in FILING_COLUMNS]
+    accounts = [name for name in headers if name not in key_names]
+    account_ids = {name: index for index, name in enumerate(accounts)}
+
+    filings = []
+    for row, filing in rows():
+        filing = filing or {}
+        filings.append((int(row["ccvm"]), row["period"], str(row["version"]),
+                        filing.get("doc_type") or "",
+                        filing.get("delivery_date")))
+    order = sorted(range(len(filings)), key=lambda filing: (
+        filings[filing][0], filings[filing][1],
+        version_number(filings[filing][2])))
+    filing_ids = np.empty(len(filings), dtype="int32")
+    filing_ids[order] = np.arange(len(filings), dtype="int32")
+
+    # Compact arrays for the values while we read the rows
+    value_filings = array("i")
+    value_accounts = array("i")
+    values = array("d")
+    for row_num, (row, filing) in enumerate(rows()):
+        for name, value in row.items():
+            account_id = account_ids.get(name)
+            if account_id is None or value is None or value == "":
+                continue
+            value_filings.append(filing_ids[row_num])
+            value_accounts.append(account_id)
+            values.append(value)
+
+    columns = {
+        "filing_id": np.frombuffer(value_filings, dtype="int32"),
+        "account_id": np.frombuffer(value_accounts, dtype="int32"),
+        "value": np.frombuffer(values, dtype="float64")}
+    value_order = np.lexsort((columns["account_id"], columns["filing_id"]))
+
+    tmp_folder = temporary_folder(folder)
+
+    schema = {"filings": len(filings), "values": len(values),
+              "filing_columns": [], "value_columns": [],
+              "accounts": [{"account_id": account_id, "name": name,
+                            "description": headers[name]}
+                           for account_id, name in enumerate(accounts)]}
+    for column_num, (name, dtype) in enumerate(FILING_COLUMNS):
+        filename = "filing_{}.npy".format(name)
+        column = np.array(
+            [filings[filing][column_num] for filing in order], dtype=dtype)
+        np.save(str(tmp_folder / filename), column)
+        schema["filing_columns"].append(
+            {"name": name, "dtype": dtype, "file": filename})
+
+    for name, dtype in VALUE_COLUMNS:
+        filename = "{}.npy".format(name)
+        np.save(str(tmp_folder / filename), columns[name][value_order])
+        schema["value_columns"].append(
+            {"name": name, "dtype": dtype, "file": filename})
+
+    with open(str(tmp_folder / SCHEMA_FILE), "w") as f:
+        json.dump(schema, f, indent=1, ensure_ascii=False)
+
+    # Replace the previous dataset
+    replace_folder(tmp_folder, folder)
+
+    _logger.info("Long dataset {0} generated with {1} filings and {2} "
+                 "values".format(folder, len(filings), len(values)))
+
+
+class LongDataset(object):
+    """
+    Reads the dataset stored by write_long_dataset
+
+        dataset = LongDataset("data/dataset_long")
+        filing_id, account_id, value = dataset.read(
+            ["1.01", "3.11"], from_period="2018-01-01")
+        filing_ids, accounts, matrix = dataset.pivot(["1.01", "3.11"])
+    """
+
+    def __init__(self, folder=LONG_DATASET_FOLDER):
+        self.folder = folder
+        with open(os.path.join(folder, SCHEMA_FILE)) as f:
+            self.schema = json.load(f)
+
+        self.accounts = [account["name"]
+                         for account in self.schema["accounts"]]
+        self._account_ids = {name: account_id for account_id, name in
+                             enumerate(self.accounts)}
+        self._files = {column["name"]: column["file"] for column in
+                       self.schema["filing_columns"] +
+                       self.schema["value_columns"]}
+
+    def column(self, name):
+        """
+        :return: a column of the filings (ex: ccvm, period) or of the values
+                 (filing_id, account_id, value), memory mapped
+        """
+        try:
+            filename = self._files[name]
+        except KeyError:
+            raise KeyError("There is no column {0} in the dataset {1}".
+                           format(name, self.folder))
+        return np.load(os.path.join(self.folder, filename), mmap_mode="r")
+
+    def account_ids(self, accounts):
+        """
+        :return: the ids of the accounts (ex: ["1.01", "3.11"])
+        """
+        try:
+            return np.array([self._account_ids[name] for name in accounts],
+                            dtype="int32")
+        except KeyError as ex:
+            raise KeyError("There is no account {0} in the dataset {1}".
+                           format(ex, self.folder))
+
+    def filings(self, ccvms=None, from_period=None, to_period=None):
+        """
+        :return: the ids of the filings of the companies and periods
+        """
+        mask = np.ones(self.schema["filings"], dtype=bool)
+        if ccvms is not None:
+            mask &= np.isin(self.column("ccvm"), ccvms)
+        if from_period is not None or to_period is not None:
+            period = self.column("period")
+            if from_period is not None:
+                mask &= period >= np.datetime64(from_period, "D")
+            if to_period is not None:
+                mask &= period <= np.datetime64(to_period, "D")
+        return np.flatnonzero(mask).astype("int32")
+
+    def read(self, accounts=None, ccvms=None, from_period=None,
+             to_period=None):
+        """
+        Read the values of some accounts of the filings of some companies
+        and periods
+
+        :return: the filing_id, account_id and value arrays
+        """
+        filing_id = self.column("filing_id")
+        account_id = self.column("account_id")
+
+        mask = np.ones(len(filing_id), dtype=bool)
+        if accounts is not None:
+            mask &= np.isin(account_id, self.account_ids(accounts))
+        if ccvms is not None or from_period is not None or \
+                to_period is not None:
+            mask &= np.isin(filing_id, self.filings(
+                ccvms=ccvms, from_period=from_period, to_period=to_period))
+
+        selected = np.flatnonzero(mask)
+        return (np.asarray(filing_id[selected]),
+                np.asarray(account_id[selected]),
+                np.asarray(self.column("value")[selected]))
+
+    def pivot(self, accounts=None, ccvms=None, from_period=None,
+              to_period=None):
+        """
+        Build the wide matrix of the values: one row per filing and one
+        column per account, with NaN where the filing has no value
+
+        :return: the ids of the filings of the rows, the accounts of the
+                 columns and the matrix
+        """
+        filing_id, account_id, value = self.read(
+            accounts=accounts, ccvms=ccvms, from_period=from_period,
+            to_period=to_period)
+
+        if ccvms is not None or from_period is not None or \
+                to_period is not None:
+            filing_ids = self.filings(
+                ccvms=ccvms, from_period=from_period, to_period=to_period)
+        else:
+            filing_ids = np.arange(self.schema["filings"], dtype="int32")
+        if accounts is None:
+            accounts = self.accounts
+        columns = self.account_ids(accounts)
+
+        # The position of each filing and account in the matrix
+        rows = np.full(self.schema["filings"], -1, dtype="int64")
+        rows[filing_ids] = np.arange(len(filing_ids))
+        positions = np.full(len(self.accounts), -1, dtype="int64")
+        positions[columns] = np.arange(len(columns))
+
+        matrix = np.full((len(filing_ids), len(columns)), np.nan)
+        matrix[rows[filing_id], positions[account_id]] = value
+
+        return filing_ids, list(accounts), matrix
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*
+import queue
+import logging
+import threading
+from multiprocessing.pool import Pool
+
+from browser_pool import report_browser_launches, MAX_BROWSER_USES
+from http_session import FETCH_MODE_HTTP
+from parse_cache import PARSE_CACHE_SIZE
+from pipeline_stage import PipelineStage, run_stages, END
+
+from crawling_parts.listed_companies import (
+    update_listed_companies, has_letter, write_listed_companies,
+    listed_companies_pool, letters_checkpoint, companies_checkpoint,
+    COMPANIES_LISTING_SEARCHER_LETTERS)
+from crawling_parts.company_files import (
+    obtain_company_files, plan_company_files, company_files_pool,
+    files_checkpoint)
+from crawling_parts.download_file import (
+    plan_file_downloads, download_stages, download_files_pool,
+    DOWNLOAD_WORKERS)
+from crawling_parts.dataset import DatasetWriter
+from crawling_parts.columnar_dataset import COLUMNAR_DATASET_FOLDER
+from crawling_parts.long_dataset import LONG_DATASET_FOLDER
+from crawling_parts.derivations import derive_dataset
+
+# Maximum number of items waiting between two stages of the pipeline
+PIPELINE_QUEUE_SIZE = 100
+
+_logger = logging.getLogger("bovespa")
+
+
+def listed_companies_task(params):
+    """
+    :return: the companies of a letter, from the checkpoint if the letter
+             was already crawled
+    """
+    letter, phantomjs_path, fetch_mode = params
+    if has_letter(letter):
+        return companies_checkpoint.get(letter, [])
+    return update_listed_companies(letter, phantomjs_path,
+                                   fetch_mode=fetch_mode)
+
+
+def company_files_task(params):
+    """
+    Obtain the files of the doc_types of a company not already crawled
+
+    :return: the ccvm and all the files of the company by doc_type
+    """
+    phantomjs_path, ccvm, doc_types, from_date, fetch_mode, incremental = \
+        params
+    pending_doc_types, watermarks, crawled_files = plan_company_files(
+        ccvm, doc_types, incremental=incremental)
+    if pending_doc_types:
+        obtain_company_files(phantomjs_path, ccvm, pending_doc_types,
+                             from_date=from_date, fetch_mode=fetch_mode,
+                             watermarks=watermarks)
+
+    # In incremental mode the new files are merged into the checkpoint
+    return ccvm, {doc_type: files_checkpoint.get(
+        "{0}_{1}".format(ccvm, doc_type)) or [] for doc_type in doc_types}
+
+
+def crawl_pipelined(phantomjs_path,
+                    cache_folder,
+                    doc_types,
+                    workers_num=10,
+                    download_workers=DOWNLOAD_WORKERS,
+                    parse_workers=None,
+                    from_date=None,
+                    force_crawl_listed_companies=False,
+                    force_crawl_company_files=False,
+                    include_companies=None,
+                    fetch_mode=FETCH_MODE_HTTP,
+                    max_browser_uses=MAX_BROWSER_USES,
+                    incremental=False,
+                    keep_all_versions=False,
+                    extract_to_disk=False,
+                    parse_cache_size=PARSE_CACHE_SIZE,
+                    columnar_dataset=False,
+                    long_dataset=False,
+                    derived_dataset=False,
+                    queue_size=PIPELINE_QUEUE_SIZE,
+                    autoscale=False):
+    """
+    Crawl the listed companies, their files and download the files at the
+    same time: the companies of each letter are sent to the company files
+    stage as soon as the letter is crawled, and the files of each company
+    to the download stage as soon as the company is crawled, through
+    bounded queues. Each stage has its own pool and throttle, so all the
+    sources are used at once instead of one after the other. The files are
+    downloaded by threads and parsed by processes (see download_stages).
+
+    :param workers_num: the number of workers crawling the listed companies
+                        and the company files
+    :param download_workers: the number of threads downloading the files
+    :param parse_workers: the number of processes parsing the files. By
+                          default the number of cores
+    :param queue_size: the maximum number of items waiting between stages
+    :param autoscale: if we want the number of workers of each stage to
+                      follow the rate and the latency of its throttle, up to
+                      workers_num and download_workers (see AutoscalingPool)
+    """
+    if force_crawl_listed_companies:
+        letters_checkpoint.reset()
+        companies_checkpoint.reset()
+    if force_crawl_company_files:
+        files_checkpoint.reset()
+
+    letters = queue.Queue()
+    companies = queue.Queue(maxsize=queue_size)
+    downloads = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    # The pools of processes are forked before any thread is started
+    letters_pool = listed_companies_pool(
+        phantomjs_path, workers_num=workers_num,
+        max_browser_uses=max_browser_uses, autoscale=autoscale)
+    parse_pool = Pool(processes=parse_workers)
+    companies_pool = company_files_pool(
+        phantomjs_path, workers_num=workers_num, fetch_mode=fetch_mode,
+        max_browser_uses=max_browser_uses, autoscale=autoscale)
+    download_pool = download_files_pool(download_workers, autoscale=autoscale)
+    pools = [letters_pool, companies_pool, download_pool, parse_pool]
+
+    listed_companies = []
+    crawled_ccvms = set()
+    superseded_files = []
+
+    def produce_companies(letter_companies):
+        listed_companies.extend(letter_companies)
+        for company in letter_companies:
+            ccvm = company["ccvm"]
+            if ccvm in crawled_ccvms or \
+                    (include_companies and ccvm not in include_companies):
+                continue
+            crawled_ccvms.add(ccvm)
+            yield [phantomjs_path, ccvm, doc_types, from_date, fetch_mode,
+                   incremental]
+
+    def produce_downloads(company_files):
+        ccvm, files_by_doc_type = company_files
+        for doc_type, files in files_by_doc_type.items():
+            func_params, superseded = plan_file_downloads(
+                cache_folder, ccvm, files,
+                force_download=force_crawl_company_files,
+                keep_all_versions=keep_all_versions,
+                extract_to_disk=extract_to_disk,
+                parse_cache_size=parse_cache_size)
+            superseded_files.append(superseded)
+            for params in func_params:
+                yield params
+
+    try:
+        with DatasetWriter(columnar_folder=COLUMNAR_DATASET_FOLDER
+                           if columnar_dataset or derived_dataset else None,
+                           long_folder=LONG_DATASET_FOLDER
+                           if long_dataset else None) as writer:
+
+            stages = [
+                PipelineStage("listed_companies", letters_pool,
+                              listed_companies_task, letters,
+                              produce_companies, outbox=companies,
+                              max_pending=workers_num, stop=stop),
+                PipelineStage("company_files", companies_pool,
+                              company_files_task, companies,
+                              produce_downloads, outbox=downloads,
+                              max_pending=workers_num, stop=stop)]
+            stages.extend(download_stages(
+                downloads, writer, download_pool, parse_pool, stop,
+                download_workers=download_workers,
+                parse_workers=parse_workers, queue_size=queue_size))
+
+            for letter in COMPANIES_LISTING_SEARCHER_LETTERS:
+                letters.put([letter, phantomjs_path, fetch_mode])
+            letters.put(END)
+
+            run_stages(stages)
+
+            write_listed_companies(listed_companies)
+
+            _logger.info("Pipeline finished: {0} letters, {1} companies, "
+                         "{2} files downloaded and {3} parsed ({4} "
+                         "superseded versions skipped)".format(
+                             *[stage.tasks for stage in stages],
+                             sum(superseded_files)))
+
+        if derived_dataset:
+            derive_dataset(COLUMNAR_DATASET_FOLDER)
+    finally:
+        stop.set()
+        for pool in pools:
+            pool.close()
+            pool.join()
+            pool.terminate()
+        if phantomjs_path:
+            report_browser_launches()
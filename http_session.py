@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*
+import os
+import re
+import time
+import logging
+import warnings
+import threading
+from multiprocessing.util import Finalize
+from urllib.parse import urljoin, urlencode
+
+import lxml.html
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# The ways we have to obtain the pages from the sources
+FETCH_MODE_HTTP = "http"
+FETCH_MODE_PHANTOMJS = "phantomjs"
+FETCH_MODES = [FETCH_MODE_HTTP, FETCH_MODE_PHANTOMJS]
+
+# Connect and read timeouts (seconds)
+HTTP_TIMEOUT = (10, 60)
+
+USER_AGENT = "Mozilla/5.0 (compatible; bovespa_crawler)"
+
+# The certificates of the sources are checked, except for the hosts
+# allowed with allow_insecure_host (ex: the download host of the CVM, that
+# has served invalid certificate chains)
+HTTP_VERIFY_TLS = True
+
+# Maximum number of keep-alive connections per host and process
+HTTP_POOL_SIZE = 50
+
+# Size of the blocks written to disk while downloading a file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# The keep-alive session and connection pool of each process. The
+# connections of a pool can not be shared between processes, so we keep them
+# per pid
+_sessions = {}
+_adapters = {}
+_insecure_adapters = {}
+
+# The hosts whose certificates are not checked
+_insecure_hosts = set()
+
+# The files, bytes and seconds downloaded by each process, updated by its
+# download threads
+_downloads = {}
+_downloads_lock = threading.Lock()
+
+_logger = logging.getLogger("bovespa")
+
+
+# A javascript link: the function called and its arguments
+RE_JAVASCRIPT_CALL = r"^javascript:\s*([\w.$]+)\s*\((.*)\)\s*;?\s*$"
+RE_JAVASCRIPT_ARG = r"'([^']*)'|\"([^\"]*)\"|([^,\s]+)"
+
+# The assignments of the form fields in the body of a javascript function
+# (ex: document.AIR.pagina.value = pagina;)
+RE_FIELD_ASSIGNMENT = r"(?:\[\s*['\"](\w+)['\"]\s*\]|\.(\w+))\.value\s*=" \
+                      r"\s*([^;\n]+)"
+
+
+class NoSuchLinkError(LookupError):
+    pass
+
+
+class InsecureHTTPAdapter(HTTPAdapter):
+    """
+    Adapter that does not check the certificates, mounted only for the
+    insecure hosts (see allow_insecure_host)
+    """
+
+    def send(self, request, **kwargs):
+        kwargs["verify"] = False
+        return super(InsecureHTTPAdapter, self).send(request, **kwargs)
+
+
+class UnexpectedPageError(Exception):
+    pass
+
+
+def allow_insecure_host(host):
+    """
+    Do not check the certificate of a host (ex: the download host). Only the
+    warnings of urllib3 for this host are silenced. It must be called before
+    starting the pools.
+    """
+    if host in _insecure_hosts:
+        return
+
+    _insecure_hosts.add(host)
+    warnings.filterwarnings(
+        "ignore",
+        message=r"Unverified HTTPS request is being made to host "
+                r"'{}'".format(re.escape(host)),
+        category=urllib3.exceptions.InsecureRequestWarning)
+    _logger.warning("The TLS certificate of {} is not verified".format(host))
+
+
+def _process_adapter(adapters, adapter_class):
+    """
+    :return: the adapter (connection pool) of the current process
+    """
+    pid = os.getpid()
+    adapter = adapters.get(pid)
+    if adapter is None:
+        _logger.debug("Opening HTTP connection pool for process {}".
+                      format(pid))
+        adapter = adapter_class(
+            pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        adapters[pid] = adapter
+    return adapter
+
+
+def new_session():
+    """
+    Create an HTTP session with its own cookies that uses the connection pool
+    of the current process. Useful to navigate the pages of the sources that
+    keep state in the session from several threads at the same time.
+    """
+    adapter = _process_adapter(_adapters, HTTPAdapter)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if _insecure_hosts:
+        insecure_adapter = _process_adapter(
+            _insecure_adapters, InsecureHTTPAdapter)
+        for host in _insecure_hosts:
+            # The host with and without a port, not its prefix
+            session.mount("https://{}/".format(host), insecure_adapter)
+            session.mount("https://{}:".format(host), insecure_adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    session.verify = HTTP_VERIFY_TLS
+    return session
+
+
+def get_session():
+    """
+    Obtain the keep-alive HTTP session of the current process
+    """
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        session = new_session()
+        _sessions[pid] = session
+
+    return session
+
+
+def form_fields(form):
+    """
+    Obtain the values a browser would send when submitting an HTML form
+    """
+    fields = []
+    for element in form.iter("input", "select", "textarea"):
+        name = element.get("name")
+        if not name or element.get("disabled") is not None:
+            continue
+        if element.tag == "input":
+            input_type = element.get("type", "text").lower()
+            if input_type in ("submit", "button", "image", "reset", "file"):
+                continue
+            if input_type in ("checkbox", "radio"):
+                if element.get("checked") is None:
+                    continue
+                fields.append((name, element.get("value", "on")))
+            else:
+                fields.append((name, element.get("value", "")))
+        elif element.tag == "select":
+            options = [option for option in element.iter("option")
+                       if option.get("selected") is not None]
+            for option in options[:None if element.get("multiple") else 1]:
+                fields.append((name, option.get("value", option.text or "")))
+        else:
+            fields.append((name, element.text or ""))
+
+    return fields
+
+
+def javascript_call(href):
+    """
+    Parse a javascript link (ex: javascript:__doPostBack('lnkNext',''))
+
+    :return: the name of the function called and the list of its arguments,
+             or None if the link is not a javascript call
+    """
+    match = re.match(RE_JAVASCRIPT_CALL, href.strip(), re.DOTALL)
+    if not match:
+        return None
+
+    args = [next(value for value in arg.groups() if value is not None)
+            for arg in re.finditer(RE_JAVASCRIPT_ARG, match[2])]
+    return match[1], args
+
+
+def javascript_fields(document, function_name, args):
+    """
+    Obtain the form fields a javascript function of the page sets before
+    submitting the form: the postback target and argument of the ASP.NET
+    __doPostBack, or else the assignments of the fields to the parameters
+    or literals in the body of the function (ex: the page index)
+
+    :param document: the lxml document of the page
+    :return: the list of fields (name, value)
+    """
+    if function_name == "__doPostBack":
+        return list(zip(["__EVENTTARGET", "__EVENTARGUMENT"],
+                        args + [""] * (2 - len(args))))
+
+    re_function = r"function\s+{}\s*\(([^)]*)\)\s*\{{(.*?)\}}".format(
+        re.escape(function_name))
+    for script in document.iter("script"):
+        match = re.search(re_function, script.text or "", re.DOTALL)
+        if not match:
+            continue
+
+        params = [param.strip() for param in match[1].split(",")]
+        values = dict(zip(params, args))
+
+        fields = []
+        for quoted_name, name, value in re.findall(
+                RE_FIELD_ASSIGNMENT, match[2]):
+            value = value.strip()
+            if value in values:
+                value = values[value]
+            elif re.match(r"^(['\"]).*\1$", value):
+                value = value[1:-1]
+            elif not re.match(r"^-?\d+(\.\d+)?$", value):
+                _logger.debug("Unable to evaluate {0} in the javascript "
+                              "function {1}".format(value, function_name))
+                continue
+            fields.append((quoted_name or name, value))
+        return fields
+
+    return []
+
+
+def fetch_html(url, session=None, method="GET", data=None):
+    """
+    Obtain the content of an HTML page as text
+
+    :param url: the url of the page
+    :param session: the session to use. By default the keep-alive session
+                    of the current process
+    :param method: GET or POST
+    :param data: the form fields to send in a POST request
+    :return: the content of the page
+    """
+    session = session or get_session()
+    response = session.request(method, url, data=data, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+
+    # The servers do not always inform the charset in the headers
+    if "charset" not in response.headers.get("Content-Type", ""):
+        response.encoding = response.apparent_encoding
+
+    return response.text
+
+
+def download(url, filename, session=None, resume=True):
+    """
+    Download a file streaming the response into a temporary file next to the
+    destination (filename.part), which is synced to disk and renamed to the
+    filename once completed. If a previous download of the file was
+    interrupted we ask the server only for the bytes we are missing, with
+    the ETag or the Last-Modified date of the previous response (saved in
+    filename.part.validator) in an If-Range header: if the file changed the
+    server sends the whole file again. A partial file without validator is
+    never resumed.
+
+    :param url: the url of the file
+    :param filename: the destination of the file
+    :param session: the session to use. By default the keep-alive session
+                    of the current process
+    :param resume: if we want to resume an interrupted download. If not the
+                   partial file is discarded
+    :return: the number of bytes downloaded
+    """
+    session = session or get_session()
+    part_filename = "{}.part".format(filename)
+    validator_filename = "{}.validator".format(part_filename)
+
+    validator = None
+    if resume and os.path.exists(validator_filename):
+        with open(validator_filename) as f:
+            validator = f.read().strip() or None
+    offset = os.path.getsize(part_filename) \
+        if validator and os.path.exists(part_filename) else 0
+
+    # The files are compressed already, and the ranges are only valid over
+    # the content without any transfer encoding
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+        headers["If-Range"] = validator
+
+    started_at = time.monotonic()
+    downloaded = 0
+    with session.get(url, headers=headers, stream=True,
+                     timeout=HTTP_TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            # The partial file is not valid anymore
+            _logger.debug("Unable to resume {}. Downloading it again".
+                          format(filename))
+            os.remove(part_filename)
+            return download(url, filename, session=session, resume=False)
+        response.raise_for_status()
+
+        content_range = response.headers.get("Content-Range", "")
+        if offset and (response.status_code != 206 or not
+                       content_range.startswith("bytes {}-".format(offset))):
+            # The server sends the whole file (ex: it changed)
+            offset = 0
+        elif offset:
+            _logger.debug("Resuming {0} from byte {1}".format(
+                filename, offset))
+
+        if not offset:
+            _save_validator(validator_filename, response)
+
+        with open(part_filename, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                downloaded += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.replace(part_filename, filename)
+    if os.path.exists(validator_filename):
+        os.remove(validator_filename)
+    _add_download(downloaded, time.monotonic() - started_at)
+
+    return downloaded
+
+
+def _save_validator(validator_filename, response):
+    """
+    Keep the validator of the response to resume the download: its strong
+    ETag or else its Last-Modified date. Without any, the partial file can
+    not be resumed
+    """
+    etag = response.headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else \
+        response.headers.get("Last-Modified")
+
+    if validator:
+        with open(validator_filename, "w") as f:
+            f.write(validator)
+    elif os.path.exists(validator_filename):
+        os.remove(validator_filename)
+
+
+def _add_download(downloaded, seconds):
+    pid = os.getpid()
+    with _downloads_lock:
+        stats = _downloads.get(pid)
+        if stats is None:
+            stats = _downloads[pid] = [0, 0, 0]
+            Finalize(None, report_downloads, exitpriority=10)
+        stats[0] += 1
+        stats[1] += downloaded
+        stats[2] += seconds
+
+
+def report_downloads():
+    """
+    Log the files downloaded by the current process and the bytes/sec
+    """
+    files, downloaded, seconds = _downloads.get(os.getpid(), (0, 0, 0))
+    if files:
+        _logger.info("Process {0} downloaded {1} files, {2} bytes "
+                     "({3:.0f} bytes/sec)".format(
+                         os.getpid(), files, downloaded,
+                         downloaded / seconds if seconds else 0))
+
+
+class HttpNavigator(object):
+    """
+    Navigates through the pages of a site like the browser does, but using
+    plain HTTP requests: following the links by their text and submitting
+    the forms when the links are javascript calls.
+    """
+
+    def __init__(self, session=None):
+        self.session = session or new_session()
+        self.url = None
+        self.html = None
+        self.document = None
+
+    def _load(self, url, method="GET", data=None):
+        self.html = fetch_html(
+            url, session=self.session, method=method, data=data)
+        self.url = url
+        self.document = lxml.html.fromstring(self.html)
+        return self.html
+
+    def get(self, url):
+        return self._load(url)
+
+    def state(self):
+        """
+        :return: the current page, to come back to it later with restore
+        """
+        return self.url, self.html, self.document
+
+    def restore(self, state):
+        self.url, self.html, self.document = state
+
+    def find(self, xpath):
+        """
+        :return: the first element for the xpath in the current page or None
+        """
+        elements = self.document.xpath(xpath)
+        return elements[0] if elements else None
+
+    def title(self):
+        title = self.document.find(".//title")
+        return title.text_content() if title is not None else ""
+
+    def click_link(self, text):
+        """
+        Navigate to the link with the given text in the current page
+
+        :raise NoSuchLinkError: if there is no link with the text
+        """
+        for anchor in self.document.iter("a"):
+            if anchor.text_content().strip() == text:
+                return self.follow(anchor)
+
+        raise NoSuchLinkError(
+            "Link [{0}] not found in {1}".format(text, self.url))
+
+    def follow(self, anchor):
+        href = (anchor.get("href") or "").strip()
+        if href and not href.lower().startswith("javascript:"):
+            return self._load(urljoin(self.url, href))
+
+        # The javascript links submit the form of the page, with the fields
+        # the function called sets
+        form = next(anchor.iterancestors("form"), None)
+        if form is None:
+            form = self.document.find(".//form")
+        if form is None:
+            raise UnexpectedPageError(
+                "Unable to follow the link [{0}] in {1}".format(
+                    href, self.url))
+
+        call = javascript_call(href) if href else None
+        fields = javascript_fields(self.document, *call) if call else []
+        return self.submit(form, fields=fields)
+
+    def submit(self, form, fields=None):
+        """
+        :param fields: the fields (name, value) to send instead of the
+                       values of the form, or in addition to them
+        """
+        data = form_fields(form)
+        if fields:
+            names = {name for name, _ in fields}
+            data = [field for field in data if field[0] not in names] + \
+                list(fields)
+
+        action = urljoin(self.url, form.get("action") or self.url)
+        if form.get("method", "GET").upper() == "POST":
+            return self._load(action, method="POST", data=data)
+
+        return self._load("{0}?{1}".format(
+            action.split("?")[0], urlencode(data)))
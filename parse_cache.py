@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*
+import os
+import time
+import zlib
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+# Default size of the cache of each cache folder (bytes)
+PARSE_CACHE_SIZE = 512 * 1024 * 1024
+
+PARSE_CACHE_FILENAME = "parse_cache.sqlite"
+
+# Seconds a writer waits for the lock of the database
+SQLITE_TIMEOUT = 60
+
+# Size of the blocks read to hash the files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The last use of the results read is written in batches, every this many
+# hits or seconds (or with the next put), so the reads do not take the
+# write lock of the database
+USED_AT_BATCH_SIZE = 100
+USED_AT_BATCH_SECONDS = 30
+
+# Number of least recently used results read at once while evicting
+EVICTION_BATCH_SIZE = 100
+
+# The caches opened by the current process by filename
+_parse_caches = {}
+
+_logger = logging.getLogger("bovespa")
+
+
+def file_hash(filename):
+    """
+    :return: the sha256 of the content of the file
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache(object):
+    """
+    Keeps the results of parsing the downloaded files in a SQLite database,
+    compressed, so we only parse the new or changed files when we generate
+    the dataset again. The results are evicted, least recently used first,
+    when the cache is larger than max_size bytes. The size of the cache is
+    kept in the parse_cache_meta table, updated in the same transaction as
+    the results, so the puts do not need to add the sizes of all the
+    results.
+
+        cache = ParseCache("crawler_cache/parse_cache.sqlite")
+        key = cache.key(file_hash(file), ccvm, doc_type, PARSER_VERSION)
+        result = cache.get(key)
+        if result is None:
+            result = parse(file)
+            cache.put(key, result)
+    """
+
+    def __init__(self, filename, max_size=PARSE_CACHE_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self._local = threading.local()
+
+    @staticmethod
+    def key(*fields):
+        """
+        Build the key of a result from the fields that identify it, usually
+        the hash of the file, the arguments of the parser, and the version
+        of the parser
+        """
+        return "_".join(str(field) for field in fields)
+
+    def _connection(self):
+        # The connections can not be shared between processes nor threads
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.pid = os.getpid()
+            self._local.connection = self._connect()
+            self._local.used = {}
+            self._local.used_flushed_at = time.monotonic()
+        return self._local.connection
+
+    def _connect(self):
+        Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(
+            self.filename, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS parse_cache ("
+                           "key TEXT PRIMARY KEY, value BLOB, "
+                           "size INTEGER, used_at REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS parse_cache_used_at "
+                           "ON parse_cache (used_at)")
+        connection.execute("CREATE TABLE IF NOT EXISTS parse_cache_meta ("
+                           "name TEXT PRIMARY KEY, value INTEGER)")
+
+        # The caches created by the previous versions have no size yet
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR IGNORE INTO parse_cache_meta (name, value) "
+                "SELECT 'size', COALESCE(SUM(size), 0) FROM parse_cache")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return connection
+
+    def get(self, key):
+        """
+        :return: the result cached for the key, or None
+        """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value FROM parse_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self._local.used[key] = time.time()
+        if len(self._local.used) >= USED_AT_BATCH_SIZE or \
+                time.monotonic() - self._local.used_flushed_at >= \
+                USED_AT_BATCH_SECONDS:
+            self._write(connection, self._flush_used)
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        content = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if len(content) > self.max_size:
+            return
+
+        def insert(connection):
+            self._flush_used(connection)
+            row = connection.execute(
+                "SELECT size FROM parse_cache WHERE key = ?",
+                (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO parse_cache (key, value, size, "
+                "used_at) VALUES (?, ?, ?, ?)",
+                (key, content, len(content), time.time()))
+            self._add_size(connection, len(content) - (row[0] if row else 0))
+            self._evict(connection)
+
+        self._write(self._connection(), insert)
+
+    def _write(self, connection, operation):
+        """
+        Run the operation in a write transaction
+        """
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            operation(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _flush_used(self, connection):
+        """
+        Write the last use of the results read. Must be called in a write
+        transaction
+        """
+        if self._local.used:
+            connection.executemany(
+                "UPDATE parse_cache SET used_at = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in self._local.used.items()])
+            self._local.used = {}
+        self._local.used_flushed_at = time.monotonic()
+
+    def _add_size(self, connection, size):
+        connection.execute("UPDATE parse_cache_meta SET value = value + ? "
+                           "WHERE name = 'size'", (size,))
+
+    def _evict(self, connection):
+        """
+        Remove the least recently used results while the cache is larger
+        than max_size. Must be called in a write transaction
+        """
+        size = connection.execute(
+            "SELECT value FROM parse_cache_meta WHERE name = 'size'"
+        ).fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        evicted = 0
+        evicted_size = 0
+        while size - evicted_size > self.max_size:
+            rows = connection.execute(
+                "SELECT key, size FROM parse_cache ORDER BY used_at "
+                "LIMIT ?", (EVICTION_BATCH_SIZE,)).fetchall()
+            if not rows:
+                break
+            for key, key_size in rows:
+                if size - evicted_size <= self.max_size:
+                    break
+                connection.execute(
+                    "DELETE FROM parse_cache WHERE key = ?", (key,))
+                evicted_size += key_size
+                evicted += 1
+
+        self._add_size(connection, -evicted_size)
+        _logger.debug("Evicted {0} results from the parse cache {1}".format(
+            evicted, self.filename))
+
+
+def get_parse_cache(cache_folder, max_size=PARSE_CACHE_SIZE):
+    """
+    Obtain the parse cache of a cache folder, or None if the max_size is 0
+    (disabled)
+    """
+    if not max_size:
+        return None
+
+    filename = os.path.join(cache_folder, PARSE_CACHE_FILENAME)
+    cache = _parse_caches.get(filename)
+    if cache is None:
+        cache = ParseCache(filename, max_size=max_size)
+        _parse_caches[filename] = cache
+    cache.max_size = max_size
+    return cache
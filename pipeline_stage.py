@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*
+import queue
+import logging
+import threading
+
+from task_runner import TaskRunner
+
+# Seconds the stages wait on a queue before looking if the pipeline stopped
+PIPELINE_POLL_INTERVAL = 0.5
+
+# Marks the end of the items of a queue
+END = object()
+
+_logger = logging.getLogger("bovespa")
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class PipelineStage(object):
+    """
+    A stage of a pipeline: a thread takes the items of the inbox of the
+    stage and runs them in the pool of the stage, with at most max_pending
+    items at once, and gives every result to the produce function, that
+    returns the items for the outbox (the inbox of the next stage). When
+    the outbox is full the stage stops taking items, so the slowest stage
+    sets the pace of the ones before it and the queues stay bounded. The
+    last item of an inbox must be END.
+
+    The tasks that fail are retried and then written to the dead letter
+    file (see TaskRunner), without stopping the stage. If the stage itself
+    fails (ex: its produce function), the stop event is set and all the
+    stages end.
+
+        stop = threading.Event()
+        files = queue.Queue(maxsize=100)
+        stages = [PipelineStage("download", threads, download, urls,
+                                lambda file: [file], outbox=files, stop=stop),
+                  PipelineStage("parse", processes, parse, files,
+                                write, stop=stop)]
+        run_stages(stages)
+    """
+
+    def __init__(self, name, pool, func, inbox, produce, outbox=None,
+                 max_pending=10, stop=None):
+        self.name = name
+        self.pool = pool
+        self.func = func
+        self.inbox = inbox
+        self.produce = produce
+        self.outbox = outbox
+        self.stop = stop or threading.Event()
+        self.tasks = 0
+        self.error = None
+
+        self.runner = TaskRunner(pool, func, name=name,
+                                 max_pending=max_pending, stop=self.stop)
+        self._thread = threading.Thread(
+            target=self._run, name="pipeline-{}".format(name), daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def _items(self):
+        while True:
+            item = get_item(self.inbox, self.stop)
+            if item is END:
+                return
+            yield item
+
+    def _run(self):
+        try:
+            for result in self.runner.imap_unordered(self._items()):
+                self.tasks += 1
+                for item in self.produce(result) or []:
+                    put_item(self.outbox, item, self.stop)
+
+            if self.outbox is not None:
+                put_item(self.outbox, END, self.stop)
+        except PipelineStopped:
+            pass
+        except Exception as ex:
+            _logger.exception("Pipeline stage {} failed".format(self.name))
+            self.error = ex
+            self.stop.set()
+
+
+def put_item(items_queue, item, stop):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            items_queue.put(item, timeout=PIPELINE_POLL_INTERVAL)
+            return
+        except queue.Full:
+            pass
+
+
+def get_item(items_queue, stop):
+    """
+    :return: the next item of the queue, or END if the pipeline stopped
+    """
+    while not stop.is_set():
+        try:
+            return items_queue.get(timeout=PIPELINE_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return END
+
+
+def run_stages(stages):
+    """
+    Start the stages and wait until all of them end
+
+    :raise: the error of the first stage that failed
+    """
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*
+import os
+import re
+import logging
+import logging.config
+import argparse
+from pathlib import Path
+from datetime import datetime
+from multiprocessing.pool import Pool
+
+from parse_cache import PARSE_CACHE_SIZE
+from checkpoint import (
+    set_checkpoint_backend, CHECKPOINT_BACKENDS, CHECKPOINT_BACKEND_SQLITE)
+
+from crawling_parts.dataset import DatasetWriter
+from crawling_parts.columnar_dataset import COLUMNAR_DATASET_FOLDER
+from crawling_parts.long_dataset import LONG_DATASET_FOLDER
+from crawling_parts.derivations import derive_dataset
+from crawling_parts.download_file import (
+    parse_file, latest_versions, downloads_checkpoint, DOC_TYPES)
+
+logging.config.fileConfig("log_config.conf")
+_logger = logging.getLogger("bovespa")
+
+# Where we find the downloaded files: the downloads checkpoint of the
+# crawler, or all the files of the cache folder
+SOURCE_DOWNLOADS = "downloads"
+SOURCE_SCAN = "scan"
+SOURCES = [SOURCE_DOWNLOADS, SOURCE_SCAN]
+
+# The names of the downloaded files: CCVM_{ccvm}_{fiscal_date}_{version}.
+# {doc_type}, where the version has no dot (ex: 2.0 -> 20)
+RE_DOWNLOADED_FILE = r"^CCVM_(\d+)_(\d{{8}})_(\d+)\.({})$".format(
+    "|".join(DOC_TYPES))
+
+
+def downloaded_file_info(file):
+    """
+    Obtain the information of a downloaded file from its name
+
+    :return: a tuple with the ccvm, fiscal_date, version and doc_type of the
+             file, or None if it is not a downloaded file
+    """
+    match = re.match(RE_DOWNLOADED_FILE, Path(file).name)
+    if not match:
+        return None
+
+    ccvm, fiscal_date, version, doc_type = match.groups()
+    # The versions have one decimal digit (ex: 1.0, 10.0)
+    version = "{0}.{1}".format(version[:-1] or "0", version[-1])
+
+    return ccvm, datetime.strptime(fiscal_date, "%Y%m%d"), version, doc_type
+
+
+def downloaded_files(cache_folder, source=SOURCE_DOWNLOADS):
+    """
+    :return: the downloaded files that are in the cache folder
+    """
+    if source == SOURCE_DOWNLOADS:
+        files = [file for ccvm, company_files in downloads_checkpoint.items()
+                 for file in company_files]
+    else:
+        files = [str(file) for file in Path(cache_folder).glob("*/CCVM_*")]
+
+    return [file for file in files if os.path.isfile(file)]
+
+
+def plan_files(files, include_companies=None, keep_all_versions=False):
+    """
+    Group the downloaded files by company and doc_type, keeping only the
+    latest version of each fiscal_date unless keep_all_versions
+
+    :return: a list of tuples with the file, ccvm, fiscal_date, version and
+             doc_type
+    """
+    files_by_company = {}
+    for file in sorted(set(files)):
+        info = downloaded_file_info(file)
+        if info is None:
+            _logger.debug("Ignoring the file {}".format(file))
+            continue
+
+        ccvm, fiscal_date, version, doc_type = info
+        if include_companies and ccvm not in include_companies:
+            continue
+
+        # The same fields than the files of the company files stage, with
+        # the file instead of the protocol
+        files_by_company.setdefault((ccvm, doc_type), []).append(
+            (fiscal_date, file, version, doc_type, None, datetime.min))
+
+    planned_files = []
+    for (ccvm, doc_type), company_files in sorted(files_by_company.items()):
+        if not keep_all_versions:
+            company_files = latest_versions(company_files)
+        planned_files.extend(
+            (file, ccvm, fiscal_date, version, doc_type)
+            for fiscal_date, file, version, doc_type, _, _ in company_files)
+
+    return planned_files
+
+
+def parse_downloaded_file(params):
+    """
+    :return: the company info, the headers info and the information of the
+             filing, or None if the file could not be parsed
+    """
+    cache_folder, file, ccvm, fiscal_date, version, doc_type, \
+        extract_to_disk, parse_cache_size = params
+    try:
+        company_info, headers_info = parse_file(
+            cache_folder, ccvm, fiscal_date, version, doc_type, file,
+            extract_to_disk=extract_to_disk,
+            parse_cache_size=parse_cache_size)
+        # The delivery dates are not in the names of the files
+        return company_info, headers_info, {
+            "doc_type": doc_type, "delivery_date": None}
+    except Exception:
+        # An invalid file must not stop the rest of the files
+        _logger.exception("Unable to parse the file {}".format(file))
+        return None
+
+
+def rebuild_dataset(cache_folder="./crawler_cache",
+                    workers_num=None,
+                    source=SOURCE_DOWNLOADS,
+                    include_companies=None,
+                    keep_all_versions=False,
+                    extract_to_disk=False,
+                    parse_cache_size=PARSE_CACHE_SIZE,
+                    checkpoint_backend=CHECKPOINT_BACKEND_SQLITE,
+                    columnar_dataset=False,
+                    long_dataset=False,
+                    derived_dataset=False):
+    """
+    Generate the dataset from the files already downloaded, without any
+    request to the sources, so there is no throttle: the files are parsed
+    with all the cores and written to the dataset as they are parsed.
+    """
+    set_checkpoint_backend(checkpoint_backend)
+
+    planned_files = plan_files(
+        downloaded_files(cache_folder, source),
+        include_companies=include_companies,
+        keep_all_versions=keep_all_versions)
+    _logger.info("Parsing {} downloaded files...".format(len(planned_files)))
+
+    failed_files = 0
+    pool = Pool(processes=workers_num)
+    try:
+        with DatasetWriter(columnar_folder=COLUMNAR_DATASET_FOLDER
+                           if columnar_dataset or derived_dataset else None,
+                           long_folder=LONG_DATASET_FOLDER
+                           if long_dataset else None) as writer:
+            for result in pool.imap_unordered(
+                    parse_downloaded_file,
+                    [(cache_folder, file, ccvm, fiscal_date, version,
+                      doc_type, extract_to_disk, parse_cache_size)
+                     for file, ccvm, fiscal_date, version, doc_type in
+                     planned_files],
+                    chunksize=8):
+                if result is None:
+                    failed_files += 1
+                    continue
+                writer.write(*result)
+
+        if derived_dataset:
+            derive_dataset(COLUMNAR_DATASET_FOLDER)
+    finally:
+        pool.close()
+        pool.join()
+        pool.terminate()
+
+    if failed_files:
+        _logger.warning("{} files could not be parsed".format(failed_files))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate the dataset from the files downloaded by the "
+                    "crawler")
+
+    parser.add_argument("--cache-folder",
+                        type=str,
+                        required=False,
+                        default="./crawler_cache",
+                        dest="cache_folder",
+                        help="The folder with the downloaded files. "
+                             "(ex: /data/crawlers/bovespa")
+    parser.add_argument("--workers-num",
+                        action='store',
+                        default=os.cpu_count(),
+                        type=int,
+                        required=False,
+                        dest="workers_num",
+                        help="The number of parallel processes parsing. "
+                             "By default the number of cores."
+                             "(ex: 8")
+    parser.add_argument("--source",
+                        action='store',
+                        choices=SOURCES,
+                        default=SOURCE_DOWNLOADS,
+                        required=False,
+                        dest="source",
+                        help="Where we find the downloaded files: the "
+                             "downloads checkpoint of the crawler, or all "
+                             "the files of the cache folder."
+                             "(ex: --source scan")
+    parser.add_argument("--include-companies",
+                        action='store',
+                        nargs='*',
+                        required=False,
+                        dest="include_companies",
+                        help="If we want to focus only on a specific "
+                             "companies."
+                             "(ex: 35 94 1384")
+    parser.add_argument("--keep-all-versions",
+                        action='store_true',
+                        required=False,
+                        dest="keep_all_versions",
+                        help="If we want all the versions downloaded of "
+                             "each document, instead of only the latest "
+                             "one."
+                             "(ex: --keep-all-versions")
+    parser.add_argument("--extract-to-disk",
+                        action='store_true',
+                        required=False,
+                        dest="extract_to_disk",
+                        help="If we want to explode the downloaded files in "
+                             "the cache folder, instead of reading the files "
+                             "we need in memory."
+                             "(ex: --extract-to-disk")
+    parser.add_argument("--parse-cache-size",
+                        action='store',
+                        default=PARSE_CACHE_SIZE // (1024 * 1024),
+                        type=int,
+                        required=False,
+                        dest="parse_cache_size",
+                        help="The maximum size in MB of the cache of the "
+                             "parsed files. 0 to parse all the files again."
+                             "(ex: 1024")
+    parser.add_argument("--checkpoint-backend",
+                        action='store',
+                        choices=CHECKPOINT_BACKENDS,
+                        default=CHECKPOINT_BACKEND_SQLITE,
+                        required=False,
+                        dest="checkpoint_backend",
+                        help="How the checkpoint files of the crawler are "
+                             "stored."
+                             "(ex: --checkpoint-backend pickle")
+    parser.add_argument("--columnar-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="columnar_dataset",
+                        help="If we also want the dataset stored column-wise "
+                             "(a NumPy file per account) in "
+                             "data/dataset_columns."
+                             "(ex: --columnar-dataset")
+    parser.add_argument("--long-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="long_dataset",
+                        help="If we also want the dataset stored in long "
+                             "format (one row per value of an account) in "
+                             "data/dataset_long."
+                             "(ex: --long-dataset")
+    parser.add_argument("--derived-dataset",
+                        action='store_true',
+                        required=False,
+                        dest="derived_dataset",
+                        help="If we also want the quarterly, trailing twelve "
+                             "months and year over year values of the "
+                             "accounts in data/dataset_quarterly, "
+                             "data/dataset_ttm and data/dataset_yoy. It "
+                             "implies --columnar-dataset."
+                             "(ex: --derived-dataset")
+
+    args, unknown = parser.parse_known_args()
+
+    # The size of the parse cache is given in MB
+    args.parse_cache_size *= 1024 * 1024
+
+    try:
+        rebuild_dataset(**vars(args))
+    except Exception as ex:
+        _logger.exception("Exception generating the dataset. Arguments: {}".
+                          format(vars(args)))
+        exit(2)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*
+import json
+import time
+import heapq
+import queue
+import random
+import logging
+import threading
+import traceback
+from pathlib import Path
+from datetime import datetime
+from operator import itemgetter
+
+# Times a task is run before we give up on it
+TASK_MAX_ATTEMPTS = 3
+
+# Seconds before the first retry of a task, doubled on every attempt up to
+# TASK_MAX_BACKOFF
+TASK_BACKOFF = 5
+TASK_MAX_BACKOFF = 300
+
+# The tasks that failed all their attempts, one json per line
+DEAD_LETTER_FILE = "logs/dead_letters.jsonl"
+
+# Seconds the runner waits for a new task before looking at the retries
+TASK_POLL_INTERVAL = 0.5
+
+_max_attempts = TASK_MAX_ATTEMPTS
+_dead_letter_file = DEAD_LETTER_FILE
+_dead_letter_lock = threading.Lock()
+
+# Marks the end of the tasks of a run
+_END = object()
+
+_logger = logging.getLogger("bovespa")
+
+
+def configure_task_runner(max_attempts=None, dead_letter_file=None):
+    """
+    Change the attempts of the tasks and the dead letter file of the
+    TaskRunners. It must be called before starting the pools.
+    """
+    global _max_attempts, _dead_letter_file
+    if max_attempts is not None:
+        _max_attempts = max(max_attempts, 1)
+    if dead_letter_file is not None:
+        _dead_letter_file = dead_letter_file
+
+
+def backoff_delay(attempt, backoff=TASK_BACKOFF, max_backoff=TASK_MAX_BACKOFF):
+    """
+    The seconds to wait before the next attempt of a task: an exponential
+    backoff with jitter (between the half and the whole delay), so the
+    tasks that failed at the same time are not retried at the same time
+
+    :param attempt: the attempt that failed, starting at 1
+    """
+    delay = min(backoff * 2 ** (attempt - 1), max_backoff)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def run_task(task):
+    """
+    Run a task in a worker of the pool, returning its error instead of
+    raising it, so a failing task never stops the rest of the tasks
+
+    :return: the id of the task, if it succeeded, and the result or the
+             error and the traceback
+    """
+    task_id, func, params, star = task
+    try:
+        return task_id, True, func(*params) if star else func(params)
+    except Exception as ex:
+        return task_id, False, ("{0}: {1}".format(type(ex).__name__, ex),
+                                traceback.format_exc())
+
+
+class TaskRunner(object):
+    """
+    Runs the tasks of a stage in a pool isolating their failures: a task
+    that fails is retried after a backoff (see backoff_delay) while the
+    rest of the tasks go on, and after max_attempts it is written to the
+    dead letter file with its params and traceback. Only the results of the
+    tasks that succeed are returned.
+
+        runner = TaskRunner(pool, download_file_task, name="download_file")
+        for result in runner.imap_unordered(params):
+            ...
+
+    A runner is used for one run (imap_unordered or starmap) only.
+    """
+
+    def __init__(self, pool, func, name=None, max_attempts=None,
+                 max_pending=None, backoff=TASK_BACKOFF,
+                 max_backoff=TASK_MAX_BACKOFF, dead_letter_file=None,
+                 stop=None):
+        """
+        :param max_pending: the maximum number of tasks running or waiting
+                            for a retry. No limit by default
+        :param stop: an event to stop sending tasks (ex: the one of a
+                     pipeline), dropping the retries
+        """
+        self.pool = pool
+        self.func = func
+        self.name = name or func.__name__
+        self.max_attempts = max_attempts or _max_attempts
+        self.max_pending = max_pending
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_file = dead_letter_file or _dead_letter_file
+        self.stop = stop
+
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+
+        self._condition = threading.Condition()
+        # The task running by id, and the tasks waiting for a retry
+        self._running = {}
+        self._retries = []
+        self._next_task_id = 0
+        self._stopped = False
+        self._error = None
+
+    def _pending(self):
+        return len(self._running) + len(self._retries)
+
+    def _submit(self, index, params, attempt, star):
+        with self._condition:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._running[task_id] = (index, params, attempt)
+        return task_id, self.func, params, star
+
+    def _read(self, iterable, fresh):
+        # The tasks of the iterable can take long to come (ex: the items
+        # of a stage), so they are read in their own thread
+        try:
+            for index, params in enumerate(iterable):
+                while not self._stopped:
+                    try:
+                        fresh.put((index, params), timeout=TASK_POLL_INTERVAL)
+                        break
+                    except queue.Full:
+                        pass
+                if self._stopped:
+                    return
+        except Exception as ex:
+            self._error = ex
+        finally:
+            fresh.put(_END)
+
+    def _tasks(self, iterable, star):
+        """
+        The tasks for the pool: the new ones and the retries when their
+        backoff ends
+        """
+        fresh = queue.Queue(maxsize=1)
+        threading.Thread(target=self._read, args=(iterable, fresh),
+                         name="{}-reader".format(self.name),
+                         daemon=True).start()
+
+        fresh_ended = False
+        while True:
+            with self._condition:
+                if self._stopped or (self.stop and self.stop.is_set()):
+                    return
+                now = time.monotonic()
+                if self._retries and self._retries[0][0] <= now:
+                    _, _, index, params, attempt = heapq.heappop(
+                        self._retries)
+                    task = (index, params, attempt)
+                else:
+                    task = None
+                    if fresh_ended and not self._pending():
+                        return
+                    next_retry = self._retries[0][0] - now \
+                        if self._retries else TASK_POLL_INTERVAL
+                    wait = min(max(next_retry, 0), TASK_POLL_INTERVAL)
+                    if fresh_ended or (self.max_pending and
+                                       self._pending() >= self.max_pending):
+                        self._condition.wait(wait)
+                        continue
+
+            if task is not None:
+                yield self._submit(task[0], task[1], task[2], star)
+                continue
+
+            try:
+                item = fresh.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if item is _END:
+                fresh_ended = True
+                continue
+            yield self._submit(item[0], item[1], 1, star)
+
+    def _imap(self, iterable, star=False):
+        """
+        :return: an iterator over the position in the iterable and the
+                 result of the tasks that succeed, as they end
+        """
+        try:
+            for task_id, success, result in self.pool.imap_unordered(
+                    run_task, self._tasks(iterable, star)):
+                with self._condition:
+                    index, params, attempt = self._running.pop(task_id)
+                    retry = not success and attempt < self.max_attempts
+                    if retry:
+                        delay = backoff_delay(
+                            attempt, self.backoff, self.max_backoff)
+                        heapq.heappush(self._retries, (
+                            time.monotonic() + delay, task_id, index, params,
+                            attempt + 1))
+                    self._condition.notify_all()
+
+                if success:
+                    self.succeeded += 1
+                    yield index, result
+                elif retry:
+                    self.retried += 1
+                    _logger.warning(
+                        "Task {0} {1} failed ({2}). Attempt {3} of {4}, "
+                        "retrying in {5:.1f}s".format(
+                            self.name, params, result[0], attempt,
+                            self.max_attempts, delay))
+                else:
+                    self.failed += 1
+                    self.dead_letter(params, attempt, *result)
+
+            if self._error is not None:
+                raise self._error
+        finally:
+            with self._condition:
+                self._stopped = True
+                self._condition.notify_all()
+
+        if self.retried or self.failed:
+            _logger.info("Task {0}: {1} succeeded, {2} retries and {3} "
+                         "failed (see {4})".format(
+                             self.name, self.succeeded, self.retried,
+                             self.failed, self.dead_letter_file))
+
+    def imap_unordered(self, iterable):
+        """
+        :return: an iterator over the results of the tasks that succeed, as
+                 they end
+        """
+        for index, result in self._imap(iterable):
+            yield result
+
+    def starmap(self, iterable):
+        """
+        :return: the results of the tasks that succeed, in the order of the
+                 iterable
+        """
+        return [result for index, result in
+                sorted(self._imap(iterable, star=True), key=itemgetter(0))]
+
+    def dead_letter(self, params, attempts, error, error_traceback):
+        _logger.error("Task {0} {1} failed {2} times ({3}). Written to {4}".
+                      format(self.name, params, attempts, error,
+                             self.dead_letter_file))
+
+        dead_letter = {"task": self.name,
+                       "params": repr(params),
+                       "attempts": attempts,
+                       "error": error,
+                       "traceback": error_traceback,
+                       "failed_at": datetime.now().isoformat()}
+        with _dead_letter_lock:
+            Path(self.dead_letter_file).parent.mkdir(
+                parents=True, exist_ok=True)
+            with open(self.dead_letter_file, "a") as f:
+                f.write(json.dumps(dead_letter, ensure_ascii=False) + "\n")
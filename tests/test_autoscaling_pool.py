@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import time
+import threading
+import unittest
+from multiprocessing import Value
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from autoscaling_pool import AutoscalingPool  # noqa: E402
+
+# The workers that released their resources, shared with the processes
+_releases = Value("i", 0)
+
+
+class FakeThrottle(object):
+    """
+    A throttle whose calls in progress (rate x latency) are the workers
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def tokens_per_second(self):
+        return self.workers
+
+    def average_latency(self):
+        return 1
+
+
+def worker_id(seconds):
+    time.sleep(seconds)
+    return os.getpid(), threading.get_ident()
+
+
+def count_release():
+    with _releases.get_lock():
+        _releases.value += 1
+
+
+class AutoscalingPoolTest(unittest.TestCase):
+
+    def pool(self, throttle, threads):
+        pool = AutoscalingPool(throttle, max_workers=6, threads=threads,
+                               releaser=count_release, headroom=1,
+                               interval=0)
+        self.addCleanup(self.close, pool)
+        return pool
+
+    @staticmethod
+    def close(pool):
+        pool.close()
+        pool.join()
+
+    def assert_workers(self, pool, tasks, max_workers):
+        workers = set(pool.imap_unordered(worker_id, [0.01] * tasks))
+        self.assertLessEqual(len(workers), max_workers)
+        return workers
+
+    def test_only_the_target_workers_run_tasks(self):
+        for threads in [False, True]:
+            with self.subTest(threads=threads):
+                pool = self.pool(FakeThrottle(2), threads)
+                self.assert_workers(pool, 30, 2)
+
+    def test_scale_down(self):
+        for threads in [False, True]:
+            with self.subTest(threads=threads):
+                _releases.value = 0
+                throttle = FakeThrottle(4)
+                pool = self.pool(throttle, threads)
+                workers = self.assert_workers(pool, 40, 4)
+
+                throttle.workers = 1
+                pool._check_workers()
+                self.assert_workers(pool, 20, 1)
+
+                # The threads over the target exit, and the processes that
+                # got tasks and are not active anymore release their
+                # resources (ex: their browsers)
+                released = 3 if threads else len(workers) - 1
+                deadline = time.monotonic() + 5
+                while _releases.value < released and \
+                        time.monotonic() < deadline:
+                    time.sleep(0.05)
+                self.assertEqual(_releases.value, released)
+
+    def test_runs_share_the_pool(self):
+        pool = self.pool(FakeThrottle(3), threads=True)
+        results = {}
+
+        def run(name):
+            results[name] = list(pool.imap_unordered(
+                worker_id, [0.01] * 20))
+
+        runs = [threading.Thread(target=run, args=(name,))
+                for name in ["a", "b"]]
+        for thread in runs:
+            thread.start()
+        for thread in runs:
+            thread.join(30)
+        self.assertEqual(sorted(len(run) for run in results.values()),
+                         [20, 20])
+
+    def test_errors_do_not_keep_workers_busy(self):
+        pool = self.pool(FakeThrottle(2), threads=False)
+        with self.assertRaises(ValueError):
+            list(pool.imap_unordered(int, ["1", "x", "2", "3"]))
+        self.assertEqual(sorted(pool.imap_unordered(int, ["1", "2", "3"])),
+                         [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
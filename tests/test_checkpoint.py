@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import checkpoint  # noqa: E402
+from checkpoint import (  # noqa: E402
+    Checkpoint, set_checkpoint_backend, CHECKPOINT_BACKEND_SQLITE,
+    CHECKPOINT_BACKEND_PICKLE)
+from utils import get_control_file, put_control_file  # noqa: E402
+
+
+class CheckpointMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        backend = checkpoint._backend
+        self.addCleanup(set_checkpoint_backend, backend)
+        set_checkpoint_backend(CHECKPOINT_BACKEND_SQLITE)
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        os.makedirs(os.path.join(folder.name, "ctl"))
+        self.filename = os.path.join(folder.name, "ctl", "files.ctl")
+        self.db_filename = os.path.join(folder.name, "ctl", "files.sqlite")
+
+    def test_migrate_pickle_control_file(self):
+        put_control_file(self.filename, {"9512_ITR": [("2018-03-31", 1)],
+                                         "9512_DFP": []})
+
+        files = Checkpoint(self.filename)
+
+        self.assertEqual(files.to_dict(), {"9512_ITR": [("2018-03-31", 1)],
+                                           "9512_DFP": []})
+        self.assertIn("9512_ITR", files)
+        self.assertTrue(os.path.exists(self.db_filename))
+        # The control file is left as it was
+        self.assertEqual(len(get_control_file(self.filename, {})), 2)
+
+    def test_migrate_list_control_file(self):
+        put_control_file(self.filename, ["9512", "4170"])
+
+        files = Checkpoint(self.filename)
+
+        self.assertEqual(files.to_dict(), {"9512": True, "4170": True})
+
+    def test_migrate_only_once(self):
+        put_control_file(self.filename, {"9512": 1})
+        files = Checkpoint(self.filename)
+        files.put("4170", 2)
+
+        # A control file written after the migration (ex: by the pickle
+        # backend) is not imported again
+        put_control_file(self.filename, {"9512": 10, "1023": 3})
+        files = Checkpoint(self.filename)
+
+        self.assertEqual(files.to_dict(), {"9512": 1, "4170": 2})
+
+    def test_without_control_file(self):
+        files = Checkpoint(self.filename)
+
+        self.assertEqual(files.items(), [])
+        self.assertIsNone(files.get("9512"))
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_update_and_reset(self):
+        put_control_file(self.filename, {"9512": [1]})
+        files = Checkpoint(self.filename)
+
+        files.update("9512", lambda value: value + [2])
+        files.update("4170", lambda value: value + [3], default=[])
+        self.assertEqual(files.to_dict(), {"9512": [1, 2], "4170": [3]})
+
+        files.reset()
+        self.assertTrue(os.path.exists("{}.bak".format(self.filename)))
+        self.assertTrue(os.path.exists("{}.bak".format(self.db_filename)))
+        self.assertEqual(Checkpoint(self.filename).items(), [])
+
+    def test_pickle_backend(self):
+        set_checkpoint_backend(CHECKPOINT_BACKEND_PICKLE)
+        put_control_file(self.filename, ["9512"])
+        files = Checkpoint(self.filename)
+
+        files.put("4170", 2)
+
+        self.assertEqual(get_control_file(self.filename, {}),
+                         {"9512": True, "4170": 2})
+        self.assertFalse(os.path.exists(self.db_filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import time
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from circuit_breaker import CircuitBreaker, CIRCUIT_CLOSED, CIRCUIT_OPEN, \
+    _COOLDOWN
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def breaker(self, errors):
+        """
+        :return: a function that raises the errors in order (or returns if
+                 the error is None) and its circuit breaker
+        """
+        errors = iter(errors)
+
+        @CircuitBreaker("test", min_calls=4, window=60, cooldown=0.1)
+        def fetch():
+            error = next(errors)
+            if error is not None:
+                raise error
+
+        return fetch, fetch.circuit_breaker
+
+    def call(self, fetch, times):
+        for _ in range(times):
+            try:
+                fetch()
+            except requests.RequestException:
+                pass
+
+    def test_opens_on_read_timeouts(self):
+        fetch, circuit = self.breaker([requests.ReadTimeout()] * 4)
+        self.call(fetch, 3)
+        self.assertEqual(circuit.state(), CIRCUIT_CLOSED)
+        self.call(fetch, 1)
+        self.assertEqual(circuit.state(), CIRCUIT_OPEN)
+
+    def test_probe_with_read_timeout_reopens(self):
+        fetch, circuit = self.breaker([requests.ReadTimeout()] * 5 + [None])
+        self.call(fetch, 4)
+        self.assertEqual(circuit.state(), CIRCUIT_OPEN)
+
+        # The probe waits for the cooldown and fails, doubling it
+        self.call(fetch, 1)
+        self.assertEqual(circuit.state(), CIRCUIT_OPEN)
+        self.assertAlmostEqual(circuit._circuit[_COOLDOWN], 0.2)
+
+        started = time.monotonic()
+        fetch()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertEqual(circuit.state(), CIRCUIT_CLOSED)
+
+    def test_failures(self):
+        _, circuit = self.breaker([])
+        for ex in [requests.ReadTimeout(), requests.ConnectTimeout(),
+                   requests.ConnectionError(),
+                   requests.exceptions.ChunkedEncodingError(),
+                   http_error(503)]:
+            self.assertTrue(circuit.is_failure(ex), repr(ex))
+
+        # The endpoint answered
+        for ex in [http_error(404), ValueError()]:
+            self.assertFalse(circuit.is_failure(ex), repr(ex))
+
+    def test_client_errors_do_not_open(self):
+        fetch, circuit = self.breaker([http_error(404)] * 4)
+        self.call(fetch, 4)
+        self.assertEqual(circuit.state(), CIRCUIT_CLOSED)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*
+import os
+import re
+import sys
+import unittest
+import warnings
+from datetime import datetime
+
+import lxml.html
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "benchmarks"))
+
+from crawling_parts.company_files import parse_company_files_page  # noqa
+from company_files_parser_benchmark import (  # noqa: E402
+    legacy_extract_company_files_from_page, no_next_page,
+    RE_COMPANY_NAME, RE_CNPJ)
+
+# A documents listing of a company with all its ITR files in one page, some
+# of them without download, and a DFP file
+PAGE_FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures",
+                            "company_files_ITR.html")
+
+
+class CompanyFilesParserTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(PAGE_FIXTURE, encoding="utf-8") as f:
+            cls.html = f.read()
+
+    def legacy(self, doc_type, from_date=None):
+        with warnings.catch_warnings():
+            # The deprecated BeautifulSoup calls of the legacy parser
+            warnings.simplefilter("ignore", DeprecationWarning)
+            return legacy_extract_company_files_from_page(
+                "1023", no_next_page, BeautifulSoup(self.html, "html.parser"),
+                doc_type=doc_type, from_date=from_date)
+
+    def parse(self, doc_type, from_date=None):
+        return parse_company_files_page(
+            lxml.html.fromstring(self.html), doc_type=doc_type,
+            from_date=from_date)
+
+    def test_same_files_as_legacy_parser(self):
+        for doc_type in ["ITR", "DFP"]:
+            legacy = self.legacy(doc_type)
+            self.assertTrue(legacy)
+            self.assertEqual(self.parse(doc_type).files, legacy)
+
+    def test_same_files_as_legacy_parser_from_date(self):
+        for from_date in [datetime(2018, 1, 1),
+                          datetime(2018, 5, 10, 18, 35)]:
+            page = self.parse("ITR", from_date=from_date)
+            self.assertEqual(page.files, self.legacy("ITR", from_date))
+            self.assertTrue(page.complete)
+
+    def test_same_company_as_legacy_parser(self):
+        html = str(BeautifulSoup(self.html, "html.parser"))
+        page = self.parse("ITR")
+        self.assertEqual(page.company_name,
+                         re.search(RE_COMPANY_NAME, html)[1].strip())
+        self.assertEqual(page.cnpj,
+                         re.search(RE_CNPJ, html)[1].strip().lower())
+        self.assertEqual((page.num_of_docs, page.last_file_in_page), (6, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
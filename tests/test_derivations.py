@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from crawling_parts.derivations import (  # noqa: E402
+    account_kind, quarterly_values, derive, derive_measures,
+    MEASURES, MEASURE_TTM, MEASURE_YOY)
+
+NAN = np.nan
+
+# A DRE account (the quarter alone, the DFP the whole year), a DFC account
+# (since the start of the year) and a balance, for 2 years
+ACCOUNTS = ["3.01", "6.01", "1.01"]
+REPORTED = [
+    # Q1, Q2, Q3, DFP of the first year, then of the second one
+    [10, 5, 1], [20, 15, 2], [30, 30, 3], [100, 50, 4],
+    [11, 6, 5], [22, 16, 6], [33, 33, 7], [110, 60, 8],
+]
+
+
+def reported(values=REPORTED):
+    """
+    :return: the array (companies, quarters, accounts) of a company
+    """
+    return np.array([values], dtype="float64")
+
+
+def kinds():
+    return np.array([account_kind(account) for account in ACCOUNTS])
+
+
+class QuarterlyValuesTest(unittest.TestCase):
+
+    def test_q4_is_the_year_minus_nine_months(self):
+        quarterly = quarterly_values(reported(), kinds())[0]
+
+        # DRE: the DFP minus the Q1, Q2 and Q3
+        np.testing.assert_array_equal(quarterly[:, 0],
+                                      [10, 20, 30, 40, 11, 22, 33, 44])
+        # DFC: the difference with the previous quarter of the year
+        np.testing.assert_array_equal(quarterly[:, 1],
+                                      [5, 10, 15, 20, 6, 10, 17, 27])
+        # Balances as reported
+        np.testing.assert_array_equal(quarterly[:, 2], range(1, 9))
+
+    def test_missing_quarter(self):
+        values = [list(quarter) for quarter in REPORTED]
+        values[5] = [NAN, NAN, NAN]  # No Q2 filing in the second year
+        quarterly = quarterly_values(reported(values), kinds())[0]
+
+        # The Q4 of the DRE needs the 9 months
+        np.testing.assert_array_equal(quarterly[:, 0],
+                                      [10, 20, 30, 40, 11, NAN, 33, NAN])
+        # The Q3 of the DFC needs the Q2, the Q4 only the Q3
+        np.testing.assert_array_equal(quarterly[:, 1],
+                                      [5, 10, 15, 20, 6, NAN, NAN, 27])
+        np.testing.assert_array_equal(quarterly[:, 2],
+                                      [1, 2, 3, 4, 5, NAN, 7, 8])
+
+        ttm = derive(reported(values), kinds(), MEASURE_TTM)[0]
+        np.testing.assert_array_equal(
+            ttm[:, 0], [NAN, NAN, NAN, 100, 101, NAN, NAN, NAN])
+
+        yoy = derive(reported(values), kinds(), MEASURE_YOY)[0]
+        np.testing.assert_array_equal(
+            yoy[:, 0], [NAN, NAN, NAN, NAN, 1, NAN, 3, NAN])
+
+
+class DeriveTest(unittest.TestCase):
+
+    def test_ttm_and_yoy(self):
+        ttm = derive(reported(), kinds(), MEASURE_TTM)[0]
+        np.testing.assert_array_equal(
+            ttm[:, 0], [NAN, NAN, NAN, 100, 101, 103, 106, 110])
+        np.testing.assert_array_equal(
+            ttm[:, 1], [NAN, NAN, NAN, 50, 51, 51, 53, 60])
+        # The balances are not summed
+        np.testing.assert_array_equal(ttm[:, 2], range(1, 9))
+
+        yoy = derive(reported(), kinds(), MEASURE_YOY)[0]
+        np.testing.assert_array_equal(
+            yoy[:, 0], [NAN, NAN, NAN, NAN, 1, 2, 3, 4])
+        np.testing.assert_array_equal(
+            yoy[:, 2], [NAN, NAN, NAN, NAN, 4, 4, 4, 4])
+
+    def test_derive_measures_share_the_quarterly_values(self):
+        derived = derive_measures(reported(), kinds())
+        self.assertEqual(sorted(derived), sorted(MEASURES))
+        for measure in MEASURES:
+            np.testing.assert_array_equal(
+                derived[measure], derive(reported(), kinds(), measure))
+
+        with mock.patch("crawling_parts.derivations.quarterly_values",
+                        wraps=quarterly_values) as quarterly:
+            derive_measures(reported(), kinds())
+        self.assertEqual(quarterly.call_count, 1)
+
+    def test_unknown_measure(self):
+        with self.assertRaises(ValueError):
+            derive_measures(reported(), kinds(), ["monthly"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*
+import io
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from crawling_parts.download_file import (  # noqa: E402
+    latest_versions, iter_xml_elements, convert_xml_into_json,
+    get_financial_info_accounts, read_file_content, FilingContext)
+from benchmarks.account_extractor_benchmark import (  # noqa: E402
+    synthetic_package)
+
+FINANCIAL_INFO_XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<ArrayOfInfoFinaDFin>
+  <InfoFinaDFin codigo="1">
+    <PlanoConta>
+      <NumeroConta>1.01</NumeroConta>
+    </PlanoConta>
+    <DescricaoConta1>Caixa e
+ Equivalentes</DescricaoConta1>
+    <ValorConta1>-1500.5</ValorConta1>
+    <ValorConta2>0</ValorConta2>
+    <Nota>a</Nota>
+    <Nota>b</Nota>
+  </InfoFinaDFin>
+  <Outro>ignored</Outro>
+  <InfoFinaDFin codigo="2">
+    <PlanoConta>
+      <NumeroConta>2</NumeroConta>
+    </PlanoConta>
+    <DescricaoConta1>Passivo</DescricaoConta1>
+    <ValorConta1></ValorConta1>
+    <Nota>c</Nota>
+  </InfoFinaDFin>
+</ArrayOfInfoFinaDFin>
+"""
+
+
+def badgerfish_elements(file):
+    """
+    The extraction before iter_xml_elements: the whole file into json
+    """
+    return convert_xml_into_json(file)["ArrayOfInfoFinaDFin"]["InfoFinaDFin"]
+
+
+class LatestVersionsTest(unittest.TestCase):
+
+    def test_latest_version_of_each_fiscal_date(self):
+        files = [
+            ("2018-03-31", "1", "1.0", "ITR", "ORIGINAL", "2018-05-10"),
+            ("2018-06-30", "2", "1.0", "ITR", "ORIGINAL", "2018-08-10"),
+            ("2018-03-31", "3", "10.0", "ITR", "REAPRESENTACAO",
+             "2018-06-01"),
+            ("2018-03-31", "4", "2.0", "ITR", "REAPRESENTACAO",
+             "2018-07-01"),
+        ]
+
+        self.assertEqual(latest_versions(files), [files[1], files[2]])
+
+    def test_same_version_by_delivery_date(self):
+        files = [
+            ("2018-12-31", "1", "1.0", "DFP", "ORIGINAL", "2019-03-01"),
+            ("2018-12-31", "2", "1.0", "DFP", "ORIGINAL", "2019-02-01"),
+        ]
+
+        self.assertEqual(latest_versions(files), [files[0]])
+
+    def test_without_files(self):
+        self.assertEqual(latest_versions([]), [])
+
+
+class IterXmlElementsTest(unittest.TestCase):
+
+    def test_same_as_badgerfish(self):
+        elements = list(iter_xml_elements(FINANCIAL_INFO_XML,
+                                          "InfoFinaDFin"))
+
+        self.assertEqual(elements, badgerfish_elements(FINANCIAL_INFO_XML))
+        self.assertEqual(elements[0]["@codigo"], 1)
+        self.assertEqual(elements[0]["DescricaoConta1"]["$"],
+                         "Caixa e Equivalentes")
+        self.assertEqual(elements[0]["Nota"], [{"$": "a"}, {"$": "b"}])
+
+    def test_from_path(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "InfoFinaDFin.xml")
+            with open(filename, "wb") as f:
+                f.write(FINANCIAL_INFO_XML)
+
+            self.assertEqual(list(iter_xml_elements(filename, "InfoFinaDFin")),
+                             badgerfish_elements(filename))
+
+    def test_same_accounts(self):
+        for doc_type in ["ITR", "DFP"]:
+            with self.subTest(doc_type=doc_type):
+                available_files = read_file_content(
+                    doc_type, io.BytesIO(synthetic_package(doc_type, 200)))
+
+                accounts = [
+                    get_financial_info_accounts(
+                        FilingContext(available_files), "9512",
+                        datetime(2018, 3, 31), "1.0", doc_type,
+                        stream=stream)
+                    for stream in [True, False]]
+
+                self.assertTrue(accounts[0])
+                self.assertEqual(accounts[0], accounts[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
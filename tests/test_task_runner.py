@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from task_runner import TaskRunner, backoff_delay  # noqa: E402
+
+
+class FlakyTask(object):
+    """
+    A task that fails the first failures times it is called for each param,
+    recording when it was called
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, param):
+        with self._lock:
+            calls = self.calls.setdefault(param, [])
+            calls.append(time.monotonic())
+            attempt = len(calls)
+        if attempt <= self.failures.get(param, 0):
+            raise ValueError("attempt {0} of {1}".format(attempt, param))
+        return param * 10
+
+
+class BackoffDelayTest(unittest.TestCase):
+
+    def test_exponential_with_jitter(self):
+        for attempt, delay in [(1, 5), (2, 10), (3, 20)]:
+            for _ in range(50):
+                self.assertGreaterEqual(backoff_delay(attempt), delay / 2)
+                self.assertLessEqual(backoff_delay(attempt), delay)
+
+    def test_max_backoff(self):
+        for _ in range(50):
+            self.assertLessEqual(backoff_delay(20, backoff=5, max_backoff=60),
+                                 60)
+            self.assertGreaterEqual(
+                backoff_delay(20, backoff=5, max_backoff=60), 30)
+
+
+class TaskRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(processes=4)
+        self.addCleanup(self.pool.terminate)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.dead_letter_file = os.path.join(folder.name, "logs",
+                                             "dead_letters.jsonl")
+
+    def runner(self, task, max_attempts=3, backoff=0.1):
+        return TaskRunner(self.pool, task, name="flaky",
+                          max_attempts=max_attempts, backoff=backoff,
+                          max_backoff=1,
+                          dead_letter_file=self.dead_letter_file)
+
+    def dead_letters(self):
+        if not os.path.exists(self.dead_letter_file):
+            return []
+        with open(self.dead_letter_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_retry_after_backoff(self):
+        task = FlakyTask({2: 2})
+        runner = self.runner(task)
+
+        results = sorted(runner.imap_unordered(range(5)))
+
+        self.assertEqual(results, [0, 10, 20, 30, 40])
+        self.assertEqual((runner.succeeded, runner.retried, runner.failed),
+                         (5, 2, 0))
+        self.assertEqual(self.dead_letters(), [])
+
+        # The second retry waits twice the first one, with jitter
+        first, second, third = task.calls[2]
+        self.assertGreaterEqual(second - first, 0.05)
+        self.assertGreaterEqual(third - second, 0.1)
+
+    def test_other_tasks_go_on_during_backoff(self):
+        task = FlakyTask({0: 1})
+        runner = self.runner(task, backoff=0.5)
+
+        results = list(runner.imap_unordered(range(4)))
+
+        # The task that failed ends the last one, after its backoff
+        self.assertEqual(results[-1], 0)
+        self.assertEqual(sorted(results), [0, 10, 20, 30])
+
+    def test_dead_letter(self):
+        task = FlakyTask({1: 10})
+        runner = self.runner(task, backoff=0.01)
+
+        results = sorted(runner.imap_unordered(range(3)))
+
+        self.assertEqual(results, [0, 20])
+        self.assertEqual(len(task.calls[1]), 3)
+        self.assertEqual((runner.succeeded, runner.retried, runner.failed),
+                         (2, 2, 1))
+
+        dead_letters = self.dead_letters()
+        self.assertEqual(len(dead_letters), 1)
+        dead_letter = dead_letters[0]
+        self.assertEqual(dead_letter["task"], "flaky")
+        self.assertEqual(dead_letter["params"], "1")
+        self.assertEqual(dead_letter["attempts"], 3)
+        self.assertEqual(dead_letter["error"], "ValueError: attempt 3 of 1")
+        self.assertIn("ValueError: attempt 3 of 1", dead_letter["traceback"])
+        self.assertIn("failed_at", dead_letter)
+
+    def test_starmap_keeps_the_order(self):
+        task = FlakyTask({0: 1, 3: 2})
+        runner = TaskRunner(self.pool, lambda param, factor: task(param) *
+                            factor, name="flaky", backoff=0.01,
+                            dead_letter_file=self.dead_letter_file)
+
+        results = runner.starmap([(param, 2) for param in range(5)])
+
+        self.assertEqual(results, [0, 20, 40, 60, 80])
+
+    def test_stop_drops_the_retries(self):
+        stop = threading.Event()
+        task = FlakyTask({0: 10})
+        runner = TaskRunner(self.pool, task, name="flaky", backoff=10,
+                            dead_letter_file=self.dead_letter_file,
+                            stop=stop)
+
+        results = []
+        for result in runner.imap_unordered(range(3)):
+            results.append(result)
+            if len(results) == 2:
+                stop.set()
+
+        self.assertEqual(sorted(results), [10, 20])
+        self.assertEqual(self.dead_letters(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utils import (  # noqa: E402
+    version_number, temporary_folder, replace_folder)
+
+
+def write_file(filename, content):
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def folder_content(folder):
+    content = {}
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name)) as f:
+            content[name] = f.read()
+    return content
+
+
+class VersionNumberTest(unittest.TestCase):
+
+    def test_version_number(self):
+        self.assertEqual(version_number("1.0"), (1, 0))
+        self.assertEqual(version_number("10.2"), (10, 2))
+        self.assertLess(version_number("2.0"), version_number("10.0"))
+        self.assertLess(version_number("1.0"), version_number("1.1"))
+
+
+class ReplaceFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.folder = os.path.join(self.root, "dataset", "9512")
+
+    def test_replace_folder(self):
+        os.makedirs(self.folder)
+        write_file(os.path.join(self.folder, "old.csv"), "old")
+
+        tmp_folder = temporary_folder(self.folder)
+        self.assertEqual(str(tmp_folder), "{}.tmp".format(self.folder))
+        # The current content is kept until the new one is in place
+        self.assertEqual(folder_content(self.folder), {"old.csv": "old"})
+        write_file(os.path.join(str(tmp_folder), "new.csv"), "new")
+
+        replace_folder(tmp_folder, self.folder)
+
+        self.assertEqual(folder_content(self.folder), {"new.csv": "new"})
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.folder))),
+                         ["9512"])
+
+    def test_replace_missing_folder(self):
+        tmp_folder = temporary_folder(self.folder)
+        write_file(os.path.join(str(tmp_folder), "new.csv"), "new")
+
+        replace_folder(tmp_folder, self.folder)
+
+        self.assertEqual(folder_content(self.folder), {"new.csv": "new"})
+
+    def test_stale_folders(self):
+        # Left by a run that was interrupted
+        os.makedirs(self.folder)
+        os.makedirs("{}.tmp".format(self.folder))
+        write_file(os.path.join("{}.tmp".format(self.folder), "half.csv"),
+                   "half")
+        os.makedirs("{}.old".format(self.folder))
+
+        tmp_folder = temporary_folder(self.folder)
+        self.assertEqual(os.listdir(str(tmp_folder)), [])
+        write_file(os.path.join(str(tmp_folder), "new.csv"), "new")
+
+        replace_folder(tmp_folder, self.folder)
+
+        self.assertEqual(folder_content(self.folder), {"new.csv": "new"})
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.folder))),
+                         ["9512"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,87 @@
 # -*- coding: utf-8 -*
 # https://quentin.pradet.me/blog/how-do-you-rate-limit-calls-with-aiohttp.html
 import time
+import socket
 import logging
 from datetime import timedelta
 from functools import wraps
-from multiprocessing import Manager
+from multiprocessing import Lock, RawArray
 
-manager = Manager()
-lock = manager.Lock()
-_throttle_info = manager.dict()
+import requests
 
 _logger = logging.getLogger("bovespa")
 
+# Positions of the token bucket fields inside the shared array
+_TOKENS = 0
+_UPDATED_AT = 1
+_RATE = 2
+_LATENCY = 3
+
+# Adaptive throttles registered by function name, to be configured from the
+# command line before the pools are started
+_adaptive_throttles = {}
+_adaptive_mode = False
+
+
+def set_adaptive_mode(enabled):
+    """
+    Enable or disable the adaptive rate control of the AdaptiveThrottle
+    decorated functions. It must be called before starting the pools.
+    """
+    global _adaptive_mode
+    _adaptive_mode = enabled
+
+
+def configure_adaptive_throttle(fn_name, min_rate=None, max_rate=None):
+    """
+    Change the floor and the ceiling of the rate of an adaptive throttled
+    function (ex: configure_adaptive_throttle("download_file", 5, 60))
+
+    :raise ValueError: if there is no adaptive throttled function with the
+                       name
+    """
+    if fn_name not in _adaptive_throttles:
+        raise ValueError("Unknown adaptive throttled function {0}. Valid "
+                         "functions: {1}".format(
+                             fn_name, ", ".join(adaptive_throttle_names())))
+    throttle = _adaptive_throttles[fn_name]
+    if min_rate is not None:
+        throttle.min_rate = min_rate
+    if max_rate is not None:
+        throttle.max_rate = max_rate
+    throttle.set_rate(min(max(throttle.current_rate(), throttle.min_rate),
+                          throttle.max_rate))
+
+
+def adaptive_throttle_names():
+    """
+    :return: the names of the adaptive throttled functions
+    """
+    return sorted(_adaptive_throttles)
+
+
+def log_adaptive_rates():
+    for fn_name, throttle in _adaptive_throttles.items():
+        _logger.info("Effective throttle rate for {0}: {1:.2f} calls every "
+                     "{2}s".format(fn_name, throttle.current_rate(),
+                                   throttle.throttle_period.total_seconds()))
+
+
+def is_server_failure(ex):
+    """
+    The errors that tell us the server is not able to cope with our rate:
+    timeouts (also the read timeouts of requests) and HTTP 5xx responses
+    """
+    if isinstance(ex, (socket.timeout, TimeoutError, requests.Timeout)):
+        return True
+
+    status_code = getattr(ex, "code", None)
+    response = getattr(ex, "response", None)
+    if response is not None:
+        status_code = getattr(response, "status_code", status_code)
+
+    return isinstance(status_code, int) and status_code >= 500
+
 
 class Throttle(object):
     """
@@ -22,6 +92,14 @@ class Throttle(object):
         @throttle(minutes=1, rate=10, max_tokens=10)
         def my_fun():
             pass
+
+    The token bucket lives in shared memory (a lock-protected array of
+    doubles) created when the function is decorated, so all the processes
+    forked by a Pool after the import share the same bucket without any
+    round trip to a Manager process. Tokens are refilled with fractional
+    precision and a throttled call sleeps exactly the time needed until the
+    next token is available. The moving average of the duration of the calls
+    is kept in the bucket too (see average_latency).
     """
 
     def __init__(self, seconds=1, minutes=0, hours=0, rate=10, max_tokens=10):
@@ -31,53 +109,175 @@ class Throttle(object):
         self.rate = rate
         self.max_tokens = max_tokens
 
-    def check_info(self, fn_name):
-        _logger.debug("Checking tokens info for {0}".format(fn_name))
-        info = _throttle_info.get(fn_name, None)
-        if not info:
-            _logger.debug("Initialize tokens for {0}".format(fn_name))
-            info = {"tokens": self.max_tokens,
-                    "updated_at": time.monotonic()}
-            _throttle_info[fn_name] = info
+        self._lock = Lock()
+        self._bucket = RawArray("d", [max_tokens, time.monotonic(), rate, 0])
+
+    def tokens_per_second(self):
+        return self._bucket[_RATE] / self.throttle_period.total_seconds()
+
+    def current_rate(self):
+        """
+        The effective number of calls allowed every throttle period
+        """
+        return self._bucket[_RATE]
+
+    def average_latency(self):
+        """
+        The moving average of the duration of the calls (seconds), without
+        the time waiting for a token. 0 until a call ends
+        """
+        return self._bucket[_LATENCY]
+
+    def record_latency(self, latency):
+        """
+        Add the duration of a call to the moving average of the latency.
+        Must be called holding the lock.
+
+        :return: the new average
+        """
+        average = self._bucket[_LATENCY]
+        average = latency if not average else 0.8 * average + 0.2 * latency
+        self._bucket[_LATENCY] = average
+        return average
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.add_new_tokens(time.monotonic())
+            self._bucket[_RATE] = rate
+
+    def add_new_tokens(self, now):
+        """
+        Refill the bucket with the tokens generated since the last update.
+        Must be called holding the lock.
+        """
+        elapsed = now - self._bucket[_UPDATED_AT]
+        if elapsed > 0:
+            self._bucket[_TOKENS] = min(
+                self._bucket[_TOKENS] + elapsed * self.tokens_per_second(),
+                self.max_tokens)
+            self._bucket[_UPDATED_AT] = now
+
+    def try_acquire(self):
+        """
+        Try to get a token from the bucket.
+
+        :return: 0 if the token was acquired, or the number of seconds to
+                 wait until the next token will be available
+        """
+        with self._lock:
+            self.add_new_tokens(time.monotonic())
+            tokens = self._bucket[_TOKENS]
+            if tokens >= 1:
+                self._bucket[_TOKENS] = tokens - 1
+                return 0
+            return (1 - tokens) / self.tokens_per_second()
 
     def wait_for_token(self, fn_name):
-        lock.acquire()
-        self.check_info(fn_name)
-        while _throttle_info[fn_name]["tokens"] <= 1:
-            self.add_new_tokens(fn_name)
-            lock.release()
-            _logger.debug("Function {} being throttle".format(fn_name))
-            time.sleep(5)
-            lock.acquire()
-
-        _throttle_info[fn_name] = {
-            "tokens": _throttle_info[fn_name]["tokens"] - 1,
-            "updated_at": _throttle_info[fn_name]["updated_at"]
-        }
-        _logger.debug("Tokens info. {0} -> {1}".format(
-            fn_name, _throttle_info[fn_name]))
-        lock.release()
-
-    def add_new_tokens(self, fn_name):
-        now = time.monotonic()
-        time_since_update = \
-            (now - _throttle_info[fn_name]["updated_at"]) / \
-            self.throttle_period.seconds
-        new_tokens = int(time_since_update * self.rate)
-        if new_tokens > 1:
-            _throttle_info[fn_name] = {
-                "tokens": min(
-                    _throttle_info[fn_name]["tokens"] + new_tokens,
-                    self.max_tokens),
-                "updated_at": now
-            }
-            _logger.debug("New Tokens info. {0} -> {1}".format(
-                fn_name, _throttle_info[fn_name]))
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            _logger.debug("Function {0} being throttle for {1:.2f}s".
+                          format(fn_name, wait))
+            time.sleep(wait)
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.wait_for_token(fn.__name__)
+            started_at = time.monotonic()
+            result = fn(*args, **kwargs)
+            with self._lock:
+                self.record_latency(time.monotonic() - started_at)
+            return result
+
+        wrapper.throttle = self
+        return wrapper
+
+
+class AdaptiveThrottle(Throttle):
+    """
+    Throttle decorator that adapts the rate to the health of the server
+    (AIMD) when the adaptive mode is enabled (see set_adaptive_mode):
+
+        - every healthy call (no failure and an average latency under
+          latency_target seconds) increases the rate by increase / rate,
+          which means the rate grows by increase calls every period
+        - every failure (timeouts, HTTP 5xx or any of the failures
+          exceptions) multiplies the rate by decrease and empties the bucket
+
+    The rate always stays between min_rate and max_rate. When the adaptive
+    mode is disabled it behaves like a Throttle with a fixed rate.
+        @AdaptiveThrottle(minutes=1, rate=20, min_rate=5, max_rate=60)
+        def my_fun():
+            pass
+    """
+
+    def __init__(self, seconds=1, minutes=0, hours=0, rate=10, max_tokens=10,
+                 min_rate=1, max_rate=None, increase=1, decrease=0.5,
+                 latency_target=10, failures=()):
+        super(AdaptiveThrottle, self).__init__(
+            seconds=seconds, minutes=minutes, hours=hours,
+            rate=rate, max_tokens=max_tokens)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.failures = tuple(failures)
+
+    def is_failure(self, ex):
+        return isinstance(ex, self.failures) or is_server_failure(ex)
+
+    def on_success(self, fn_name, latency):
+        with self._lock:
+            # Exponentially weighted moving average of the call latency
+            average = self.record_latency(latency)
+            if not _adaptive_mode:
+                return
+
+            rate = self._bucket[_RATE]
+            if average > self.latency_target or rate >= self.max_rate:
+                return
+            self.add_new_tokens(time.monotonic())
+            new_rate = min(rate + self.increase / rate, self.max_rate)
+            self._bucket[_RATE] = new_rate
+
+        if int(new_rate) != int(rate):
+            _logger.info("Throttle rate for {0} increased to {1:.2f} calls "
+                         "every {2}s (latency {3:.2f}s)".format(
+                             fn_name, new_rate,
+                             self.throttle_period.total_seconds(), average))
+
+    def on_failure(self, fn_name, ex):
+        with self._lock:
+            self.add_new_tokens(time.monotonic())
+            rate = self._bucket[_RATE]
+            new_rate = max(rate * self.decrease, self.min_rate)
+            self._bucket[_RATE] = new_rate
+            self._bucket[_TOKENS] = min(self._bucket[_TOKENS], 0)
+
+        _logger.warning("Throttle rate for {0} decreased to {1:.2f} calls "
+                        "every {2}s after {3}".format(
+                            fn_name, new_rate,
+                            self.throttle_period.total_seconds(),
+                            type(ex).__name__))
 
     def __call__(self, fn):
+        _adaptive_throttles[fn.__name__] = self
+
         @wraps(fn)
         def wrapper(*args, **kwargs):
             self.wait_for_token(fn.__name__)
-            return fn(*args, **kwargs)
+            started_at = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as ex:
+                if _adaptive_mode and self.is_failure(ex):
+                    self.on_failure(fn.__name__, ex)
+                raise
+            self.on_success(fn.__name__, time.monotonic() - started_at)
+            return result
 
+        wrapper.throttle = self
         return wrapper
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*
+import os
 import re
 import pickle
+import shutil
 from pathlib import Path
 
 from dateutil.parser import parse as date_parse
@@ -23,13 +25,18 @@ def get_control_file(filename, default=None):
 
 
 def put_control_file(filename, content):
-    with open(filename, "wb") as f:
-        return pickle.dump(content, f, pickle.HIGHEST_PROTOCOL)
+    # Write a temporary file and replace the control file with it, so a crash
+    # never leaves a half written control file
+    tmp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(content, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
 
 
 def get_cache_folder(cache_folder, extra_path=None):
     if not cache_folder:
-        import os
         cache_folder = os.path.dirname(os.path.realpath(__file__))
 
     if extra_path:
@@ -38,4 +45,40 @@ def get_cache_folder(cache_folder, extra_path=None):
 
     Path(cache_folder).mkdir(parents=True, exist_ok=True)
 
-    return cache_folder
\ No newline at end of file
+    return cache_folder
+
+
+def version_number(version):
+    """
+    The version of a document as a tuple of numbers, to sort the versions
+    (ex: 1.0 is older than 2.0 and 10.0)
+    """
+    return tuple(int(number) for number in re.findall(r"\d+", version))
+
+
+def temporary_folder(folder):
+    """
+    Create an empty folder next to a folder (folder.tmp), to write the new
+    content of the folder before replacing it (see replace_folder)
+    """
+    tmp_folder = Path("{}.tmp".format(folder))
+    if tmp_folder.exists():
+        shutil.rmtree(str(tmp_folder))
+    tmp_folder.mkdir(parents=True)
+    return tmp_folder
+
+
+def replace_folder(tmp_folder, folder):
+    """
+    Replace a folder with its temporary folder (see temporary_folder). The
+    previous content is moved to folder.old and removed once the new one is
+    in place, so the folder is never half written
+    """
+    old_folder = Path("{}.old".format(folder))
+    if Path(folder).exists():
+        if old_folder.exists():
+            shutil.rmtree(str(old_folder))
+        os.replace(str(folder), str(old_folder))
+    os.replace(str(tmp_folder), str(folder))
+    if old_folder.exists():
+        shutil.rmtree(str(old_folder))